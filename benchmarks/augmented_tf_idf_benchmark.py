@@ -0,0 +1,92 @@
+__author__ = 'Georgios Rizos (georgerizos@iti.gr)'
+
+import argparse
+import time
+
+import numpy as np
+import scipy.sparse as sparse
+
+from reveal_user_annotation.text.text_util import augmented_tf_idf
+
+
+def augmented_tf_idf_loop(attribute_matrix):
+    """
+    The previous implementation of augmented_tf_idf, with one sparse slice per column and per row.
+    """
+    number_of_documents = attribute_matrix.shape[0]
+
+    max_term_frequencies = np.ones(number_of_documents, dtype=np.float64)
+    idf_array = np.ones(attribute_matrix.shape[1], dtype=np.float64)
+
+    # Calculate inverse document frequency
+    attribute_matrix = attribute_matrix.tocsc()
+    for j in range(attribute_matrix.shape[1]):
+        document_frequency = attribute_matrix.getcol(j).data.size
+        if document_frequency > 1:
+            idf_array[j] = np.log(number_of_documents/document_frequency)
+
+    # Calculate maximum term frequencies for a user
+    attribute_matrix = attribute_matrix.tocsr()
+    for i in range(attribute_matrix.shape[0]):
+        max_term_frequency = attribute_matrix.getrow(i).data
+        if max_term_frequency.size > 0:
+            max_term_frequency = max_term_frequency.max()
+            if max_term_frequency > 0.0:
+                max_term_frequencies[i] = max_term_frequency
+
+    # Do augmented tf-idf normalization
+    attribute_matrix = attribute_matrix.tocoo()
+    attribute_matrix.data = 0.5 + np.divide(0.5*attribute_matrix.data, np.multiply((max_term_frequencies[attribute_matrix.row]), (idf_array[attribute_matrix.col])))
+    attribute_matrix = attribute_matrix.tocsr()
+
+    return attribute_matrix
+
+
+def form_random_user_term_matrix(number_of_users, number_of_terms, density, seed):
+    """
+    Forms a random user-term count matrix with heavy-tailed term popularity, in COO format.
+    """
+    random_state = np.random.RandomState(seed)
+    nnz = int(number_of_users*number_of_terms*density)
+
+    row = random_state.randint(0, number_of_users, size=nnz)
+    col = np.minimum(random_state.zipf(1.5, size=nnz) - 1, number_of_terms - 1)
+    data = random_state.randint(1, 10, size=nnz).astype(np.float64)
+
+    return sparse.coo_matrix((data, (row, col)), shape=(number_of_users, number_of_terms))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the loop-based and the vectorized augmented_tf_idf.")
+    parser.add_argument("--users", dest="number_of_users", type=int, default=100000)
+    parser.add_argument("--terms", dest="number_of_terms", type=int, default=20000)
+    parser.add_argument("--density", dest="density", type=float, default=0.0005)
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+    args = parser.parse_args()
+
+    matrix = form_random_user_term_matrix(args.number_of_users, args.number_of_terms, args.density, args.seed)
+    print("Matrix shape:", matrix.shape, "nnz:", matrix.getnnz())
+
+    start_time = time.perf_counter()
+    reference = augmented_tf_idf_loop(matrix)
+    loop_time = time.perf_counter() - start_time
+    print("Loop implementation:       %.3f s" % loop_time)
+
+    for matrix_format in ("coo", "csr", "csc"):
+        formatted_matrix = matrix.asformat(matrix_format)
+
+        start_time = time.perf_counter()
+        result = augmented_tf_idf(formatted_matrix)
+        vectorized_time = time.perf_counter() - start_time
+
+        identical = (np.array_equal(result.indptr, reference.indptr) and
+                     np.array_equal(result.indices, reference.indices) and
+                     np.array_equal(result.data, reference.data))
+        print("Vectorized (%s input):    %.3f s, speedup: %.1fx, bit-identical: %s" % (matrix_format,
+                                                                                       vectorized_time,
+                                                                                       loop_time/vectorized_time,
+                                                                                       identical))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,555 @@
+__author__ = 'Georgios Rizos (georgerizos@iti.gr)'
+
+import os
+import operator
+import tempfile
+import collections
+from array import array
+from collections.abc import Mapping
+
+import numpy as np
+import scipy.sparse as spsp
+
+
+########################################################################################################################
+# Growable typed buffers.
+########################################################################################################################
+class Int64Buffer:
+    """
+    An append-only buffer of 64-bit integers, e.g. for the row or column coordinates of a sparse matrix in COO format.
+
+    Values are appended to a typed array("q") block, i.e. 8 bytes per value instead of a boxed python int and a list
+    slot. Full blocks are frozen into numpy arrays or, if a spill folder is given, appended to a temporary file, so that
+    the coordinates of graphs larger than the main memory can still be accumulated.
+    """
+    def __init__(self, block_size=2**20, spill_folder=None):
+        """
+        Inputs: - block_size: The number of values in a block.
+                - spill_folder: A folder where full blocks are written. Default: None, i.e. keep everything in memory.
+        """
+        self.block_size = block_size
+        self.spill_folder = spill_folder
+
+        self.blocks = list()
+        self.current_block = array("q")
+        self.number_of_frozen_values = 0
+
+        self.spill_file = None
+        self.spill_file_path = None
+        if spill_folder is not None:
+            file_descriptor, self.spill_file_path = tempfile.mkstemp(dir=spill_folder, suffix=".int64")
+            self.spill_file = os.fdopen(file_descriptor, "wb")
+
+    def __len__(self):
+        return self.number_of_frozen_values + len(self.current_block)
+
+    def append(self, value):
+        self.current_block.append(value)
+        if len(self.current_block) >= self.block_size:
+            self.freeze_block()
+
+    def extend(self, values):
+        """
+        Appends an iterable of integers; numpy arrays are copied in one go.
+        """
+        if isinstance(values, np.ndarray):
+            self.current_block.frombytes(values.astype(np.int64, copy=False).tobytes())
+        else:
+            self.current_block.extend(values)
+        if len(self.current_block) >= self.block_size:
+            self.freeze_block()
+
+    def extend_repeat(self, value, number_of_repetitions):
+        """
+        Appends the same integer a number of times, without forming a temporary python list.
+        """
+        if number_of_repetitions > 0:
+            self.current_block.extend(array("q", (value,))*number_of_repetitions)
+            if len(self.current_block) >= self.block_size:
+                self.freeze_block()
+
+    def freeze_block(self):
+        if len(self.current_block) == 0:
+            return
+
+        self.number_of_frozen_values += len(self.current_block)
+        if self.spill_file is not None:
+            self.current_block.tofile(self.spill_file)
+        else:
+            self.blocks.append(np.frombuffer(self.current_block, dtype=np.int64))
+        self.current_block = array("q")
+
+    def to_array(self):
+        """
+        Returns all values as a numpy int64 array; it is memory-mapped from the spill file, if there is one.
+        """
+        if self.spill_file is None:
+            if len(self.current_block) > 0:
+                self.blocks.append(np.frombuffer(self.current_block, dtype=np.int64))
+                self.number_of_frozen_values += len(self.current_block)
+                self.current_block = array("q")
+            if len(self.blocks) == 0:
+                return np.empty(0, dtype=np.int64)
+            elif len(self.blocks) > 1:
+                self.blocks = [np.concatenate(self.blocks)]
+            return self.blocks[0]
+        else:
+            self.freeze_block()
+            self.spill_file.flush()
+            if self.number_of_frozen_values == 0:
+                return np.empty(0, dtype=np.int64)
+            return np.memmap(self.spill_file_path, dtype=np.int64, mode="r", shape=(self.number_of_frozen_values,))
+
+    def close(self):
+        """
+        Releases the buffered values and removes the spill file.
+        """
+        self.blocks = list()
+        self.current_block = array("q")
+        self.number_of_frozen_values = 0
+        if self.spill_file is not None:
+            self.spill_file.close()
+            os.remove(self.spill_file_path)
+            self.spill_file = None
+            self.spill_file_path = None
+
+
+def form_count_matrix(row_buffer, col_buffer, shape):
+    """
+    Forms a sparse matrix whose entries count the occurrences of each (row, column) pair in two coordinate buffers.
+
+    Inputs:  - row_buffer: An Int64Buffer of row indices.
+             - col_buffer: An Int64Buffer of column indices, of the same length.
+             - shape: The shape of the matrix.
+
+    Output:  - count_matrix: The matrix in SciPy sparse COO format, without duplicate entries.
+    """
+    row = row_buffer.to_array()
+    col = col_buffer.to_array()
+    data = np.ones(row.size, dtype=np.float64)
+
+    count_matrix = spsp.coo_matrix((data, (row, col)), shape=shape)
+    count_matrix = spsp.coo_matrix(spsp.csr_matrix(count_matrix))
+
+    return count_matrix
+
+
+def extend_count_matrix(count_matrix, row_buffer, col_buffer, shape):
+    """
+    Adds the occurrences of the (row, column) pairs in two coordinate buffers to a count matrix of a smaller shape.
+
+    Inputs:  - count_matrix: A count matrix in SciPy sparse CSR format.
+             - row_buffer: An Int64Buffer of row indices.
+             - col_buffer: An Int64Buffer of column indices, of the same length.
+             - shape: The new shape of the matrix; at least as large as the old one in both dimensions.
+
+    Output:  - count_matrix: The extended count matrix in SciPy sparse CSR format.
+    """
+    new_count_matrix = form_count_matrix(row_buffer, col_buffer, shape).tocsr()
+    if count_matrix.nnz == 0:
+        return new_count_matrix
+
+    # Pad the old matrix with empty rows and columns.
+    indptr = np.empty(shape[0] + 1, dtype=count_matrix.indptr.dtype)
+    indptr[:count_matrix.shape[0] + 1] = count_matrix.indptr
+    indptr[count_matrix.shape[0] + 1:] = count_matrix.indptr[-1]
+    count_matrix = spsp.csr_matrix((count_matrix.data, count_matrix.indices, indptr), shape=shape)
+
+    return count_matrix + new_count_matrix
+
+
+########################################################################################################################
+# Compact maps keyed by Twitter ids.
+########################################################################################################################
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+class IdInterner(Mapping):
+    """
+    A compact map from 64-bit integer ids (e.g. Twitter user ids) to 64-bit integer values (e.g. graph nodes).
+
+    The keys and values are stored in insertion order in numpy arrays, and an open-addressing hash table with linear
+    probing maps the keys to their position; about 40 bytes per entry instead of a python dictionary entry plus two
+    boxed integers. It supports the read-only python dictionary interface, setdefault and item assignment, but not
+    deletion.
+
+    Interning ids to consecutive integers is done with: node = id_to_node.setdefault(user_id, len(id_to_node))
+    """
+    def __init__(self, capacity=1024):
+        """
+        Input:  - capacity: The initial number of entries for which space is reserved.
+        """
+        self.size = 0
+        self.keys_array = np.empty(max(1, capacity), dtype=np.int64)
+        self.values_array = np.empty(max(1, capacity), dtype=np.int64)
+
+        number_of_bits = max(1, int(2*max(1, capacity) - 1).bit_length())
+        self.shift = 64 - number_of_bits
+        self.mask = (1 << number_of_bits) - 1
+        self.table = np.empty(1 << number_of_bits, dtype=np.int64)
+        self.table.fill(-1)
+
+        self.make_views()
+
+    def make_views(self):
+        # Memory views are much faster than numpy arrays for the scalar accesses of the probing loop.
+        self.keys_view = memoryview(self.keys_array)
+        self.values_view = memoryview(self.values_array)
+        self.table_view = memoryview(self.table)
+
+    def __getstate__(self):
+        return {"keys_array": self.keys_array[:self.size].copy(),
+                "values_array": self.values_array[:self.size].copy()}
+
+    def __setstate__(self, state):
+        self.size = state["keys_array"].size
+        self.keys_array = np.resize(state["keys_array"], max(1024, self.size))
+        self.values_array = np.resize(state["values_array"], max(1024, self.size))
+        self.rebuild_table(max(1024, self.size))
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for index in range(self.size):
+            yield self.keys_view[index]
+
+    def __contains__(self, key):
+        return self.find(key)[1] != -1
+
+    def __getitem__(self, key):
+        index = self.find(key)[1]
+        if index == -1:
+            raise KeyError(key)
+        return self.values_view[index]
+
+    def __setitem__(self, key, value):
+        slot, index = self.find(key)
+        if index == -1:
+            self.insert(slot, key, value)
+        else:
+            self.values_view[index] = value
+
+    def get(self, key, default=None):
+        index = self.find(key)[1]
+        if index == -1:
+            return default
+        return self.values_view[index]
+
+    def setdefault(self, key, default=None):
+        """
+        Returns the value of a key; if the key is missing, it is first inserted with the default value.
+        """
+        slot, index = self.find(key)
+        if index == -1:
+            self.insert(slot, key, default)
+            return default
+        return self.values_view[index]
+
+    def intern(self, key):
+        """
+        Returns the insertion position of a key; if the key is missing, it is inserted with its position as value.
+        """
+        slot, index = self.find(key)
+        if index == -1:
+            index = self.size
+            self.insert(slot, key, index)
+        return index
+
+    def find(self, key):
+        """
+        Output: - slot: The table slot that holds the key, or the empty slot where it would be inserted.
+                - index: The insertion position of the key, or -1 if it is missing.
+
+        Keys that are not integers are never stored, so, as in a dictionary of integer ids, they are simply missing.
+        """
+        table_view = self.table_view
+        keys_view = self.keys_view
+        mask = self.mask
+
+        try:
+            key = operator.index(key)
+        except TypeError:
+            return -1, -1
+        slot = (((key & UINT64_MASK)*HASH_MULTIPLIER) & UINT64_MASK) >> self.shift
+        while True:
+            index = table_view[slot]
+            if index == -1:
+                return slot, -1
+            if keys_view[index] == key:
+                return slot, index
+            slot = (slot + 1) & mask
+
+    def insert(self, slot, key, value):
+        # Raises a TypeError for the keys that are not integers.
+        key = operator.index(key)
+        index = self.size
+        if index == self.keys_array.size:
+            self.keys_array = np.resize(self.keys_array, 2*index)
+            self.values_array = np.resize(self.values_array, 2*index)
+            self.make_views()
+        self.keys_view[index] = key
+        self.values_view[index] = value
+        self.table_view[slot] = index
+        self.size += 1
+
+        # Keep the load factor of the table under one half.
+        if 2*self.size > self.table.size:
+            self.rebuild_table(2*self.size)
+
+    def rebuild_table(self, capacity):
+        number_of_bits = max(1, int(2*capacity - 1).bit_length())
+        self.shift = 64 - number_of_bits
+        self.mask = (1 << number_of_bits) - 1
+        self.table = np.empty(1 << number_of_bits, dtype=np.int64)
+        self.table.fill(-1)
+
+        # Insert all keys at once; in every round, each still unplaced key claims the next slot of its probe sequence.
+        pending_indices = np.arange(self.size, dtype=np.int64)
+        pending_slots = self.get_slots(self.keys_array[:self.size])
+        while pending_indices.size > 0:
+            is_free = self.table[pending_slots] == -1
+            free_slots, first_claims = np.unique(pending_slots[is_free], return_index=True)
+            self.table[free_slots] = pending_indices[is_free][first_claims]
+
+            is_placed = np.zeros(pending_indices.size, dtype=np.bool_)
+            is_placed[np.flatnonzero(is_free)[first_claims]] = True
+            pending_indices = pending_indices[~is_placed]
+            pending_slots = (pending_slots[~is_placed] + 1) & self.mask
+
+        self.make_views()
+
+    def get_slots(self, keys):
+        with np.errstate(over="ignore"):
+            hashes = keys.astype(np.uint64)*np.uint64(HASH_MULTIPLIER)
+        return (hashes >> np.uint64(self.shift)).astype(np.int64)
+
+    def get_keys_array(self):
+        """
+        Returns the keys in insertion order, as a numpy int64 array.
+        """
+        return self.keys_array[:self.size]
+
+    def get_values_array(self):
+        """
+        Returns the values in insertion order, as a numpy int64 array.
+        """
+        return self.values_array[:self.size]
+
+    def get_node_to_id(self):
+        """
+        Inverts an interning map whose values are 0, ..., len - 1 in some order.
+
+        Output: - node_to_id: A numpy int64 array, such that node_to_id[node] is the id that is mapped to node.
+        """
+        node_to_id = np.empty(self.size, dtype=np.int64)
+        node_to_id[self.values_array[:self.size]] = self.keys_array[:self.size]
+        return node_to_id
+
+
+class IdToStringMap(Mapping):
+    """
+    A compact map from 64-bit integer ids to strings (e.g. Twitter user names).
+
+    The strings are UTF-8 encoded in a single growable byte arena, and each id keeps the offset and length of its
+    string. Assigning the same string again to an id stores nothing new. None values are also supported.
+    """
+    def __init__(self, capacity=1024):
+        self.id_to_index = IdInterner(capacity)
+        self.arena = bytearray()
+        self.offsets = array("q")
+        self.lengths = array("q")
+
+    def __len__(self):
+        return len(self.id_to_index)
+
+    def __iter__(self):
+        return iter(self.id_to_index)
+
+    def __contains__(self, key):
+        return key in self.id_to_index
+
+    def __getitem__(self, key):
+        index = self.id_to_index.get(key)
+        if index is None:
+            raise KeyError(key)
+        length = self.lengths[index]
+        if length == -1:
+            return None
+        offset = self.offsets[index]
+        return self.arena[offset:offset + length].decode("utf-8")
+
+    def __setitem__(self, key, value):
+        if value is None:
+            index = self.id_to_index.intern(key)
+            if index == len(self.offsets):
+                self.offsets.append(len(self.arena))
+                self.lengths.append(-1)
+            else:
+                self.lengths[index] = -1
+            return
+        encoded_value = value.encode("utf-8")
+
+        index = self.id_to_index.intern(key)
+        if index == len(self.offsets):
+            self.offsets.append(len(self.arena))
+            self.lengths.append(len(encoded_value))
+            self.arena.extend(encoded_value)
+        else:
+            offset = self.offsets[index]
+            length = self.lengths[index]
+            if (length != len(encoded_value)) or (self.arena[offset:offset + length] != encoded_value):
+                self.offsets[index] = len(self.arena)
+                self.lengths[index] = len(encoded_value)
+                self.arena.extend(encoded_value)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+########################################################################################################################
+# Sparse count matrices over a sliding time window.
+########################################################################################################################
+class TimedCountMatrix:
+    """
+    A sparse count matrix of (row, column) events that expire after a while, e.g. the edges of a rolling-window graph.
+
+    The counts are kept in a CSR matrix whose structure only changes at compactions. Adding or expiring events changes
+    the values of the existing entries in place, while new entries are kept in a small overflow dictionary. The overflow
+    is merged into the CSR matrix once it grows past a fraction of the number of entries. Thus, an update costs
+    amortized time proportional to the number of events that arrive or expire, not to the size of the matrix.
+
+    Rows and columns must be smaller than 2**31.
+    """
+    def __init__(self, compaction_ratio=0.125):
+        """
+        Input:  - compaction_ratio: The overflow is merged when it exceeds this fraction of the number of CSR entries.
+        """
+        self.compaction_ratio = compaction_ratio
+
+        self.matrix = spsp.csr_matrix((0, 0), dtype=np.float64)
+        self.matrix_keys = np.empty(0, dtype=np.int64)
+        self.overflow = dict()
+
+        self.event_chunks = collections.deque()
+        self.number_of_events = 0
+
+    def add_events(self, times, rows, cols):
+        """
+        Inputs: - times: A numpy int64 array of event timestamps, in increasing order and after any earlier event.
+                - rows: A numpy int64 array of row indices.
+                - cols: A numpy int64 array of column indices.
+        """
+        if times.size == 0:
+            return
+        keys = np.left_shift(rows, 32) | cols
+        self.event_chunks.append((times, keys))
+        self.number_of_events += times.size
+        self.apply_deltas(keys, 1.0)
+
+    def add_counts(self, rows, cols, delta):
+        """
+        Adds to the counts of some entries without recording events, i.e. these counts never expire by themselves.
+
+        Inputs: - rows: A numpy int64 array of row indices.
+                - cols: A numpy int64 array of column indices.
+                - delta: The value added to the count of every (row, column) pair; it may be negative.
+        """
+        if rows.size == 0:
+            return
+        self.apply_deltas(np.left_shift(rows, 32) | cols, delta)
+
+    def expire(self, cutoff_time):
+        """
+        Removes the counts of all events that happened before a cutoff time.
+
+        Output: - number_of_expired_events: The number of events that were removed.
+        """
+        expired_keys_list = list()
+        while len(self.event_chunks) > 0:
+            times, keys = self.event_chunks[0]
+            number_of_expired = np.searchsorted(times, cutoff_time, side="left")
+            if number_of_expired == 0:
+                break
+            expired_keys_list.append(keys[:number_of_expired])
+            if number_of_expired == times.size:
+                self.event_chunks.popleft()
+            else:
+                self.event_chunks[0] = (times[number_of_expired:], keys[number_of_expired:])
+                break
+
+        if len(expired_keys_list) == 0:
+            return 0
+        expired_keys = np.concatenate(expired_keys_list)
+        self.number_of_events -= expired_keys.size
+        self.apply_deltas(expired_keys, -1.0)
+        return expired_keys.size
+
+    def apply_deltas(self, keys, delta):
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        deltas = delta*np.bincount(inverse.ravel(), minlength=unique_keys.size)
+
+        # Update the existing entries of the matrix in place.
+        positions = np.searchsorted(self.matrix_keys, unique_keys)
+        positions[positions == self.matrix_keys.size] = 0
+        if self.matrix_keys.size > 0:
+            is_found = self.matrix_keys[positions] == unique_keys
+        else:
+            is_found = np.zeros(unique_keys.size, dtype=np.bool_)
+        self.matrix.data[positions[is_found]] += deltas[is_found]
+
+        # The rest go to the overflow.
+        overflow = self.overflow
+        for key, key_delta in zip(unique_keys[~is_found].tolist(), deltas[~is_found].tolist()):
+            count = overflow.get(key, 0.0) + key_delta
+            if count == 0.0:
+                del overflow[key]
+            else:
+                overflow[key] = count
+
+        if len(overflow) > max(1024, self.compaction_ratio*self.matrix.nnz):
+            self.compact(self.matrix.shape)
+
+    def compact(self, shape):
+        """
+        Merges the overflow into the CSR matrix and removes the entries whose counts dropped to zero.
+
+        Input:  - shape: The shape of the compacted matrix; at least as large as the rows and columns of the events.
+        """
+        shape = (max(shape[0], self.matrix.shape[0]), max(shape[1], self.matrix.shape[1]))
+        if len(self.overflow) > 0:
+            overflow_keys = np.fromiter(self.overflow.keys(), dtype=np.int64, count=len(self.overflow))
+            overflow_counts = np.fromiter(self.overflow.values(), dtype=np.float64, count=len(self.overflow))
+            shape = (max(shape[0], int(np.right_shift(overflow_keys, 32).max()) + 1),
+                     max(shape[1], int((overflow_keys & 0xFFFFFFFF).max()) + 1))
+        else:
+            overflow_keys = np.empty(0, dtype=np.int64)
+            overflow_counts = np.empty(0, dtype=np.float64)
+
+        keys = np.concatenate([self.matrix_keys, overflow_keys])
+        counts = np.concatenate([self.matrix.data, overflow_counts])
+        is_nonzero = counts != 0.0
+        keys = keys[is_nonzero]
+        counts = counts[is_nonzero]
+
+        matrix = spsp.coo_matrix((counts, (np.right_shift(keys, 32), keys & 0xFFFFFFFF)), shape=shape)
+        self.matrix = spsp.csr_matrix(matrix)
+        self.matrix.sort_indices()
+        self.matrix_keys = np.left_shift(np.repeat(np.arange(shape[0], dtype=np.int64), np.diff(self.matrix.indptr)), 32) |\
+            self.matrix.indices.astype(np.int64)
+        self.overflow = dict()
+
+    def get_matrix(self, shape):
+        """
+        Returns the current counts.
+
+        Input:  - shape: The shape of the matrix; at least as large as the rows and columns of the events.
+
+        Output: - matrix: A copy of the count matrix in SciPy sparse CSR format, without explicit zeros.
+        """
+        self.compact(shape)
+        return self.matrix.copy()
@@ -14,6 +14,17 @@ def get_package_path():
     return os.path.dirname(inspect.getfile(reveal_user_annotation))
 
 
+def get_cache_path():
+    """
+    Returns the folder where expensive-to-compute resources (e.g. trained taggers) are cached between runs.
+
+    The REVEAL_USER_ANNOTATION_CACHE environment variable overrides the default "~/.cache/reveal_user_annotation".
+    """
+    cache_path = os.environ.get("REVEAL_USER_ANNOTATION_CACHE",
+                                os.path.join(os.path.expanduser("~"), ".cache", "reveal_user_annotation"))
+    return cache_path
+
+
 ########################################################################################################################
 # Configure optimization related functions.
 ########################################################################################################################
@@ -1,5 +1,12 @@
 __author__ = 'Georgios Rizos (georgerizos@iti.gr)'
 
+import os
+import tempfile
+import time
+import json
+import gzip
+import mmap
+
 try:
     import cPickle as pickle
 except ImportError:
@@ -34,6 +41,28 @@ def store_pickle(file_path, data):
     pkl_file.close()
 
 
+def store_pickle_atomically(file_path, data):
+    """
+    Pickle some data to a given path, so that concurrent readers never see a partially written file.
+
+    The data is first written to a temporary file in the same folder, which then replaces the target path.
+
+    Inputs: - file_path: Target file path.
+            - data: The python object to be serialized via pickle.
+    """
+    folder_path = os.path.dirname(os.path.abspath(file_path))
+    os.makedirs(folder_path, exist_ok=True)
+
+    file_descriptor, temporary_file_path = tempfile.mkstemp(dir=folder_path, suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "wb") as pkl_file:
+            pickle.dump(data, pkl_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_file_path, file_path)
+    except BaseException:
+        os.remove(temporary_file_path)
+        raise
+
+
 def load_pickle(file_path):
     """
     Unpickle some data from a given path.
@@ -46,3 +75,414 @@ def load_pickle(file_path):
     data = pickle.load(pkl_file)
     pkl_file.close()
     return data
+
+
+########################################################################################################################
+# Sharded JSON lines storage of per-user records.
+########################################################################################################################
+class ShardedJsonlWriter:
+    """
+    Writes (user_twitter_id, user_annotation) records in a few large, optionally gzip-compressed, JSON lines shards.
+
+    Every shard "<prefix>-<number>.jsonl[.gz]" has a companion ".index" file, whose tab-separated lines hold the JSON
+    encoded user id, the byte offset and length of the record (or of the gzip member that contains it when compressed)
+    and the line number of the record within that range. Compressed shards consist of one gzip member per block of
+    records, so that any record can be read by decompressing a single block.
+
+    A record only becomes visible to the readers once its index line is flushed. Shard prefixes start with the creation
+    time, so that when a user is written again in a later run, the latest record wins. A user whose output is gone is
+    written as a tombstone, i.e. an index line with an offset of -1 and no data, which hides the earlier records.
+    """
+    def __init__(self, folder, compress=False, max_shard_size=100000, block_size=256, shard_prefix=None):
+        """
+        Inputs: - folder: The folder where the shards are stored.
+                - compress: If True, the shards are gzip-compressed.
+                - max_shard_size: The maximum number of records in a shard.
+                - block_size: The maximum number of records in a gzip member.
+                - shard_prefix: The prefix of the shard file names. Default: "part-<time in us>-<process id>".
+        """
+        if shard_prefix is None:
+            shard_prefix = "part-" + "%020d" % int(time.time()*10**6) + "-" + str(os.getpid())
+
+        self.folder = folder
+        self.compress = compress
+        self.max_shard_size = max_shard_size
+        self.block_size = block_size
+        self.shard_prefix = shard_prefix
+
+        self.shard_number = 0
+        self.shard_file_name = None
+        self.shard_size = 0
+        self.data_file = None
+        self.index_file = None
+
+        self.pending_records = list()
+
+    def open_shard(self):
+        self.shard_file_name = self.shard_prefix + "-" + "%05d" % self.shard_number + ".jsonl"
+        if self.compress:
+            self.shard_file_name += ".gz"
+        self.shard_number += 1
+        self.shard_size = 0
+
+        self.data_file = open(self.folder + "/" + self.shard_file_name, "wb")
+        self.index_file = open(self.folder + "/" + self.shard_file_name + ".index", "w", encoding="utf-8")
+
+    def close_shard(self):
+        self.flush()
+        if self.data_file is not None:
+            self.data_file.close()
+            self.index_file.close()
+            self.data_file = None
+            self.index_file = None
+
+    def write(self, user_twitter_id, user_annotation):
+        """
+        Adds a record to the current shard.
+
+        Inputs: - user_twitter_id: A Twitter user id; any JSON serializable value.
+                - user_annotation: A JSON serializable python dictionary.
+
+        Output: - shard_file_name: The name of the shard file to which the record is written.
+        """
+        if (self.data_file is None) or (self.shard_size >= self.max_shard_size):
+            self.close_shard()
+            self.open_shard()
+
+        line = (json.dumps([user_twitter_id, user_annotation]) + "\n").encode("utf-8")
+        self.pending_records.append((user_twitter_id, line))
+        self.shard_size += 1
+
+        if len(self.pending_records) >= self.block_size:
+            self.write_block()
+
+        return self.shard_file_name
+
+    def write_tombstone(self, user_twitter_id):
+        """
+        Marks a user as removed, so that the readers skip the records of the user in the earlier shards.
+
+        Input:  - user_twitter_id: A Twitter user id; any JSON serializable value.
+
+        Output: - shard_file_name: The name of the shard file in whose index the tombstone is written.
+        """
+        if (self.data_file is None) or (self.shard_size >= self.max_shard_size):
+            self.close_shard()
+            self.open_shard()
+
+        self.pending_records.append((user_twitter_id, None))
+        self.shard_size += 1
+
+        if len(self.pending_records) >= self.block_size:
+            self.write_block()
+
+        return self.shard_file_name
+
+    def write_block(self):
+        if len(self.pending_records) == 0:
+            return
+
+        offset = self.data_file.tell()
+        index_lines = list()
+        append_index_line = index_lines.append
+        if self.compress:
+            line_list = [line for user_twitter_id, line in self.pending_records if line is not None]
+            if len(line_list) > 0:
+                block = gzip.compress(b"".join(line_list))
+                self.data_file.write(block)
+            line_number = 0
+            for user_twitter_id, line in self.pending_records:
+                if line is None:
+                    append_index_line(json.dumps(user_twitter_id) + "\t-1\t0\t0\n")
+                    continue
+                append_index_line(json.dumps(user_twitter_id) + "\t" + str(offset) + "\t" + str(len(block)) + "\t" +
+                                  str(line_number) + "\n")
+                line_number += 1
+        else:
+            for user_twitter_id, line in self.pending_records:
+                if line is None:
+                    append_index_line(json.dumps(user_twitter_id) + "\t-1\t0\t0\n")
+                    continue
+                self.data_file.write(line)
+                append_index_line(json.dumps(user_twitter_id) + "\t" + str(offset) + "\t" + str(len(line)) + "\t0\n")
+                offset += len(line)
+
+        # The data precede their index lines on disk.
+        self.data_file.flush()
+        self.index_file.write("".join(index_lines))
+        self.pending_records = list()
+
+    def flush(self):
+        """
+        Writes out all buffered records, so that they are visible to the readers.
+        """
+        if self.data_file is not None:
+            self.write_block()
+            self.index_file.flush()
+
+    def close(self):
+        self.close_shard()
+
+
+def get_sharded_jsonl_file_names(folder):
+    """
+    Returns the names of the JSON lines shards in a folder, oldest first.
+    """
+    shard_file_name_list = [file_name for file_name in os.listdir(folder)
+                            if file_name.endswith(".jsonl") or file_name.endswith(".jsonl.gz")]
+    shard_file_name_list.sort()
+    return shard_file_name_list
+
+
+def remove_sharded_jsonl_files(folder):
+    """
+    Removes all JSON lines shards and their indices from a folder, so that no records of an earlier run remain visible.
+
+    Input:  - folder: The folder where the shards are stored.
+
+    Output: - number_of_shards: The number of shards that were removed.
+    """
+    shard_file_name_list = get_sharded_jsonl_file_names(folder)
+    for shard_file_name in shard_file_name_list:
+        os.remove(folder + "/" + shard_file_name)
+        index_file_path = folder + "/" + shard_file_name + ".index"
+        if os.path.exists(index_file_path):
+            os.remove(index_file_path)
+
+    return len(shard_file_name_list)
+
+
+def load_sharded_jsonl_index(folder):
+    """
+    Reads the indices of all shards in a folder; a later record of the same user overrides the earlier ones, and a
+    later tombstone removes them.
+
+    Input:  - folder: The folder where the shards are stored.
+
+    Output: - user_twitter_id_to_location: A python dictionary that maps user ids to
+                                           (shard_file_name, offset, length, line_number) tuples.
+    """
+    user_twitter_id_to_location = dict()
+    for shard_file_name in get_sharded_jsonl_file_names(folder):
+        index_file_path = folder + "/" + shard_file_name + ".index"
+        if not os.path.exists(index_file_path):
+            continue
+        with open(index_file_path, "r", encoding="utf-8") as fp:
+            for line in fp:
+                words = line.rstrip("\n").split("\t")
+                # The last line may have been cut short by a crash.
+                if len(words) != 4:
+                    continue
+                try:
+                    user_twitter_id = json.loads(words[0])
+                except ValueError:
+                    continue
+                if int(words[1]) < 0:
+                    user_twitter_id_to_location.pop(user_twitter_id, None)
+                    continue
+                user_twitter_id_to_location[user_twitter_id] = (shard_file_name,
+                                                                int(words[1]),
+                                                                int(words[2]),
+                                                                int(words[3]))
+
+    return user_twitter_id_to_location
+
+
+def read_sharded_jsonl_block(data_file, shard_file_name, offset, length):
+    data_file.seek(offset)
+    block = data_file.read(length)
+    if shard_file_name.endswith(".gz"):
+        block = gzip.decompress(block)
+    return block.splitlines()
+
+
+def load_sharded_jsonl_record(folder, location):
+    """
+    Reads a single record.
+
+    Inputs: - folder: The folder where the shards are stored.
+            - location: A (shard_file_name, offset, length, line_number) tuple, as found in the index.
+
+    Outputs: - user_twitter_id: A Twitter user id.
+             - user_annotation: A python dictionary.
+    """
+    shard_file_name, offset, length, line_number = location
+    with open(folder + "/" + shard_file_name, "rb") as data_file:
+        line = read_sharded_jsonl_block(data_file, shard_file_name, offset, length)[line_number]
+    user_twitter_id, user_annotation = json.loads(line.decode("utf-8"))
+    return user_twitter_id, user_annotation
+
+
+def read_sharded_jsonl_generator(folder, id_type=None):
+    """
+    Streams the latest record of every user, reading each shard sequentially.
+
+    Inputs: - folder: The folder where the shards are stored.
+            - id_type: An optional callable applied to the user ids (e.g. int, if the ids were stored as strings).
+
+    Yields: - user_twitter_id: A Twitter user id.
+            - user_annotation: A python dictionary.
+    """
+    shard_file_name_to_locations = dict()
+    for location in load_sharded_jsonl_index(folder).values():
+        shard_file_name_to_locations.setdefault(location[0], list()).append(location)
+
+    for shard_file_name in sorted(shard_file_name_to_locations.keys()):
+        location_list = shard_file_name_to_locations[shard_file_name]
+        location_list.sort(key=lambda x: (x[1], x[3]))
+
+        with open(folder + "/" + shard_file_name, "rb") as data_file:
+            block_offset = None
+            block_lines = None
+            for shard_file_name, offset, length, line_number in location_list:
+                if offset != block_offset:
+                    block_lines = read_sharded_jsonl_block(data_file, shard_file_name, offset, length)
+                    block_offset = offset
+                user_twitter_id, user_annotation = json.loads(block_lines[line_number].decode("utf-8"))
+                if id_type is not None:
+                    user_twitter_id = id_type(user_twitter_id)
+                yield user_twitter_id, user_annotation
+
+
+########################################################################################################################
+# Packed storage of many small pickles.
+########################################################################################################################
+def convert_pickle_folder_to_packs(source_folder, target_folder, max_pack_size=2**30, file_name_list=None):
+    """
+    Packs a folder of small pickle files into a few large pack files, without unpickling them.
+
+    Every pack "pack-<number>.pack" is the concatenation of the original pickles and has a companion ".index" file,
+    whose tab-separated lines hold the JSON encoded original file name, and the byte offset and length of its pickle.
+
+    Inputs: - source_folder: The folder with the pickle files.
+            - target_folder: The folder where the packs are stored.
+            - max_pack_size: The maximum size of a pack in bytes; a larger pickle is stored in a pack of its own.
+            - file_name_list: The names of the files to be packed. Default: None, i.e. all files in the source folder.
+
+    Output: - pack_file_name_list: A python list of the names of the pack files.
+    """
+    if file_name_list is None:
+        file_name_list = sorted(os.listdir(source_folder))
+
+    pack_file_name_list = list()
+    data_file = None
+    index_file = None
+    pack_size = 0
+    for file_name in file_name_list:
+        file_path = source_folder + "/" + file_name
+        if not os.path.isfile(file_path):
+            continue
+        with open(file_path, "rb") as fp:
+            data = fp.read()
+
+        if (data_file is None) or ((pack_size > 0) and (pack_size + len(data) > max_pack_size)):
+            if data_file is not None:
+                data_file.close()
+                index_file.close()
+            pack_file_name = "pack-" + "%05d" % len(pack_file_name_list) + ".pack"
+            pack_file_name_list.append(pack_file_name)
+            data_file = open(target_folder + "/" + pack_file_name, "wb")
+            index_file = open(target_folder + "/" + pack_file_name + ".index", "w", encoding="utf-8")
+            pack_size = 0
+
+        data_file.write(data)
+        index_file.write(json.dumps(file_name) + "\t" + str(pack_size) + "\t" + str(len(data)) + "\n")
+        pack_size += len(data)
+
+    if data_file is not None:
+        data_file.close()
+        index_file.close()
+
+    return pack_file_name_list
+
+
+def get_pickle_pack_file_names(folder):
+    """
+    Returns the names of the pickle packs in a folder.
+    """
+    pack_file_name_list = [file_name for file_name in os.listdir(folder) if file_name.endswith(".pack")]
+    pack_file_name_list.sort()
+    return pack_file_name_list
+
+
+def load_pickle_pack_index(pack_file_path):
+    """
+    Reads the index of a pickle pack.
+
+    Input:  - pack_file_path: The path of the pack file.
+
+    Output: - index: A python list of (file_name, offset, length) tuples, in the order they are stored in the pack.
+    """
+    index = list()
+    append_index_entry = index.append
+    with open(pack_file_path + ".index", "r", encoding="utf-8") as fp:
+        for line in fp:
+            words = line.rstrip("\n").split("\t")
+            append_index_entry((json.loads(words[0]), int(words[1]), int(words[2])))
+    return index
+
+
+def get_pickle_pack_splits(folder, number_of_splits):
+    """
+    Partitions the contents of all pickle packs in a folder in ranges of roughly equal size in bytes.
+
+    A range never spans two packs, so that each one can be read sequentially by a different process.
+
+    Inputs: - folder: The folder where the packs are stored.
+            - number_of_splits: The targeted number of ranges.
+
+    Output: - split_list: A python list of (pack_file_name, index, number_of_bytes) tuples, where index is the python
+                          list of the (file_name, offset, length) index entries of the range, so that the readers need
+                          not load the index of the pack again.
+    """
+    pack_file_name_to_index = dict()
+    total_size = 0
+    for pack_file_name in get_pickle_pack_file_names(folder):
+        index = load_pickle_pack_index(folder + "/" + pack_file_name)
+        pack_file_name_to_index[pack_file_name] = index
+        total_size += sum(length for file_name, offset, length in index)
+    target_split_size = max(1, total_size//max(1, number_of_splits))
+
+    split_list = list()
+    for pack_file_name, index in sorted(pack_file_name_to_index.items()):
+        start = 0
+        split_size = 0
+        for position, (file_name, offset, length) in enumerate(index):
+            split_size += length
+            if split_size >= target_split_size:
+                split_list.append((pack_file_name, index[start:position + 1], split_size))
+                start = position + 1
+                split_size = 0
+        if start < len(index):
+            split_list.append((pack_file_name, index[start:], split_size))
+
+    return split_list
+
+
+def read_pickle_pack_generator(pack_file_path, start=0, stop=None, index=None):
+    """
+    Reads a range of the pickles of a pack sequentially, through a memory map.
+
+    Inputs: - pack_file_path: The path of the pack file.
+            - start: The position in the index of the first pickle to be read.
+            - stop: The position in the index after the last pickle to be read. Default: None, i.e. up to the end.
+            - index: The index of the pack, if already loaded.
+
+    Yields: - file_name: The name of the original pickle file.
+            - data: The unpickled python object.
+    """
+    if index is None:
+        index = load_pickle_pack_index(pack_file_path)
+    index = index[start:stop]
+    if len(index) == 0:
+        return
+
+    with open(pack_file_path, "rb") as fp:
+        memory_map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if hasattr(memory_map, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                memory_map.madvise(mmap.MADV_SEQUENTIAL)
+            for file_name, offset, length in index:
+                yield file_name, pickle.loads(memory_map[offset:offset + length])
+        finally:
+            memory_map.close()
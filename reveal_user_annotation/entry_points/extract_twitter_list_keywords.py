@@ -2,53 +2,350 @@ __author__ = 'Georgios Rizos (georgerizos@iti.gr)'
 
 import argparse
 import os
+import time
+import hashlib
+import tempfile
 from multiprocessing import Pool
+from multiprocessing.util import Finalize
 from functools import partial
 import json
 
 from reveal_user_annotation.common.config_package import get_threads_number
-from reveal_user_annotation.common.datarw import load_pickle
-from reveal_user_annotation.text.map_data import chunks
-from reveal_user_annotation.twitter.clean_twitter_list import user_twitter_list_bag_of_words
+from reveal_user_annotation.common.datarw import load_pickle, ShardedJsonlWriter, get_pickle_pack_splits,\
+    read_pickle_pack_generator, remove_sharded_jsonl_files
+from reveal_user_annotation.twitter.clean_twitter_list import user_twitter_list_bag_of_words,\
+    update_twitter_list_keyword_index, MAX_TWITTER_LIST_INDEX_SIZE
+from reveal_user_annotation.text.document_cache import CleanDocumentCache
 from reveal_user_annotation.text.clean_text import get_lemmatizer, get_stopset, get_camel_case_regexes,\
-    get_digits_punctuation_whitespace_regex, get_pos_set, get_braupt_tagger, get_tokenizer
+    get_digits_punctuation_whitespace_regex, get_pos_set, get_braupt_tagger, get_tokenizer,\
+    get_clean_document_namespace
 
 
-def worker_function(file_name_list,
-                    source_folder,
-                    target_folder):
-    source_path_list = (source_folder + "/" + file_name for file_name in file_name_list)
-    target_path_list = (target_folder + "/" + file_name[:-4] + ".json" for file_name in file_name_list)
+########################################################################################################################
+# Per-process state; built once by the pool initializer and reused for every batch the process is handed.
+########################################################################################################################
+nlp_resources = None
+document_cache = None
+twitter_list_index = None
+output_writer = None
+lemmatizer_vocabulary_file_path = None
+
+
+def initialize_worker(cache_file_path=None, target_folder=None, output_format="json", shard_size=100000,
+                      vocabulary_file_path=None):
+    """
+    Builds the text cleaning resources, the document cache and the Twitter list index of a pool process.
+
+    Inputs: - cache_file_path: The path of the SQLite file of the document cache. Default: None, i.e. in-memory only.
+            - target_folder: The folder where the extracted keywords are stored.
+            - output_format: "json" for one file per user, or "jsonl"/"jsonl.gz" for shards written by this process.
+            - shard_size: The maximum number of users per shard.
+            - vocabulary_file_path: A file with which the memoized lemmatizer is pre-warmed, if it exists, and where
+                                    its vocabulary is stored when the process shuts down. Default: None, i.e. neither.
+    """
+    global nlp_resources
+    global document_cache
+    global twitter_list_index
+    global output_writer
+    global lemmatizer_vocabulary_file_path
+
+    lemmatizer_vocabulary_file_path = vocabulary_file_path
+    if (vocabulary_file_path is not None) and (not os.path.exists(vocabulary_file_path)):
+        vocabulary_file_path = None
 
     sent_tokenize, _treebank_word_tokenize = get_tokenizer()
     tagger = get_braupt_tagger()
-    lemmatizer, lemmatize = get_lemmatizer("wordnet")
+    lemmatizer, lemmatize = get_lemmatizer("wordnet", cache_size=2**16, vocabulary_file_path=vocabulary_file_path)
     stopset = get_stopset()
     first_cap_re, all_cap_re = get_camel_case_regexes()
     digits_punctuation_whitespace_re = get_digits_punctuation_whitespace_regex()
     pos_set = get_pos_set()
 
-    # Get the lists of a user
-    for source_path in source_path_list:
-        twitter_lists_corpus = load_pickle(source_path)
+    nlp_resources = (sent_tokenize, _treebank_word_tokenize,
+                     tagger, lemmatizer, lemmatize, stopset,
+                     first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
+                     pos_set)
+    # Cached results are only reused for the same tagger, lemmatizer, stopwords and NLTK version.
+    namespace = get_clean_document_namespace("wordnet", stopset=stopset, pos_set=pos_set)
+    document_cache = CleanDocumentCache(file_path=cache_file_path, namespace=namespace)
+    twitter_list_index = dict()
+
+    if output_format == "json":
+        output_writer = None
+    elif output_format in ("jsonl", "jsonl.gz"):
+        output_writer = ShardedJsonlWriter(target_folder,
+                                           compress=(output_format == "jsonl.gz"),
+                                           max_shard_size=shard_size)
+    else:
+        print("Invalid output format.")
+        raise RuntimeError
+
+    # Flush the document cache, the output shards and the lemmatizer vocabulary when the pool shuts the process down.
+    Finalize(document_cache, finalize_worker, exitpriority=10)
+
+
+def finalize_worker():
+    if output_writer is not None:
+        output_writer.close()
+    document_cache.close()
+    print("Process", os.getpid(), "document cache statistics:", document_cache.cache_info())
+
+    lemmatize = nlp_resources[4]
+    print("Process", os.getpid(), "lemmatizer cache statistics:", lemmatize.cache_info())
+    if lemmatizer_vocabulary_file_path is not None:
+        lemmatize.store_vocabulary(lemmatizer_vocabulary_file_path)
+
+
+########################################################################################################################
+# Manifest of completed outputs, used by the incremental mode.
+########################################################################################################################
+MANIFEST_FILE_NAME = ".manifest.jsonl"
+
+
+def get_file_signature(file_path, checksum=False):
+    """
+    Describes the current state of a source file.
+
+    Inputs: - file_path: The path of the source file.
+            - checksum: If True, the SHA-1 hash of the contents is also calculated.
+
+    Output: - signature: A python dictionary with the "size", the "mtime_ns" and optionally the "sha1" of the file.
+    """
+    file_stat = os.stat(file_path)
+    signature = dict()
+    signature["size"] = file_stat.st_size
+    signature["mtime_ns"] = file_stat.st_mtime_ns
+    if checksum:
+        signature["sha1"] = get_file_sha1(file_path)
+    return signature
+
+
+def get_file_sha1(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as fp:
+        for block in iter(lambda: fp.read(2**20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def load_manifest(manifest_path):
+    """
+    Reads the manifest of completed outputs; later entries for the same file override earlier ones.
+
+    Input:  - manifest_path: The path of the JSON lines manifest file.
+
+    Output: - file_name_to_entry: A python dictionary that maps source file names to their latest manifest entry.
+    """
+    file_name_to_entry = dict()
+    if not os.path.exists(manifest_path):
+        return file_name_to_entry
+
+    with open(manifest_path, "r", encoding="utf-8") as fp:
+        for line in fp:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line may have been cut short by a crash.
+                continue
+            file_name_to_entry[entry["file_name"]] = entry
+
+    return file_name_to_entry
+
+
+def store_manifest(manifest_path, file_name_to_entry):
+    """
+    Atomically rewrites the manifest with one entry per source file.
+    """
+    file_descriptor, temporary_file_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(manifest_path)),
+                                                            suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "w", encoding="utf-8") as fp:
+            for entry in file_name_to_entry.values():
+                fp.write(json.dumps(entry) + "\n")
+        os.replace(temporary_file_path, manifest_path)
+    except BaseException:
+        os.remove(temporary_file_path)
+        raise
+
+
+def is_file_up_to_date(source_folder, target_folder, file_name, entry, checksum=False):
+    """
+    Checks whether the output recorded in a manifest entry is still valid for the current source file.
+
+    If the size or modification time changed and checksum is True, the contents are compared by hash before giving up.
+
+    Output: - is_up_to_date: A boolean.
+            - entry: The manifest entry, refreshed with the current size and modification time if only those changed.
+    """
+    if entry is None:
+        return False, entry
+    if (entry["target_file_name"] is not None) and\
+            (not os.path.exists(target_folder + "/" + entry["target_file_name"])):
+        return False, entry
+
+    try:
+        signature = get_file_signature(source_folder + "/" + file_name)
+    except OSError:
+        return False, entry
+    if (signature["size"] == entry["size"]) and (signature["mtime_ns"] == entry["mtime_ns"]):
+        return True, entry
+
+    if checksum and ("sha1" in entry.keys()) and (signature["size"] == entry["size"]):
+        if get_file_sha1(source_folder + "/" + file_name) == entry["sha1"]:
+            entry = dict(entry)
+            entry["mtime_ns"] = signature["mtime_ns"]
+            return True, entry
+
+    return False, entry
+
+
+def get_size_aware_batches(source_folder, file_name_list, number_of_workers, batches_per_worker=16,
+                           max_batch_size=1000):
+    """
+    Partitions the files in batches of roughly equal total size in bytes.
+
+    Inputs: - source_folder: The folder with the pickled Twitter lists.
+            - file_name_list: A python list of file names in the source folder.
+            - number_of_workers: The number of pool processes.
+            - batches_per_worker: The targeted number of batches per process, so that the load evens out at the end.
+            - max_batch_size: The maximum number of files in a batch.
+
+    Output: - batch_list: A python list of (file_name_list, number_of_bytes) batches, the largest files first.
+    """
+    file_size_list = list()
+    for file_name in file_name_list:
+        try:
+            file_size_list.append((file_name, os.path.getsize(source_folder + "/" + file_name)))
+        except OSError:
+            continue
+    file_size_list.sort(key=lambda x: x[1], reverse=True)
+
+    total_size = sum(file_size for file_name, file_size in file_size_list)
+    target_batch_size = max(1, total_size//max(1, number_of_workers*batches_per_worker))
+
+    batch_list = list()
+    batch = list()
+    batch_size = 0
+    for file_name, file_size in file_size_list:
+        batch.append(file_name)
+        batch_size += file_size
+        if (batch_size >= target_batch_size) or (len(batch) >= max_batch_size):
+            batch_list.append((batch, batch_size))
+            batch = list()
+            batch_size = 0
+    if len(batch) > 0:
+        batch_list.append((batch, batch_size))
+
+    return batch_list
+
+
+def get_batch_corpus_generator(batch, source_folder, checksum=False, packed=False):
+    """
+    Reads the pickled Twitter lists of a batch of users.
+
+    Inputs: - batch: A python list of file names or, for packed input, a (pack_file_name, index) range, as made by
+                     get_pickle_pack_splits.
+            - source_folder: The folder with the pickled Twitter lists, or with the packs made by pack_twitter_list_corpora.
+            - checksum: If True, the content hashes of the files are also recorded.
+            - packed: If True, the source folder contains packs.
+
+    Yields: - manifest_entry: The manifest entry of the file, without the "target_file_name".
+            - twitter_lists_corpus: The unpickled contents of the file.
+    """
+    if packed:
+        pack_file_name, index = batch
+        pack_file_path = source_folder + "/" + pack_file_name
+        pack_mtime_ns = os.stat(pack_file_path).st_mtime_ns
+        pickle_gen = read_pickle_pack_generator(pack_file_path, index=index)
+        for (file_name, twitter_lists_corpus), (indexed_file_name, offset, length) in zip(pickle_gen, index):
+            manifest_entry = dict()
+            manifest_entry["size"] = length
+            manifest_entry["mtime_ns"] = pack_mtime_ns
+            manifest_entry["file_name"] = file_name
+            yield manifest_entry, twitter_lists_corpus
+    else:
+        for file_name in batch:
+            # The signature is taken before reading, so that a file modified in the meantime is processed again next time.
+            manifest_entry = get_file_signature(source_folder + "/" + file_name, checksum)
+            manifest_entry["file_name"] = file_name
+            yield manifest_entry, load_pickle(source_folder + "/" + file_name)
+
+
+def remove_user_output(target_folder, user_twitter_id, output_writer=None):
+    """
+    Removes the extracted keywords of a user, i.e. deletes the json file of the user or writes a tombstone in the shards.
+    """
+    if output_writer is None:
+        target_file_path = target_folder + "/" + user_twitter_id + ".json"
+        if os.path.exists(target_file_path):
+            os.remove(target_file_path)
+    else:
+        output_writer.write_tombstone(user_twitter_id)
+
+
+def worker_function(batch,
+                    source_folder,
+                    target_folder,
+                    checksum=False,
+                    packed=False):
+    """
+    Extracts and stores the Twitter list keywords of a batch of users, using the resources of the current process.
+
+    Output: - manifest_entry_list: A python list of manifest entries, one per file in the batch.
+            - number_of_bytes: The total size of the files in the batch.
+            - elapsed_time: The processing time of the batch in seconds.
+    """
+    global twitter_list_index
+
+    start_time = time.perf_counter()
+
+    # Get the lists of the users.
+    user_twitter_lists = list()
+    manifest_entry_list = list()
+    number_of_bytes = 0
+    for manifest_entry, twitter_lists_corpus in get_batch_corpus_generator(batch, source_folder, checksum, packed):
+        manifest_entry["target_file_name"] = None
+        manifest_entry_list.append(manifest_entry)
+        number_of_bytes += manifest_entry["size"]
+
         if "lists" in twitter_lists_corpus.keys():
-            twitter_lists_corpus = twitter_lists_corpus["lists"]
+            user_twitter_lists.append((manifest_entry, manifest_entry["file_name"][:-4], twitter_lists_corpus["lists"]))
         else:
-            continue
+            # The output of an earlier version of the file must not outlive it.
+            remove_user_output(target_folder, manifest_entry["file_name"][:-4], output_writer)
 
+    # Past the size limit the index is dropped; the document cache still serves repeated lists.
+    if len(twitter_list_index) > MAX_TWITTER_LIST_INDEX_SIZE:
+        twitter_list_index = dict()
+
+    # A Twitter list is shared by many users; clean each distinct list once per process.
+    for manifest_entry, user_twitter_id, twitter_lists_corpus in user_twitter_lists:
+        update_twitter_list_keyword_index(twitter_list_index, twitter_lists_corpus,
+                                          *nlp_resources, document_cache=document_cache)
+
+    for manifest_entry, user_twitter_id, twitter_lists_corpus in user_twitter_lists:
         bag_of_lemmas, lemma_to_keywordbag = user_twitter_list_bag_of_words(twitter_lists_corpus,
-                                                                            sent_tokenize, _treebank_word_tokenize,
-                                                                            tagger, lemmatizer, lemmatize, stopset,
-                                                                            first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
-                                                                            pos_set)
+                                                                            *nlp_resources,
+                                                                            document_cache=document_cache,
+                                                                            twitter_list_index=twitter_list_index)
 
         user_annotation = dict()
         user_annotation["bag_of_lemmas"] = bag_of_lemmas
         user_annotation["lemma_to_keywordbag"] = lemma_to_keywordbag
 
-        target_path = next(target_path_list)
-        with open(target_path, "w", encoding="utf-8") as fp:
-            json.dump(user_annotation, fp)
+        if output_writer is None:
+            manifest_entry["target_file_name"] = user_twitter_id + ".json"
+            with open(target_folder + "/" + manifest_entry["target_file_name"], "w", encoding="utf-8") as fp:
+                json.dump(user_annotation, fp)
+        else:
+            manifest_entry["target_file_name"] = output_writer.write(user_twitter_id, user_annotation)
+
+    # The outputs must be readable before the batch is recorded in the manifest.
+    if output_writer is not None:
+        output_writer.flush()
+    document_cache.commit()
+
+    return manifest_entry_list, number_of_bytes, time.perf_counter() - start_time
 
 
 def main():
@@ -57,26 +354,144 @@ def main():
     parser.add_argument("-s", "--source", dest="source_folder",
                         help="This is the folder with the pickled Twitter lists.",
                         type=str, required=True)
+    parser.add_argument("-p", "--packed", dest="packed",
+                        help="The source folder contains packs made by pack_twitter_list_corpora instead of one pickle per user.",
+                        action="store_true")
     parser.add_argument("-t", "--target", dest="target_folder",
                         help="This is the folder where the extracted keyword jsons will be stored.",
                         type=str, required=True)
+    parser.add_argument("-c", "--cache", dest="cache_file_path",
+                        help="This is an SQLite file where cleaned Twitter list names and descriptions are cached across runs.",
+                        type=str, required=False, default=None)
+    parser.add_argument("-v", "--vocabulary", dest="vocabulary_file_path",
+                        help="This is a file with which the lemmatizer cache is pre-warmed, and where the most recently used words are stored for the next runs.",
+                        type=str, required=False, default=None)
+    parser.add_argument("-w", "--workers", dest="number_of_workers",
+                        help="This is the number of worker processes. Default: the number of cores.",
+                        type=int, required=False, default=get_threads_number())
+    parser.add_argument("-i", "--incremental", dest="incremental",
+                        help="Only process the source files that are new or changed since they were last recorded in the manifest of the target folder.",
+                        action="store_true")
+    parser.add_argument("--checksum", dest="checksum",
+                        help="Also record content hashes, so that files that were rewritten unchanged are not processed again.",
+                        action="store_true")
+    parser.add_argument("-f", "--format", dest="output_format",
+                        help="This is the output format: one json file per user (json), or JSON lines shards (jsonl) that may also be gzip-compressed (jsonl.gz).",
+                        type=str, required=False, default="json", choices=["json", "jsonl", "jsonl.gz"])
+    parser.add_argument("--shard-size", dest="shard_size",
+                        help="This is the maximum number of users per JSON lines shard.",
+                        type=int, required=False, default=100000)
 
     args = parser.parse_args()
 
     source_folder = args.source_folder
     target_folder = args.target_folder
+    cache_file_path = args.cache_file_path
+    vocabulary_file_path = args.vocabulary_file_path
+    number_of_workers = args.number_of_workers
+    incremental = args.incremental
+    checksum = args.checksum
+    output_format = args.output_format
+    shard_size = args.shard_size
+    packed = args.packed
+
+    if packed and incremental:
+        print("The incremental mode is not supported for packed input.")
+        raise RuntimeError
 
     # Get the file names where the twitter lists for certain users are stored.
-    file_name_list = os.listdir(source_folder)
+    if packed:
+        file_name_list = list()
+    else:
+        file_name_list = os.listdir(source_folder)
+
+    # Skip the files whose outputs are recorded as complete and are still valid.
+    manifest_path = target_folder + "/" + MANIFEST_FILE_NAME
+    file_name_to_entry = dict()
+    if incremental:
+        old_file_name_to_entry = load_manifest(manifest_path)
+        pending_file_name_list = list()
+        for file_name in file_name_list:
+            is_up_to_date, entry = is_file_up_to_date(source_folder, target_folder, file_name,
+                                                      old_file_name_to_entry.get(file_name, None), checksum)
+            if is_up_to_date:
+                file_name_to_entry[file_name] = entry
+            else:
+                pending_file_name_list.append(file_name)
+        print("Incremental mode:", len(file_name_to_entry), "up-to-date files,", len(pending_file_name_list),
+              "new or changed files.")
+        file_name_list = pending_file_name_list
+
+        # The outputs of the source files that were deleted since the last run are removed as well.
+        file_name_set = set(os.listdir(source_folder))
+        removed_entry_list = [entry for file_name, entry in old_file_name_to_entry.items()
+                              if (file_name not in file_name_set) and (entry["target_file_name"] is not None)]
+        if len(removed_entry_list) > 0:
+            if output_format == "json":
+                tombstone_writer = None
+            else:
+                tombstone_writer = ShardedJsonlWriter(target_folder, compress=(output_format == "jsonl.gz"))
+            for entry in removed_entry_list:
+                remove_user_output(target_folder, entry["file_name"][:-4], tombstone_writer)
+            if tombstone_writer is not None:
+                tombstone_writer.close()
+            print("Incremental mode:", len(removed_entry_list), "deleted files.")
 
-    # Build a pool of processes.
-    pool = Pool(processes=get_threads_number()*2,)
+    # A full run replaces the shards of earlier runs, as the readers merge all shards in the target folder.
+    if (not incremental) and output_format != "json":
+        number_of_shards = remove_sharded_jsonl_files(target_folder)
+        if number_of_shards > 0:
+            print("Removed", number_of_shards, "JSON lines shards of earlier runs.")
 
-    # Partition dataset in chunks.
-    user_chunks = chunks(file_name_list, get_threads_number()*2)
+    # Start from a compact manifest; entries are appended as batches complete, so that a crashed run can be resumed.
+    store_manifest(manifest_path, file_name_to_entry)
+
+    # Partition dataset in batches of roughly equal size.
+    if packed:
+        batch_list = [((pack_file_name, index), batch_size)
+                      for pack_file_name, index, batch_size in get_pickle_pack_splits(source_folder,
+                                                                                      number_of_workers*16)]
+        number_of_files = sum(len(batch[1]) for batch, batch_size in batch_list)
+    else:
+        batch_list = get_size_aware_batches(source_folder, file_name_list, number_of_workers)
+        number_of_files = sum(len(batch) for batch, batch_size in batch_list)
+    number_of_bytes = sum(batch_size for batch, batch_size in batch_list)
+    if number_of_files == 0:
+        print("No files to process.")
+        return
+
+    # Build a pool of processes; each one builds the tagger and the other text cleaning resources only once.
+    pool = Pool(processes=number_of_workers,
+                initializer=initialize_worker,
+                initargs=(cache_file_path, target_folder, output_format, shard_size, vocabulary_file_path))
 
     # Extract bags of words in parallel and serialize and store in JSON format.
-    pool.map(partial(worker_function,
-                     source_folder=source_folder,
-                     target_folder=target_folder),
-             user_chunks)
+    start_time = time.perf_counter()
+    files_done = 0
+    bytes_done = 0
+    results = pool.imap_unordered(partial(worker_function,
+                                          source_folder=source_folder,
+                                          target_folder=target_folder,
+                                          checksum=checksum,
+                                          packed=packed),
+                                  (batch for batch, batch_size in batch_list))
+    manifest_file = open(manifest_path, "a", encoding="utf-8")
+    for manifest_entry_list, batch_bytes, batch_time in results:
+        for manifest_entry in manifest_entry_list:
+            manifest_file.write(json.dumps(manifest_entry) + "\n")
+        manifest_file.flush()
+
+        batch_files = len(manifest_entry_list)
+        files_done += batch_files
+        bytes_done += batch_bytes
+        elapsed_time = time.perf_counter() - start_time
+        print("Processed: ", files_done, "/", number_of_files, " files (",
+              "%.1f" % (100*bytes_done/max(1, number_of_bytes)), "% of the data). ",
+              "Throughput: ", "%.1f" % (files_done/elapsed_time), " files/s, ",
+              "%.2f" % (bytes_done/(elapsed_time*2**20)), " MB/s. ",
+              "Batch: ", batch_files, " files in ", "%.1f" % batch_time, " s.", sep="")
+    manifest_file.close()
+    pool.close()
+    pool.join()
+
+    print("Total time:", "%.1f" % (time.perf_counter() - start_time), "s.")
@@ -0,0 +1,29 @@
+__author__ = 'Georgios Rizos (georgerizos@iti.gr)'
+
+import argparse
+
+from reveal_user_annotation.common.datarw import convert_pickle_folder_to_packs
+
+
+def main():
+    # Parse arguments.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--source", dest="source_folder",
+                        help="This is the folder with one pickled Twitter list corpus per user.",
+                        type=str, required=True)
+    parser.add_argument("-t", "--target", dest="target_folder",
+                        help="This is the folder where the packs and their indices will be stored.",
+                        type=str, required=True)
+    parser.add_argument("-m", "--max-pack-size", dest="max_pack_size",
+                        help="This is the maximum size of a pack in MB.",
+                        type=int, required=False, default=1024)
+
+    args = parser.parse_args()
+
+    source_folder = args.source_folder
+    target_folder = args.target_folder
+    max_pack_size = args.max_pack_size
+
+    pack_file_name_list = convert_pickle_folder_to_packs(source_folder, target_folder, max_pack_size*2**20)
+
+    print("Stored", len(pack_file_name_list), "packs.")
@@ -2,6 +2,7 @@ __author__ = 'Georgios Rizos (georgerizos@iti.gr)'
 
 import argparse
 
+from reveal_user_annotation.common.config_package import get_threads_number
 from reveal_user_annotation.mongo.store_snow_data import store_snow_tweets_from_disk_to_mongodb
 
 
@@ -11,9 +12,41 @@ def main():
     parser.add_argument("-f", "--folder", dest="snow_tweets_folder",
                         help="This is the folder with the SNOW tweets.",
                         type=str, required=True)
+    parser.add_argument("-u", "--uri", dest="mongo_uri",
+                        help="This is the MongoDB URI.",
+                        type=str, required=False, default="mongodb://localhost:27017")
+    parser.add_argument("-d", "--database", dest="database_name",
+                        help="This is the target Mongo database.",
+                        type=str, required=False, default="snow_tweet_storage")
+    parser.add_argument("-c", "--collection", dest="collection_name",
+                        help="This is the target tweet collection.",
+                        type=str, required=False, default="tweets")
+    parser.add_argument("-w", "--workers", dest="number_of_workers",
+                        help="This is the number of file reader processes. Default: the number of cores.",
+                        type=int, required=False, default=get_threads_number())
+    parser.add_argument("-b", "--batch-size", dest="batch_size",
+                        help="This is the number of tweets in each bulk insert.",
+                        type=int, required=False, default=1000)
+    parser.add_argument("-r", "--report-interval", dest="report_interval",
+                        help="The ingestion rate is printed every that many seconds; 0 disables reporting.",
+                        type=float, required=False, default=10.0)
+    parser.add_argument("-j", "--json-decoder", dest="json_decoder",
+                        help="This is the JSON decoder. Default: the fastest one that is installed.",
+                        type=str, required=False, default=None, choices=["orjson", "ujson", "json"])
+    parser.add_argument("--slim", dest="slim",
+                        help="Only store the tweet fields that the graph and lemma extractors read.",
+                        action="store_true")
 
     args = parser.parse_args()
 
     snow_tweets_folder = args.snow_tweets_folder
 
-    store_snow_tweets_from_disk_to_mongodb(snow_tweets_folder)
+    store_snow_tweets_from_disk_to_mongodb(snow_tweets_folder,
+                                           mongo_uri=args.mongo_uri,
+                                           database_name=args.database_name,
+                                           collection_name=args.collection_name,
+                                           number_of_workers=args.number_of_workers,
+                                           batch_size=args.batch_size,
+                                           report_interval=args.report_interval,
+                                           json_decoder=args.json_decoder,
+                                           slim=args.slim)
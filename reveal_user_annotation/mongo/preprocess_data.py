@@ -2,17 +2,39 @@ __author__ = 'Georgios Rizos (georgerizos@iti.gr)'
 
 import multiprocessing as mp
 import itertools
+import collections
 import time
+import concurrent.futures
+import datetime
+import calendar
 
 import numpy as np
 import scipy.sparse as spsp
-import networkx as nx
-import networkx.algorithms.components as nxalgcom
-from pymongo import ASCENDING
-
-from reveal_user_annotation.text.clean_text import clean_document, combine_word_list, get_lemmatizer, get_stopset,\
-    get_camel_case_regexes, get_digits_punctuation_whitespace_regex, get_pos_set, backoff_tagger, get_word_patterns,\
-    get_braupt_tagger, get_tokenizer
+import scipy.sparse.csgraph as spspcsgraph
+from pymongo import ASCENDING, DESCENDING, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from reveal_user_annotation.text.clean_text import clean_document, clean_documents, combine_word_list, get_lemmatizer,\
+    get_stopset, get_camel_case_regexes, get_digits_punctuation_whitespace_regex, get_pos_set, backoff_tagger,\
+    get_word_patterns, get_braupt_tagger, get_tokenizer
+from reveal_user_annotation.common.compact_data import Int64Buffer, extend_count_matrix, IdInterner,\
+    IdToStringMap, TimedCountMatrix
+from reveal_user_annotation.common.datarw import store_pickle_atomically, load_pickle
+from reveal_user_annotation.text.map_data import split_every
+
+# The tweet fields that the graph and lemma extractors read; the rest need not be transferred from MongoDB.
+TWEET_GRAPH_FIELDS = ["id",
+                      "created_at",
+                      "text",
+                      "user.id",
+                      "user.screen_name",
+                      "user.name",
+                      "user.listed_count",
+                      "in_reply_to_user_id",
+                      "in_reply_to_screen_name",
+                      "entities.user_mentions.id",
+                      "entities.user_mentions.screen_name"]
+TWEET_GRAPH_FIELDS += ["retweeted_status." + field for field in TWEET_GRAPH_FIELDS]
 
 
 # def get_user_to_bag_of_words_dictionary(user_twitter_id_list, database):
@@ -51,23 +73,58 @@ from reveal_user_annotation.text.clean_text import clean_document, combine_word_
 #         yield user_twitter_id, bag_of_words
 
 
-def store_user_documents(user_document_gen, client, mongo_database_name, mongo_collection_name):
+def store_user_documents(user_document_gen, client, mongo_database_name, mongo_collection_name, batch_size=1000,
+                         write_concern=None):
     """
     Stores Twitter list objects that a Twitter user is a member of in different mongo collections.
 
-    Inputs: - user_document_gen: A python generator that yields a Twitter user id and an associated document list.
-            - client: A pymongo MongoClient object.
-            - mongo_database_name: The name of a Mongo database as a string.
-            - mongo_collection_name: The name of the mongo collection as a string.
+    The documents are upserted in unordered bulk writes, i.e. one round trip per batch instead of one per user.
+
+    Inputs:  - user_document_gen: A python generator that yields a Twitter user id and an associated document list.
+             - client: A pymongo MongoClient object.
+             - mongo_database_name: The name of a Mongo database as a string.
+             - mongo_collection_name: The name of the mongo collection as a string.
+             - batch_size: The number of documents in each bulk write.
+             - write_concern: A pymongo WriteConcern object. Default: None, i.e. that of the collection. Unacknowledged
+                              writes (w=0) are reported with zero counts.
+
+    Output:  - batch_result_list: A python list with a tuple per batch, containing: * The number of inserted documents.
+                                                                                   * The number of updated documents.
+                                                                                   * The number of failed writes.
     """
     mongo_database = client[mongo_database_name]
     mongo_collection = mongo_database[mongo_collection_name]
+    if write_concern is not None:
+        mongo_collection = mongo_collection.with_options(write_concern=write_concern)
+
+    def write_batch(request_list):
+        try:
+            result = mongo_collection.bulk_write(request_list, ordered=False)
+        except BulkWriteError as e:
+            details = e.details
+            return details["nUpserted"], details["nMatched"], len(details["writeErrors"])
+        if not result.acknowledged:
+            return 0, 0, 0
+        return result.upserted_count, result.matched_count, 0
+
+    batch_result_list = list()
+    append_batch_result = batch_result_list.append
 
     # Iterate over all users to be annotated and store the Twitter lists in mongo.
+    request_list = list()
     for user_twitter_id, user_document_list in user_document_gen:
         document = user_document_list
         document["_id"] = int(user_twitter_id)
-        mongo_collection.update({"_id": user_twitter_id}, document, upsert=True)
+        request_list.append(ReplaceOne({"_id": document["_id"]}, document, upsert=True))
+
+        if len(request_list) >= batch_size:
+            append_batch_result(write_batch(request_list))
+            request_list = list()
+
+    if len(request_list) > 0:
+        append_batch_result(write_batch(request_list))
+
+    return batch_result_list
 
 
 def read_user_documents_for_single_user_generator(user_twitter_id, mongo_database):
@@ -88,14 +145,21 @@ def read_user_documents_for_single_user_generator(user_twitter_id, mongo_databas
         yield twitter_list
 
 
-def read_user_documents_generator(user_twitter_id_list, client, mongo_database_name, mongo_collection_name):
+def read_user_documents_generator(user_twitter_id_list, client, mongo_database_name, mongo_collection_name,
+                                  batch_size=1000, number_of_threads=1):
     """
     Stores Twitter list objects that a Twitter user is a member of in different mongo collections.
 
+    The documents are fetched with {"_id": {"$in": [...]}} queries over batches of the requested ids, so only the
+    requested documents are transferred. With more than one thread, the next batches are fetched while the current one
+    is being consumed.
+
     Inputs: - user_twitter_id_list: A python list of Twitter user ids.
             - client: A pymongo MongoClient object.
             - mongo_database_name: The name of a Mongo database as a string.
             - mongo_collection_name: The name of the mongo collection as a string.
+            - batch_size: The number of user ids in each query.
+            - number_of_threads: The number of queries in flight. Default: 1, i.e. one query at a time.
 
     Yields: - user_twitter_id: A Twitter user id.
             - twitter_list_gen: A python generator that yields Twitter lists in dictionary (json) format.
@@ -103,29 +167,53 @@ def read_user_documents_generator(user_twitter_id_list, client, mongo_database_n
     mongo_database = client[mongo_database_name]
     mongo_collection = mongo_database[mongo_collection_name]
 
-    # cursor = mongo_collection.find({"_id": {"$in": [int(user_twitter_id) for user_twitter_id in user_twitter_id_list]}})
-    cursor = mongo_collection.find()
-
+    # Remove duplicates, but keep the order of the requested ids.
     user_twitter_id_list = [int(user_twitter_id) for user_twitter_id in user_twitter_id_list]
-    user_twitter_id_list = set(user_twitter_id_list)
+    user_twitter_id_list = list(collections.OrderedDict.fromkeys(user_twitter_id_list))
+
+    def read_batch(user_twitter_id_batch):
+        cursor = mongo_collection.find({"_id": {"$in": user_twitter_id_batch}}).batch_size(batch_size)
+        return list(cursor)
 
-    for documents in cursor:
-        if documents["_id"] in user_twitter_id_list:
-            yield documents["_id"], documents
+    batch_gen = split_every(user_twitter_id_list, batch_size)
+
+    if number_of_threads <= 1:
+        for user_twitter_id_batch in batch_gen:
+            for documents in read_batch(user_twitter_id_batch):
+                yield documents["_id"], documents
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=number_of_threads) as executor:
+            future_queue = collections.deque(executor.submit(read_batch, user_twitter_id_batch)
+                                             for user_twitter_id_batch in itertools.islice(batch_gen,
+                                                                                           number_of_threads))
+            while len(future_queue) > 0:
+                document_list = future_queue.popleft().result()
+                for user_twitter_id_batch in itertools.islice(batch_gen, 1):
+                    future_queue.append(executor.submit(read_batch, user_twitter_id_batch))
 
+                for documents in document_list:
+                    yield documents["_id"], documents
 
-def get_collection_documents_generator(client, database_name, collection_name, spec, latest_n, sort_key):
+
+def get_collection_documents_generator(client, database_name, collection_name, spec, latest_n, sort_key,
+                                       projection=TWEET_GRAPH_FIELDS, batch_size=1000):
     """
     This is a python generator that yields tweets stored in a mongodb collection.
 
     Tweet "created_at" field is assumed to have been stored in the format supported by MongoDB.
 
+    The latest documents are fetched with a descending sort and a limit, which the server serves from the sort key
+    index, and are then yielded in ascending order.
+
     Inputs: - client: A pymongo MongoClient object.
             - database_name: The name of a Mongo database as a string.
             - collection_name: The name of the tweet collection as a string.
             - spec: A python dictionary that defines higher query arguments.
             - latest_n: The number of latest results we require from the mongo document collection.
             - sort_key: A field name according to which we will sort in ascending order.
+            - projection: The fields to be fetched, as a python list or a MongoDB projection dictionary.
+                          Default: The fields that the graph and lemma extractors read. Use None for whole documents.
+            - batch_size: The number of documents fetched from the server in each round trip.
 
     Yields: - document: A document in python dictionary (json) format.
     """
@@ -134,635 +222,916 @@ def get_collection_documents_generator(client, database_name, collection_name, s
     collection.create_index(sort_key)
 
     if latest_n is not None:
-        skip_n = collection.count() - latest_n
-        if collection.count() - latest_n < 0:
-            skip_n = 0
-        cursor = collection.find(filter=spec).sort([(sort_key, ASCENDING), ])
-        cursor = cursor[skip_n:]
+        if latest_n <= 0:
+            return
+        cursor = collection.find(filter=spec, projection=projection).sort([(sort_key, DESCENDING), ])
+        cursor = cursor.limit(latest_n).batch_size(batch_size)
+
+        document_list = list(cursor)
+        document_list.reverse()
+        for document in document_list:
+            yield document
     else:
-        cursor = collection.find(filter=spec).sort([(sort_key, ASCENDING), ])
+        cursor = collection.find(filter=spec, projection=projection).sort([(sort_key, ASCENDING), ])
+        cursor = cursor.batch_size(batch_size)
 
-    for document in cursor:
-        yield document
+        for document in cursor:
+            yield document
 
 
-def extract_graphs_and_lemmas_from_tweets(tweet_generator):
+def get_tweet_cleaning_resources(vocabulary_file_path=None):
     """
-    Given a tweet python generator, we encode the information into mention and retweet graphs and a lemma matrix.
+    Prepares the text cleaning resources used for tweets, in the argument order of clean_document.
 
-    We assume that the tweets are given in increasing timestamp.
+    Input:  - vocabulary_file_path: A vocabulary file stored by MemoizedLemmatizer.store_vocabulary, with which the
+                                    memoized lemmatizer is pre-warmed. Default: None, i.e. start with an empty cache.
+    """
+    sent_tokenize, _treebank_word_tokenize = get_tokenizer()
+    # tagger = HunposTagger('hunpos-1.0-linux/english.model', 'hunpos-1.0-linux/hunpos-tag')
+    # tagger = PerceptronTagger()
+    tagger = get_braupt_tagger()
+    lemmatizer, lemmatize = get_lemmatizer("wordnet", cache_size=2**16, vocabulary_file_path=vocabulary_file_path)
+    stopset = get_stopset()
+    first_cap_re, all_cap_re = get_camel_case_regexes()
+    digits_punctuation_whitespace_re = get_digits_punctuation_whitespace_regex()
+    pos_set = get_pos_set()
 
-    Inputs:  - tweet_generator: A python generator of tweets in python dictionary (json) format.
+    return sent_tokenize, _treebank_word_tokenize, tagger, lemmatizer, lemmatize, stopset,\
+        first_cap_re, all_cap_re, digits_punctuation_whitespace_re, pos_set
 
-    Outputs: - mention_graph: The mention graph as a SciPy sparse matrix.
-             - retweet_graph: The retweet graph as a SciPy sparse matrix.
-             - user_lemma_matrix: The user lemma vector representation matrix as a SciPy sparse matrix.
-             - tweet_id_set: A python set containing the Twitter ids for all the dataset tweets.
-             - user_id_set: A python set containing the Twitter ids for all the dataset users.
-             - lemma_to_attribute: A map from lemmas to numbers in python dictionary format.
+
+def get_tweet_lemma_text(tweet):
     """
-    ####################################################################################################################
-    # Prepare for iterating over tweets.
-    ####################################################################################################################
-    # These are initialized as lists for incremental extension.
-    tweet_id_set = set()
-    user_id_set = list()
+    Returns the text whose lemmas a tweet contributes to the user-lemma matrix, i.e. the retweeted text for retweets.
 
-    add_tweet_id = tweet_id_set.add
-    append_user_id = user_id_set.append
+    Input:   - tweet: A tweet in python dictionary (json) format.
 
-    # Initialize sparse matrix arrays.
-    mention_graph_row = list()
-    mention_graph_col = list()
+    Outputs: - lemma_tweet_id: The id of the tweet the text belongs to, i.e. the original tweet id for retweets.
+             - text: The text as a string, or None if the tweet has no text.
+    """
+    if "retweeted_status" in tweet.keys():
+        tweet = tweet["retweeted_status"]
 
-    retweet_graph_row = list()
-    retweet_graph_col = list()
+    try:
+        return tweet["id"], tweet["text"]
+    except KeyError:
+        return None, None
 
-    user_lemma_matrix_row = list()
-    user_lemma_matrix_col = list()
-    user_lemma_matrix_data = list()
 
-    append_mention_graph_row = mention_graph_row.append
-    append_mention_graph_col = mention_graph_col.append
+def get_tweet_graph_fields(tweet):
+    """
+    Extracts the fields of a tweet that the mention and retweet graphs are formed from.
 
-    append_retweet_graph_row = retweet_graph_row.append
-    append_retweet_graph_col = retweet_graph_col.append
+    Input:   - tweet: A tweet in python dictionary (json) format.
 
-    extend_user_lemma_matrix_row = user_lemma_matrix_row.extend
-    extend_user_lemma_matrix_col = user_lemma_matrix_col.extend
-    extend_user_lemma_matrix_data = user_lemma_matrix_data.extend
+    Output:  - tweet_fields: None if the tweet lacks any of the required fields. Otherwise, a tuple containing:
+                             * The tweet id.
+                             * The Twitter id, screen name, name and listed count of the author.
+                             * A python list of (Twitter id, screen name) pairs of the users the tweet replies to or
+                               mentions.
+                             * The same tuple for the retweeted tweet, or None if this is an original tweet.
+    """
+    try:
+        tweet_fields = get_single_tweet_graph_fields(tweet)
 
-    # Initialize dictionaries.
-    id_to_node = dict()
-    id_to_name = dict()
-    id_to_username = dict()
-    id_to_listedcount = dict()
-    lemma_to_attribute = dict()
+        if "retweeted_status" not in tweet.keys():
+            original_tweet_fields = None
+        else:
+            original_tweet_fields = get_single_tweet_graph_fields(tweet["retweeted_status"]) + (None, )
+    except KeyError:
+        return None
 
-    sent_tokenize, _treebank_word_tokenize = get_tokenizer()
-    # tagger = HunposTagger('hunpos-1.0-linux/english.model', 'hunpos-1.0-linux/hunpos-tag')
-    # tagger = PerceptronTagger()
-    tagger = get_braupt_tagger()
-    lemmatizer, lemmatize = get_lemmatizer("wordnet")
-    stopset = get_stopset()
-    first_cap_re, all_cap_re = get_camel_case_regexes()
-    digits_punctuation_whitespace_re = get_digits_punctuation_whitespace_regex()
-    pos_set = get_pos_set()
+    return tweet_fields + (original_tweet_fields, )
 
-    ####################################################################################################################
-    # Iterate over tweets.
-    ####################################################################################################################
-    counter = 0
-    for tweet in tweet_generator:
-        # print(tweet)
-        # Increment tweet counter.
-        counter += 1
-        # if counter % 10000 == 0:
-        #     print(counter)
-        # print(counter)
-
-        # Extract base tweet's values.
-        try:
-            tweet_id = tweet["id"]
-            user_id = tweet["user"]["id"]
-            user_name = tweet["user"]["name"]
-            user_screen_name = tweet["user"]["screen_name"]
 
-            listed_count_raw = tweet["user"]["listed_count"]
+def get_single_tweet_graph_fields(tweet):
+    user = tweet["user"]
 
-            tweet_text = tweet["text"]
+    mentioned_user_list = list()
+    if tweet["in_reply_to_user_id"] is not None:
+        mentioned_user_list.append((tweet["in_reply_to_user_id"], tweet["in_reply_to_screen_name"]))
+    for user_mention in tweet["entities"]["user_mentions"]:
+        mentioned_user_list.append((user_mention["id"], user_mention["screen_name"]))
 
-            tweet_in_reply_to_user_id = tweet["in_reply_to_user_id"]
-            tweet_in_reply_to_screen_name = tweet["in_reply_to_screen_name"]
-            tweet_entities_user_mentions = tweet["entities"]["user_mentions"]
+    listed_count_raw = user["listed_count"]
+    if listed_count_raw is None:
+        listed_count = 0
+    else:
+        listed_count = int(listed_count_raw)
 
-            if "retweeted_status" not in tweet.keys():
-                user_mention_id_list = list()
-                user_mention_screen_name_list = list()
-                for user_mention in tweet_entities_user_mentions:
-                    user_mention_id_list.append(user_mention["id"])
-                    user_mention_screen_name_list.append(user_mention["screen_name"])
-            else:
-                # Extract base tweet's values.
-                original_tweet = tweet["retweeted_status"]
+    return tweet["id"], user["id"], user["screen_name"], user["name"], listed_count, mentioned_user_list
+
+
+def get_tweet_graph_nodes(tweet_fields, id_to_node):
+    """
+    Maps the users of a tweet to distinct integer numbers, according to the edge rules of the tweet graphs.
+
+    A tweet adds mention edges from its author to the users it mentions or replies to. A retweet adds a retweet edge
+    from its author to the author of the retweeted tweet, and mention edges from both of them to the users that the
+    retweeted tweet mentions or replies to; the latter only the first time the retweeted tweet is seen.
+
+    Inputs:  - tweet_fields: The fields of a tweet, as extracted by get_tweet_graph_fields.
+             - id_to_node: A map from Twitter user ids to nodes; it is updated in place.
 
-                original_tweet_id = original_tweet["id"]
-                original_tweet_user_id = original_tweet["user"]["id"]
-                original_tweet_user_name = original_tweet["user"]["name"]
-                original_tweet_user_screen_name = original_tweet["user"]["screen_name"]
+    Outputs: - source_node: The node of the author of the tweet.
+             - original_tweet_node: The node of the author of the retweeted tweet, or None for original tweets.
+             - mention_target_node_list: A python list of the nodes mentioned by the tweet, or by the retweeted tweet
+                                         for retweets, without duplicates.
+    """
+    tweet_id, user_id, user_screen_name, user_name, listed_count, mentioned_user_list,\
+        original_tweet_fields = tweet_fields
+
+    source_node = id_to_node.setdefault(user_id, len(id_to_node))
+
+    if original_tweet_fields is None:
+        original_tweet_node = None
+    else:
+        original_tweet_node = id_to_node.setdefault(original_tweet_fields[1], len(id_to_node))
+        mentioned_user_list = original_tweet_fields[5]
 
-                listed_count_raw = original_tweet["user"]["listed_count"]
+    # We remove duplicates.
+    mentioned_user_id_set = set(mentioned_user_id for mentioned_user_id, mentioned_user_screen_name in mentioned_user_list)
 
-                original_tweet_text = original_tweet["text"]
+    mention_target_node_list = [id_to_node.setdefault(mentioned_user_id, len(id_to_node))
+                                for mentioned_user_id in mentioned_user_id_set]
 
-                original_tweet_in_reply_to_user_id = original_tweet["in_reply_to_user_id"]
-                original_tweet_in_reply_to_screen_name = original_tweet["in_reply_to_screen_name"]
-                original_tweet_entities_user_mentions = original_tweet["entities"]["user_mentions"]
+    return source_node, original_tweet_node, mention_target_node_list
+
+
+class TweetAttributeListCache:
+    """
+    A bounded least-recently-used cache of the lemma attribute lists of tweet texts, keyed by tweet id.
 
-                original_tweet_user_mention_id_list = list()
-                original_tweet_user_mention_screen_name_list = list()
-                for user_mention in original_tweet_entities_user_mentions:
-                    original_tweet_user_mention_id_list.append(user_mention["id"])
-                    original_tweet_user_mention_screen_name_list.append(user_mention["screen_name"])
+    A viral tweet is retweeted thousands of times, and all retweets carry the text of the original. The text is cleaned
+    only once while its attribute list stays in the cache. The attribute lists are identical to those cleaning the text
+    again would produce, since repeated lemmas map to the attributes they were assigned at their first appearance.
+    """
+    def __init__(self, cache_size=2**16):
+        """
+        Input:  - cache_size: The maximum number of tweets whose attribute lists are kept.
+        """
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tweet_id):
+        """
+        Returns a fresh python list of the attributes of a tweet text, or None on a miss.
+        """
+        try:
+            attribute_tuple = self.cache[tweet_id]
         except KeyError:
-            continue
-        # Map users to distinct integer numbers.
-        graph_size = len(id_to_node)
-        source_node = id_to_node.setdefault(user_id, graph_size)
+            self.misses += 1
+            return None
+        self.cache.move_to_end(tweet_id)
+        self.hits += 1
+        return list(attribute_tuple)
+
+    def put(self, tweet_id, attribute_list):
+        self.cache[tweet_id] = tuple(attribute_list)
+        self.cache.move_to_end(tweet_id)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def cache_info(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.cache),
+                "cache_size": self.cache_size}
+
+
+def get_tweet_attribute_lists_serial_generator(tweet_generator, lemma_to_attribute, attribute_list_cache=None,
+                                               vocabulary_file_path=None):
+    """
+    Cleans the text of each tweet and maps the lemmas to distinct integer attributes.
 
-        if listed_count_raw is None:
-            id_to_listedcount[user_id] = 0
-        else:
-            id_to_listedcount[user_id] = int(listed_count_raw)
+    Inputs:  - tweet_generator: A python generator of tweets in python dictionary (json) format.
+             - lemma_to_attribute: A map from lemmas to numbers in python dictionary format; it is updated in place.
+             - attribute_list_cache: An optional TweetAttributeListCache, so that retweeted texts are cleaned once.
+             - vocabulary_file_path: An optional vocabulary file with which the lemmatizer cache is pre-warmed.
 
-        # Update sets, lists and dictionaries.
-        add_tweet_id(tweet_id)
-        id_to_name[user_id] = user_screen_name
-        id_to_username[user_id] = user_name
-        append_user_id(user_id)
+    Yields:  - tweet: A tweet in python dictionary (json) format.
+             - attribute_list: A python list of the lemma attributes of the tweet, or None if the tweet is to be skipped.
+    """
+    sent_tokenize, _treebank_word_tokenize, tagger, lemmatizer, lemmatize, stopset,\
+        first_cap_re, all_cap_re, digits_punctuation_whitespace_re, pos_set = get_tweet_cleaning_resources(vocabulary_file_path)
 
-        ################################################################################################################
-        # We are dealing with an original tweet.
-        ################################################################################################################
-        if "retweeted_status" not in tweet.keys():
-            ############################################################################################################
-            # Update user-lemma frequency matrix.
-            ############################################################################################################
-            # Extract lemmas from the text.
-            tweet_lemmas, lemma_to_keywordbag = clean_document(tweet_text, sent_tokenize, _treebank_word_tokenize,
-                                                               tagger, lemmatizer, lemmatize, stopset,
-                                                               first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
-                                                               pos_set)
-
-            number_of_lemmas = len(tweet_lemmas)
-
-            # Update the user-lemma frequency matrix one-by-one.
-            attribute_list = list()
-            append_attribute = attribute_list.append
-            for lemma in tweet_lemmas:
-                # Map lemmas to distinct integer numbers.
-                vocabulary_size = len(lemma_to_attribute)
-                attribute = lemma_to_attribute.setdefault(lemma, vocabulary_size)
-                append_attribute(attribute)
-
-            # Add values to the sparse matrix arrays.
-            extend_user_lemma_matrix_row(number_of_lemmas*[source_node])
-            extend_user_lemma_matrix_col(attribute_list)
-            extend_user_lemma_matrix_data(number_of_lemmas*[1.0])
-
-            ############################################################################################################
-            # Update mention matrix.
-            ############################################################################################################
-            # Get mentioned user ids.
-            mentioned_user_id_set = list()
-            if tweet_in_reply_to_user_id is not None:
-                mentioned_user_id_set.append(tweet_in_reply_to_user_id)
-
-                id_to_name[tweet_in_reply_to_user_id] = tweet_in_reply_to_screen_name
-            for user_mention, mentioned_user_id, mentioned_user_screen_name in zip(tweet_entities_user_mentions,
-                                                                                   user_mention_id_list,
-                                                                                   user_mention_screen_name_list):
-                mentioned_user_id_set.append(mentioned_user_id)
-
-                id_to_name[mentioned_user_id] = mentioned_user_screen_name
-
-            # We remove duplicates.
-            mentioned_user_id_set = set(mentioned_user_id_set)
-
-            # Update the mention graph one-by-one.
-            for mentioned_user_id in mentioned_user_id_set:
-                # Map users to distinct integer numbers.
-                graph_size = len(id_to_node)
-                mention_target_node = id_to_node.setdefault(mentioned_user_id, graph_size)
-
-                append_user_id(mentioned_user_id)
-
-                # Add values to the sparse matrix arrays.
-                append_mention_graph_row(source_node)
-                append_mention_graph_col(mention_target_node)
+    for tweet in tweet_generator:
+        lemma_tweet_id, text = get_tweet_lemma_text(tweet)
+        if text is None:
+            yield tweet, None
+            continue
 
-        ################################################################################################################
-        # We are dealing with a retweet.
-        ################################################################################################################
-        else:
-            # Map users to distinct integer numbers.
-            graph_size = len(id_to_node)
-            original_tweet_node = id_to_node.setdefault(original_tweet_user_id, graph_size)
+        if attribute_list_cache is not None:
+            attribute_list = attribute_list_cache.get(lemma_tweet_id)
+            if attribute_list is not None:
+                yield tweet, attribute_list
+                continue
 
-            if listed_count_raw is None:
-                id_to_listedcount[user_id] = 0
-            else:
-                id_to_listedcount[user_id] = int(listed_count_raw)
-
-            # Update retweet graph.
-            append_retweet_graph_row(source_node)
-            append_retweet_graph_col(original_tweet_node)
-
-            # Extract lemmas from the text.
-            tweet_lemmas, lemma_to_keywordbag = clean_document(original_tweet_text, sent_tokenize, _treebank_word_tokenize,
-                                                               tagger, lemmatizer, lemmatize, stopset,
-                                                               first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
-                                                               pos_set)
-
-            number_of_lemmas = len(tweet_lemmas)
-
-            # Update the user-lemma frequency matrix one-by-one.
-            attribute_list = list()
-            append_attribute = attribute_list.append
-            for lemma in tweet_lemmas:
-                # Map lemmas to distinct integer numbers.
-                vocabulary_size = len(lemma_to_attribute)
-                attribute = lemma_to_attribute.setdefault(lemma, vocabulary_size)
-                append_attribute(attribute)
-
-            # Add values to the sparse matrix arrays.
-            extend_user_lemma_matrix_row(number_of_lemmas*[source_node])
-            extend_user_lemma_matrix_col(attribute_list)
-            extend_user_lemma_matrix_data(number_of_lemmas*[1.0])
-
-            # Get mentioned user ids.
-            mentioned_user_id_set = list()
-            if original_tweet_in_reply_to_user_id is not None:
-                mentioned_user_id_set.append(original_tweet_in_reply_to_user_id)
-
-                id_to_name[original_tweet_in_reply_to_user_id] = original_tweet_in_reply_to_screen_name
-            for user_mention, mentioned_user_id, mentioned_user_screen_name in zip(original_tweet_entities_user_mentions,
-                                                                                   original_tweet_user_mention_id_list,
-                                                                                   original_tweet_user_mention_screen_name_list):
-                mentioned_user_id_set.append(mentioned_user_id)
-
-                id_to_name[mentioned_user_id] = mentioned_user_screen_name
-
-            # We remove duplicates.
-            mentioned_user_id_set = set(mentioned_user_id_set)
-
-            # Get mentioned user ids.
-            retweet_mentioned_user_id_set = list()
-            if original_tweet_in_reply_to_user_id is not None:
-                retweet_mentioned_user_id_set.append(original_tweet_in_reply_to_user_id)
-
-                id_to_name[original_tweet_in_reply_to_user_id] = original_tweet_in_reply_to_screen_name
-            for user_mention, mentioned_user_id, mentioned_user_screen_name in zip(original_tweet_entities_user_mentions,
-                                                                                   original_tweet_user_mention_id_list,
-                                                                                   original_tweet_user_mention_screen_name_list):
-                retweet_mentioned_user_id_set.append(mentioned_user_id)
-
-                id_to_name[mentioned_user_id] = mentioned_user_screen_name
-
-            # We remove duplicates.
-            retweet_mentioned_user_id_set = set(retweet_mentioned_user_id_set)
-
-            mentioned_user_id_set.update(retweet_mentioned_user_id_set)
-
-            # Update the mention graph one-by-one.
-            for mentioned_user_id in mentioned_user_id_set:
-                # Map users to distinct integer numbers.
-                graph_size = len(id_to_node)
-                mention_target_node = id_to_node.setdefault(mentioned_user_id, graph_size)
-
-                append_user_id(mentioned_user_id)
-
-                # Add values to the sparse matrix arrays.
-                append_mention_graph_row(source_node)
-                append_mention_graph_col(mention_target_node)
-
-            # This is the first time we deal with this tweet.
-            if original_tweet_id not in tweet_id_set:
-                # Update sets, lists and dictionaries.
-                add_tweet_id(original_tweet_id)
-                id_to_name[original_tweet_user_id] = original_tweet_user_screen_name
-                id_to_username[original_tweet_user_id] = original_tweet_user_name
-                append_user_id(original_tweet_user_id)
-
-                ########################################################################################################
-                # Update user-lemma frequency matrix.
-                ########################################################################################################
-                # Update the user-lemma frequency matrix one-by-one.
-                attribute_list = list()
-                append_attribute = attribute_list.append
-                for lemma in tweet_lemmas:
-                    # Map lemmas to distinct integer numbers.
-                    vocabulary_size = len(lemma_to_attribute)
-                    attribute = lemma_to_attribute.setdefault(lemma, vocabulary_size)
-                    append_attribute(attribute)
-
-                # Add values to the sparse matrix arrays.
-                extend_user_lemma_matrix_row(number_of_lemmas*[source_node])
-                extend_user_lemma_matrix_col(attribute_list)
-                extend_user_lemma_matrix_data(number_of_lemmas*[1.0])
-
-                ########################################################################################################
-                # Update mention matrix.
-                ########################################################################################################
-                # Update the mention graph one-by-one.
-                for mentioned_user_id in retweet_mentioned_user_id_set:
-                    # Map users to distinct integer numbers.
-                    graph_size = len(id_to_node)
-                    mention_target_node = id_to_node.setdefault(mentioned_user_id, graph_size)
+        # Extract lemmas from the text.
+        tweet_lemmas, lemma_to_keywordbag = clean_document(text, sent_tokenize, _treebank_word_tokenize,
+                                                           tagger, lemmatizer, lemmatize, stopset,
+                                                           first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
+                                                           pos_set)
 
-                    append_user_id(mentioned_user_id)
+        attribute_list = list()
+        append_attribute = attribute_list.append
+        for lemma in tweet_lemmas:
+            # Map lemmas to distinct integer numbers.
+            vocabulary_size = len(lemma_to_attribute)
+            attribute = lemma_to_attribute.setdefault(lemma, vocabulary_size)
+            append_attribute(attribute)
 
-                    # Add values to the sparse matrix arrays.
-                    append_mention_graph_row(original_tweet_node)
-                    append_mention_graph_col(mention_target_node)
-            else:
-                pass
+        if attribute_list_cache is not None:
+            attribute_list_cache.put(lemma_tweet_id, attribute_list)
 
-    ####################################################################################################################
-    # Final steps of preprocessing tweets.
-    ####################################################################################################################
-    # Discard any duplicates.
-    user_id_set = set(user_id_set)
-    number_of_users = len(user_id_set)
-    # min_number_of_users = max(user_id_set) + 1
+        yield tweet, attribute_list
 
-    # Form mention graph adjacency matrix.
-    mention_graph_row = np.array(mention_graph_row, dtype=np.int64)
-    mention_graph_col = np.array(mention_graph_col, dtype=np.int64)
-    mention_graph_data = np.ones_like(mention_graph_row, dtype=np.float64)
 
-    mention_graph = spsp.coo_matrix((mention_graph_data, (mention_graph_row, mention_graph_col)),
-                                    shape=(number_of_users, number_of_users))
-    mention_graph = spsp.coo_matrix(spsp.csr_matrix(mention_graph))
+# The text cleaning resources of a worker process; set by initialize_tweet_cleaning_worker.
+tweet_cleaning_resources = None
 
-    # Form retweet graph adjacency matrix.
-    retweet_graph_row = np.array(retweet_graph_row, dtype=np.int64)
-    retweet_graph_col = np.array(retweet_graph_col, dtype=np.int64)
-    retweet_graph_data = np.ones_like(retweet_graph_row, dtype=np.float64)
 
-    retweet_graph = spsp.coo_matrix((retweet_graph_data, (retweet_graph_row, retweet_graph_col)),
-                                    shape=(number_of_users, number_of_users))
-    retweet_graph = spsp.coo_matrix(spsp.csr_matrix(retweet_graph))
+def initialize_tweet_cleaning_worker(vocabulary_file_path=None):
+    """
+    Pool initializer; the tagger and the rest of the text cleaning resources are prepared once per process.
+    """
+    global tweet_cleaning_resources
+    tweet_cleaning_resources = get_tweet_cleaning_resources(vocabulary_file_path)
 
-    # Form user-lemma matrix.
-    number_of_lemmas = len(lemma_to_attribute)
 
-    user_lemma_matrix_row = np.array(user_lemma_matrix_row, dtype=np.int64)
-    user_lemma_matrix_col = np.array(user_lemma_matrix_col, dtype=np.int64)
-    user_lemma_matrix_data = np.array(user_lemma_matrix_data, dtype=np.float64)
+def clean_tweet_text_shard(text_list):
+    """
+    Cleans a shard of tweet texts in a worker process, using local lemma ids.
 
-    user_lemma_matrix = spsp.coo_matrix((user_lemma_matrix_data, (user_lemma_matrix_row, user_lemma_matrix_col)),
-                                        shape=(number_of_users, number_of_lemmas))
-    user_lemma_matrix = spsp.coo_matrix(spsp.csr_matrix(user_lemma_matrix))
+    Input:   - text_list: A python list of tweet texts.
 
-    node_to_id = dict(zip(id_to_node.values(), id_to_node.keys()))
+    Outputs: - local_lemma_list: The distinct lemmas of the shard, in order of first appearance; the local id of a lemma
+                                 is its position in this list.
+             - local_attribute_array: A numpy array with the local lemma ids of all texts, concatenated.
+             - document_offsets: A numpy array; the local ids of text i are in local_attribute_array[offsets[i]:offsets[i+1]].
+    """
+    list_of_lemma_lists, list_of_lemma_to_keywordbags = clean_documents(text_list, *tweet_cleaning_resources)
 
-    # tagger.close()
+    local_lemma_to_attribute = dict()
+    local_attribute_list = list()
+    append_local_attribute = local_attribute_list.append
+    document_offsets = [0]
+    for tweet_lemmas in list_of_lemma_lists:
+        for lemma in tweet_lemmas:
+            append_local_attribute(local_lemma_to_attribute.setdefault(lemma, len(local_lemma_to_attribute)))
+        document_offsets.append(len(local_attribute_list))
 
-    return mention_graph, retweet_graph, user_lemma_matrix, tweet_id_set, user_id_set, node_to_id, lemma_to_attribute, id_to_name, id_to_username, id_to_listedcount
+    local_lemma_list = list(local_lemma_to_attribute.keys())
+    local_attribute_array = np.array(local_attribute_list, dtype=np.int64)
+    document_offsets = np.array(document_offsets, dtype=np.int64)
 
+    return local_lemma_list, local_attribute_array, document_offsets
 
-def extract_graphs_from_tweets(tweet_generator):
+
+def get_tweet_attribute_lists_parallel_generator(tweet_generator, lemma_to_attribute, number_of_workers, shard_size,
+                                                 attribute_list_cache=None, vocabulary_file_path=None):
     """
-    Given a tweet python generator, we encode the information into mention and retweet graphs.
+    Shards the tweet stream and cleans the texts of each shard in a pool of processes.
 
-    We assume that the tweets are given in increasing timestamp.
+    The shards are merged in stream order, with each local lemma dictionary remapped into lemma_to_attribute in its
+    order of first appearance. Thus the attributes are numbered exactly as in the serial generator.
 
     Inputs:  - tweet_generator: A python generator of tweets in python dictionary (json) format.
+             - lemma_to_attribute: A map from lemmas to numbers in python dictionary format; it is updated in place.
+             - number_of_workers: The number of text cleaning processes.
+             - shard_size: The number of tweets in each shard.
+             - attribute_list_cache: An optional TweetAttributeListCache. Texts that hit the cache when their shard is
+                                     formed, or that repeat within a shard, are not sent to the workers.
+             - vocabulary_file_path: An optional vocabulary file with which the lemmatizer caches are pre-warmed.
+
+    Yields:  - tweet: A tweet in python dictionary (json) format.
+             - attribute_list: A python list of the lemma attributes of the tweet, or None if the tweet is to be skipped.
+    """
+    def merge_shard(shard_tweet_list, shard_entries, async_result):
+        local_lemma_list, local_attribute_array, document_offsets = async_result.get()
+
+        # Remap the local lemma ids into the global attribute space.
+        local_to_global = np.array([lemma_to_attribute.setdefault(lemma, len(lemma_to_attribute)) for lemma in local_lemma_list],
+                                   dtype=np.int64)
+        global_attribute_array = local_to_global[local_attribute_array].tolist()
+
+        next_document_index = 0
+        for tweet, (lemma_tweet_id, document_index, attribute_list) in zip(shard_tweet_list, shard_entries):
+            if document_index is not None:
+                attribute_list = global_attribute_array[document_offsets[document_index]:document_offsets[document_index+1]]
+                # Only the first occurrence of a text in the shard was cleaned.
+                if document_index == next_document_index:
+                    next_document_index += 1
+                    if attribute_list_cache is not None:
+                        attribute_list_cache.put(lemma_tweet_id, attribute_list)
+            yield tweet, attribute_list
+
+    pool = mp.Pool(processes=number_of_workers, initializer=initialize_tweet_cleaning_worker,
+                   initargs=(vocabulary_file_path, ))
+    try:
+        # Keep a bounded number of shards in flight, so that the stream is never read far ahead of the merge.
+        pending_shards = collections.deque()
+        for shard_tweet_list in split_every(tweet_generator, shard_size):
+            text_list = list()
+            shard_entries = list()
+            lemma_tweet_id_to_document_index = dict()
+            for tweet in shard_tweet_list:
+                lemma_tweet_id, text = get_tweet_lemma_text(tweet)
+                if text is None:
+                    shard_entries.append((None, None, None))
+                    continue
+
+                if attribute_list_cache is not None:
+                    attribute_list = attribute_list_cache.get(lemma_tweet_id)
+                    if attribute_list is not None:
+                        shard_entries.append((lemma_tweet_id, None, attribute_list))
+                        continue
+
+                    document_index = lemma_tweet_id_to_document_index.get(lemma_tweet_id)
+                    if document_index is not None:
+                        shard_entries.append((lemma_tweet_id, document_index, None))
+                        continue
+                    lemma_tweet_id_to_document_index[lemma_tweet_id] = len(text_list)
+
+                shard_entries.append((lemma_tweet_id, len(text_list), None))
+                text_list.append(text)
+
+            async_result = pool.apply_async(clean_tweet_text_shard, (text_list, ))
+            pending_shards.append((shard_tweet_list, shard_entries, async_result))
+
+            if len(pending_shards) > 2*number_of_workers:
+                for tweet, attribute_list in merge_shard(*pending_shards.popleft()):
+                    yield tweet, attribute_list
+
+        while len(pending_shards) > 0:
+            for tweet, attribute_list in merge_shard(*pending_shards.popleft()):
+                yield tweet, attribute_list
+
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+
+class TweetGraphBuilder:
+    """
+    Encodes a tweet stream into mention and retweet graphs and a user-lemma matrix, incrementally.
 
-    Outputs: - mention_graph: The mention graph as a SciPy sparse matrix.
-             - user_id_set: A python set containing the Twitter ids for all the dataset users.
-             - node_to_id: A python dictionary that maps from node anonymized ids, to twitter user ids.
+    The tweets can be fed in several updates, e.g. only the tweets of the last hour at every hourly refresh. The node
+    (user) and attribute (lemma) ids of an update extend those of the previous updates and are never renumbered, so the
+    previous matrices are the top-left blocks of the updated ones, up to the counts of the new tweets. The state of the
+    builder can be stored to disk between updates.
     """
-    ####################################################################################################################
-    # Prepare for iterating over tweets.
-    ####################################################################################################################
-    # These are initialized as lists for incremental extension.
-    tweet_id_set = set()
-    user_id_set = list()
-    twitter_to_reveal_user_id = dict()
+    def __init__(self, number_of_workers=1, shard_size=1000, spill_folder=None, tweet_cache_size=2**16,
+                 extract_lemmas=True, vocabulary_file_path=None):
+        """
+        Inputs:  - number_of_workers: The number of text cleaning processes. Default: 1, i.e. clean in this process.
+                 - shard_size: The number of tweets in each shard sent to a worker process.
+                 - spill_folder: A folder where the sparse matrix coordinates of an update are spilled as they
+                                 accumulate. Default: None, i.e. keep them in memory.
+                 - tweet_cache_size: The number of recently seen tweet texts whose lemma attributes are kept, so that
+                                     the text of a popular tweet is not cleaned again for every retweet. Use 0 to disable.
+                 - extract_lemmas: If False, only the graphs are formed; the tweet texts are neither required nor
+                                   cleaned, and the user-lemma matrix stays empty.
+                 - vocabulary_file_path: A vocabulary file stored by MemoizedLemmatizer.store_vocabulary, with which
+                                         the lemmatizer caches are pre-warmed. Default: None, i.e. no pre-warming.
+        """
+        self.extract_lemmas = extract_lemmas
+        self.vocabulary_file_path = vocabulary_file_path
+        self.number_of_workers = number_of_workers
+        self.shard_size = shard_size
+        self.spill_folder = spill_folder
+
+        # Tweet ids are kept in a compact set.
+        self.tweet_id_set = IdInterner()
+
+        # Initialize compact maps keyed by Twitter user ids; every user in the dataset is a key of id_to_node.
+        self.id_to_node = IdInterner()
+        self.id_to_name = IdToStringMap()
+        self.id_to_username = IdToStringMap()
+        self.id_to_listedcount = IdInterner()
+        self.lemma_to_attribute = dict()
+
+        if tweet_cache_size > 0:
+            self.attribute_list_cache = TweetAttributeListCache(tweet_cache_size)
+        else:
+            self.attribute_list_cache = None
 
-    add_tweet_id = tweet_id_set.add
-    append_user_id = user_id_set.append
+        self.mention_graph = spsp.csr_matrix((0, 0), dtype=np.float64)
+        self.retweet_graph = spsp.csr_matrix((0, 0), dtype=np.float64)
+        self.user_lemma_matrix = spsp.csr_matrix((0, 0), dtype=np.float64)
 
-    # Initialize sparse matrix arrays.
-    mention_graph_row = list()
-    mention_graph_col = list()
+    def update(self, tweet_generator):
+        """
+        Adds new tweets to the graphs and the user-lemma matrix.
 
-    retweet_graph_row = list()
-    retweet_graph_col = list()
+        We assume that the tweets are given in increasing timestamp, also across updates.
 
-    append_mention_graph_row = mention_graph_row.append
-    append_mention_graph_col = mention_graph_col.append
+        Input:   - tweet_generator: A python generator of the new tweets in python dictionary (json) format.
 
-    append_retweet_graph_row = retweet_graph_row.append
-    append_retweet_graph_col = retweet_graph_col.append
+        Outputs: - mention_graph: The updated mention graph as a SciPy sparse matrix in CSR format.
+                 - retweet_graph: The updated retweet graph as a SciPy sparse matrix in CSR format.
+                 - user_lemma_matrix: The updated user lemma matrix as a SciPy sparse matrix in CSR format.
+        """
+        ################################################################################################################
+        # Prepare for iterating over tweets.
+        ################################################################################################################
+        tweet_id_set = self.tweet_id_set
 
-    # Initialize dictionaries.
-    id_to_node = dict()
-    id_to_name = dict()
-    id_to_username = dict()
-    id_to_listedcount = dict()
+        add_tweet_id = tweet_id_set.intern
 
-    ####################################################################################################################
-    # Iterate over tweets.
-    ####################################################################################################################
-    counter = 0
-    for tweet in tweet_generator:
-        # Increment tweet counter.
-        counter += 1
-        if counter % 10000 == 0:
-            print(counter)
-        # print(counter)
+        # Initialize sparse matrix coordinate buffers; every entry counts as one, so no data values are stored.
+        mention_graph_row = Int64Buffer(spill_folder=self.spill_folder)
+        mention_graph_col = Int64Buffer(spill_folder=self.spill_folder)
 
-        # Extract base tweet's values.
-        try:
-            tweet_id = tweet["id"]
-            user_id = tweet["user"]["id"]
-            user_screen_name = tweet["user"]["screen_name"]
-            user_name = tweet["user"]["name"]
+        retweet_graph_row = Int64Buffer(spill_folder=self.spill_folder)
+        retweet_graph_col = Int64Buffer(spill_folder=self.spill_folder)
 
-            listed_count_raw = tweet["user"]["listed_count"]
+        user_lemma_matrix_row = Int64Buffer(spill_folder=self.spill_folder)
+        user_lemma_matrix_col = Int64Buffer(spill_folder=self.spill_folder)
 
-            tweet_in_reply_to_user_id = tweet["in_reply_to_user_id"]
-            tweet_in_reply_to_screen_name = tweet["in_reply_to_screen_name"]
-            tweet_entities_user_mentions = tweet["entities"]["user_mentions"]
-        except KeyError:
-            continue
+        append_mention_graph_row = mention_graph_row.append
+        append_mention_graph_col = mention_graph_col.append
 
-        # Map users to distinct integer numbers.
-        graph_size = len(id_to_node)
-        source_node = id_to_node.setdefault(user_id, graph_size)
+        append_retweet_graph_row = retweet_graph_row.append
+        append_retweet_graph_col = retweet_graph_col.append
 
-        if listed_count_raw is None:
-            id_to_listedcount[user_id] = 0
-        else:
-            id_to_listedcount[user_id] = int(listed_count_raw)
+        extend_repeat_user_lemma_matrix_row = user_lemma_matrix_row.extend_repeat
+        extend_user_lemma_matrix_col = user_lemma_matrix_col.extend
 
-        # Update sets, lists and dictionaries.
-        add_tweet_id(tweet_id)
-        id_to_name[user_id] = user_screen_name
-        id_to_username[user_id] = user_name
-        append_user_id(user_id)
+        id_to_node = self.id_to_node
+        id_to_name = self.id_to_name
+        id_to_username = self.id_to_username
+        id_to_listedcount = self.id_to_listedcount
+        lemma_to_attribute = self.lemma_to_attribute
 
-        # twitter_to_user_id
+        # Each tweet comes along with the attributes of the lemmas of its text (or of the retweeted text).
+        tweet_fields_attribute_list_gen = self.get_tweet_fields_attribute_list_generator(tweet_generator)
 
         ################################################################################################################
-        # We are dealing with an original tweet.
+        # Iterate over tweets.
         ################################################################################################################
-        if "retweeted_status" not in tweet.keys():
-            ############################################################################################################
-            # Update mention matrix.
-            ############################################################################################################
-            # Get mentioned user ids.
-            mentioned_user_id_set = list()
-            if tweet_in_reply_to_user_id is not None:
-                mentioned_user_id_set.append(tweet_in_reply_to_user_id)
+        for tweet_fields, attribute_list in tweet_fields_attribute_list_gen:
+            tweet_id, user_id, user_screen_name, user_name, listed_count, mentioned_user_list,\
+                original_tweet_fields = tweet_fields
 
-                id_to_name[tweet_in_reply_to_user_id] = tweet_in_reply_to_screen_name
-            for user_mention in tweet_entities_user_mentions:
-                mentioned_user_id = user_mention["id"]  # TODO: Perhaps safe extract as well.
-                mentioned_user_id_set.append(mentioned_user_id)
+            # Map users to distinct integer numbers.
+            source_node, original_tweet_node, mention_target_node_list = get_tweet_graph_nodes(tweet_fields, id_to_node)
+
+            # Update sets, lists and dictionaries.
+            add_tweet_id(tweet_id)
+            id_to_name[user_id] = user_screen_name
+            id_to_username[user_id] = user_name
+            id_to_listedcount[user_id] = listed_count
+
+            ################################################################################################################
+            # We are dealing with an original tweet.
+            ################################################################################################################
+            if original_tweet_fields is None:
+                ############################################################################################################
+                # Update user-lemma frequency matrix.
+                ############################################################################################################
+                # The lemmas of the text have already been extracted and mapped to distinct integer numbers.
+                if attribute_list is not None:
+                    # Add values to the sparse matrix arrays.
+                    extend_repeat_user_lemma_matrix_row(source_node, len(attribute_list))
+                    extend_user_lemma_matrix_col(attribute_list)
 
-                id_to_name[mentioned_user_id] = user_mention["screen_name"]  # TODO: Perhaps safe extract as well.
+                ############################################################################################################
+                # Update mention matrix.
+                ############################################################################################################
+                for mentioned_user_id, mentioned_user_screen_name in mentioned_user_list:
+                    id_to_name[mentioned_user_id] = mentioned_user_screen_name
 
-            # We remove duplicates.
-            mentioned_user_id_set = set(mentioned_user_id_set)
+                # Update the mention graph one-by-one.
+                for mention_target_node in mention_target_node_list:
+                    # Add values to the sparse matrix arrays.
+                    append_mention_graph_row(source_node)
+                    append_mention_graph_col(mention_target_node)
+
+            ################################################################################################################
+            # We are dealing with a retweet.
+            ################################################################################################################
+            else:
+                original_tweet_id, original_tweet_user_id, original_tweet_user_screen_name, original_tweet_user_name,\
+                    original_tweet_listed_count, original_tweet_mentioned_user_list, _ = original_tweet_fields
 
-            # Update the mention graph one-by-one.
-            for mentioned_user_id in mentioned_user_id_set:
-                # Map users to distinct integer numbers.
-                graph_size = len(id_to_node)
-                mention_target_node = id_to_node.setdefault(mentioned_user_id, graph_size)
+                id_to_listedcount[original_tweet_user_id] = original_tweet_listed_count
 
-                append_user_id(mentioned_user_id)
+                # Update retweet graph.
+                append_retweet_graph_row(source_node)
+                append_retweet_graph_col(original_tweet_node)
 
-                # Add values to the sparse matrix arrays.
-                append_mention_graph_row(source_node)
-                append_mention_graph_col(mention_target_node)
+                # The lemmas of the original text have already been extracted and mapped to distinct integer numbers.
+                if attribute_list is not None:
+                    # Add values to the sparse matrix arrays.
+                    extend_repeat_user_lemma_matrix_row(source_node, len(attribute_list))
+                    extend_user_lemma_matrix_col(attribute_list)
+
+                for mentioned_user_id, mentioned_user_screen_name in original_tweet_mentioned_user_list:
+                    id_to_name[mentioned_user_id] = mentioned_user_screen_name
+
+                # Update the mention graph one-by-one.
+                for mention_target_node in mention_target_node_list:
+                    # Add values to the sparse matrix arrays.
+                    append_mention_graph_row(source_node)
+                    append_mention_graph_col(mention_target_node)
+
+                # This is the first time we deal with this tweet.
+                if original_tweet_id not in tweet_id_set:
+                    # Update sets, lists and dictionaries.
+                    add_tweet_id(original_tweet_id)
+                    id_to_name[original_tweet_user_id] = original_tweet_user_screen_name
+                    id_to_username[original_tweet_user_id] = original_tweet_user_name
+
+                    ########################################################################################################
+                    # Update user-lemma frequency matrix.
+                    ########################################################################################################
+                    if attribute_list is not None:
+                        # Add values to the sparse matrix arrays.
+                        extend_repeat_user_lemma_matrix_row(source_node, len(attribute_list))
+                        extend_user_lemma_matrix_col(attribute_list)
+
+                    ########################################################################################################
+                    # Update mention matrix.
+                    ########################################################################################################
+                    # Update the mention graph one-by-one.
+                    for mention_target_node in mention_target_node_list:
+                        # Add values to the sparse matrix arrays.
+                        append_mention_graph_row(original_tweet_node)
+                        append_mention_graph_col(mention_target_node)
 
         ################################################################################################################
-        # We are dealing with a retweet.
+        # Add the counts of the new tweets to the matrices.
         ################################################################################################################
+        number_of_users = len(id_to_node)
+        number_of_lemmas = len(lemma_to_attribute)
+
+        self.mention_graph = extend_count_matrix(self.mention_graph, mention_graph_row, mention_graph_col,
+                                                 shape=(number_of_users, number_of_users))
+        mention_graph_row.close()
+        mention_graph_col.close()
+
+        self.retweet_graph = extend_count_matrix(self.retweet_graph, retweet_graph_row, retweet_graph_col,
+                                                 shape=(number_of_users, number_of_users))
+        retweet_graph_row.close()
+        retweet_graph_col.close()
+
+        self.user_lemma_matrix = extend_count_matrix(self.user_lemma_matrix, user_lemma_matrix_row, user_lemma_matrix_col,
+                                                     shape=(number_of_users, number_of_lemmas))
+        user_lemma_matrix_row.close()
+        user_lemma_matrix_col.close()
+
+        return self.mention_graph, self.retweet_graph, self.user_lemma_matrix
+
+    def get_tweet_fields_attribute_list_generator(self, tweet_generator):
+        """
+        Yields the graph fields of the valid tweets, along with the lemma attributes of their texts.
+
+        The tweets are validated by get_tweet_graph_fields before their texts are cleaned. If lemmas are extracted, the
+        tweets without a text are also skipped; otherwise, the attribute list is always None.
+        """
+        if not self.extract_lemmas:
+            for tweet in tweet_generator:
+                tweet_fields = get_tweet_graph_fields(tweet)
+                if tweet_fields is not None:
+                    yield tweet_fields, None
+            return
+
+        # Both attribute list generators yield their input tweets in order, so the fields are queued alongside.
+        tweet_fields_queue = collections.deque()
+
+        def valid_tweet_generator():
+            for tweet in tweet_generator:
+                tweet_fields = get_tweet_graph_fields(tweet)
+                if tweet_fields is not None:
+                    tweet_fields_queue.append(tweet_fields)
+                    yield tweet
+
+        if self.number_of_workers > 1:
+            tweet_attribute_list_gen = get_tweet_attribute_lists_parallel_generator(valid_tweet_generator(),
+                                                                                    self.lemma_to_attribute,
+                                                                                    self.number_of_workers,
+                                                                                    self.shard_size,
+                                                                                    self.attribute_list_cache,
+                                                                                    self.vocabulary_file_path)
         else:
-            # Extract base tweet's values.
-            original_tweet = tweet["retweeted_status"]
+            tweet_attribute_list_gen = get_tweet_attribute_lists_serial_generator(valid_tweet_generator(),
+                                                                                  self.lemma_to_attribute,
+                                                                                  self.attribute_list_cache,
+                                                                                  self.vocabulary_file_path)
+
+        for tweet, attribute_list in tweet_attribute_list_gen:
+            tweet_fields = tweet_fields_queue.popleft()
+            if attribute_list is not None:
+                yield tweet_fields, attribute_list
+
+    def get_node_to_id(self):
+        """
+        Returns a numpy array that maps from node anonymized ids, to twitter user ids.
+        """
+        return self.id_to_node.get_node_to_id()
+
+    def store(self, file_path):
+        """
+        Stores a snapshot of the builder; it can be loaded with load_tweet_graph_builder and then updated further.
+        """
+        store_pickle_atomically(file_path, self)
+
+
+def load_tweet_graph_builder(file_path):
+    """
+    Loads a TweetGraphBuilder snapshot that was stored with TweetGraphBuilder.store.
+    """
+    builder = load_pickle(file_path)
+    if not isinstance(builder, TweetGraphBuilder):
+        print("Invalid tweet graph builder snapshot.")
+        raise RuntimeError
+    return builder
 
-            try:
-                original_tweet_id = original_tweet["id"]
-                original_tweet_user_id = original_tweet["user"]["id"]
-                original_tweet_user_screen_name = original_tweet["user"]["screen_name"]
-                original_tweet_user_name = original_tweet["user"]["name"]
 
-                listed_count_raw = original_tweet["user"]["listed_count"]
+def extract_graphs_and_lemmas_from_tweets(tweet_generator, number_of_workers=1, shard_size=1000, spill_folder=None,
+                                          tweet_cache_size=2**16, vocabulary_file_path=None):
+    """
+    Given a tweet python generator, we encode the information into mention and retweet graphs and a lemma matrix.
 
-                original_tweet_in_reply_to_user_id = original_tweet["in_reply_to_user_id"]
-                original_tweet_in_reply_to_screen_name = original_tweet["in_reply_to_screen_name"]
-                original_tweet_entities_user_mentions = original_tweet["entities"]["user_mentions"]
-            except KeyError:
-                continue
+    We assume that the tweets are given in increasing timestamp.
 
-            # Map users to distinct integer numbers.
-            graph_size = len(id_to_node)
-            original_tweet_node = id_to_node.setdefault(original_tweet_user_id, graph_size)
+    To add new tweets to previously extracted graphs later on, use a TweetGraphBuilder instead.
 
-            if listed_count_raw is None:
-                id_to_listedcount[original_tweet_user_id] = 0
-            else:
-                id_to_listedcount[original_tweet_user_id] = int(listed_count_raw)
+    Text cleaning dominates the running time. If more than one worker is requested, the tweet stream is sharded and
+    the tweet texts are cleaned in a pool of processes; the results are identical to the serial ones.
 
-            # Update retweet graph.
-            append_retweet_graph_row(source_node)
-            append_retweet_graph_col(original_tweet_node)
+    Inputs:  - tweet_generator: A python generator of tweets in python dictionary (json) format. Slim tweet records,
+                                as made by store_snow_data.get_slim_tweet, suffice.
+             - number_of_workers: The number of text cleaning processes. Default: 1, i.e. clean in this process.
+             - shard_size: The number of tweets in each shard sent to a worker process.
+             - spill_folder: A folder where the sparse matrix coordinates are spilled as they accumulate, so that
+                             graphs larger than the main memory can be built. Default: None, i.e. keep them in memory.
+             - tweet_cache_size: The number of recently seen tweet texts whose lemma attributes are kept, so that the
+                                 text of a popular tweet is not cleaned again for every retweet. Use 0 to disable.
+             - vocabulary_file_path: An optional vocabulary file with which the lemmatizer caches are pre-warmed.
 
-            # Get mentioned user ids.
-            mentioned_user_id_set = list()
-            if original_tweet_in_reply_to_user_id is not None:
-                mentioned_user_id_set.append(original_tweet_in_reply_to_user_id)
+    Outputs: - mention_graph: The mention graph as a SciPy sparse matrix.
+             - retweet_graph: The retweet graph as a SciPy sparse matrix.
+             - user_lemma_matrix: The user lemma vector representation matrix as a SciPy sparse matrix.
+             - tweet_id_set: A set-like view of the Twitter ids of all the dataset tweets.
+             - user_id_set: A set-like view of the Twitter ids of all the dataset users.
+             - node_to_id: A numpy array that maps from node anonymized ids, to twitter user ids.
+             - lemma_to_attribute: A map from lemmas to numbers in python dictionary format.
+             - id_to_name: A compact mapping from Twitter user ids to screen names.
+             - id_to_username: A compact mapping from Twitter user ids to user names.
+             - id_to_listedcount: A compact mapping from Twitter user ids to listed counts.
+    """
+    builder = TweetGraphBuilder(number_of_workers=number_of_workers,
+                                shard_size=shard_size,
+                                spill_folder=spill_folder,
+                                tweet_cache_size=tweet_cache_size,
+                                vocabulary_file_path=vocabulary_file_path)
+    mention_graph, retweet_graph, user_lemma_matrix = builder.update(tweet_generator)
 
-                id_to_name[original_tweet_in_reply_to_user_id] = original_tweet_in_reply_to_screen_name
-            for user_mention in original_tweet_entities_user_mentions:
-                mentioned_user_id = user_mention["id"]  # TODO: Perhaps safe extract as well.
-                mentioned_user_id_set.append(mentioned_user_id)
+    ####################################################################################################################
+    # Final steps of preprocessing tweets.
+    ####################################################################################################################
+    mention_graph = spsp.coo_matrix(mention_graph)
+    retweet_graph = spsp.coo_matrix(retweet_graph)
+    user_lemma_matrix = spsp.coo_matrix(user_lemma_matrix)
 
-                id_to_name[mentioned_user_id] = user_mention["screen_name"]  # TODO: Perhaps safe extract as well.
+    # All the users have been mapped to nodes.
+    tweet_id_set = builder.tweet_id_set.keys()
+    user_id_set = builder.id_to_node.keys()
+    node_to_id = builder.get_node_to_id()
 
-            # We remove duplicates.
-            mentioned_user_id_set = set(mentioned_user_id_set)
+    return mention_graph, retweet_graph, user_lemma_matrix, tweet_id_set, user_id_set, node_to_id,\
+        builder.lemma_to_attribute, builder.id_to_name, builder.id_to_username, builder.id_to_listedcount
 
-            # Get mentioned user ids.
-            retweet_mentioned_user_id_set = list()
-            if original_tweet_in_reply_to_user_id is not None:
-                retweet_mentioned_user_id_set.append(original_tweet_in_reply_to_user_id)
 
-                id_to_name[original_tweet_in_reply_to_user_id] = original_tweet_in_reply_to_screen_name
-            for user_mention in original_tweet_entities_user_mentions:
-                mentioned_user_id = user_mention["id"]  # TODO: Perhaps safe extract as well.
-                retweet_mentioned_user_id_set.append(mentioned_user_id)
+def extract_graphs_from_tweets(tweet_generator, spill_folder=None):
+    """
+    Given a tweet python generator, we encode the information into mention and retweet graphs.
 
-                id_to_name[mentioned_user_id] = user_mention["screen_name"]  # TODO: Perhaps safe extract as well.
+    We assume that the tweets are given in increasing timestamp.
 
-            # We remove duplicates.
-            retweet_mentioned_user_id_set = set(retweet_mentioned_user_id_set)
+    Inputs:  - tweet_generator: A python generator of tweets in python dictionary (json) format. Slim tweet records,
+                                as made by store_snow_data.get_slim_tweet, suffice.
+             - spill_folder: A folder where the sparse matrix coordinates are spilled as they accumulate, so that
+                             graphs larger than the main memory can be built. Default: None, i.e. keep them in memory.
 
-            mentioned_user_id_set.update(retweet_mentioned_user_id_set)
+    Outputs: - mention_graph: The mention graph as a SciPy sparse matrix.
+             - retweet_graph: The retweet graph as a SciPy sparse matrix.
+             - tweet_id_set: A set-like view of the Twitter ids of all the dataset tweets.
+             - user_id_set: A set-like view of the Twitter ids of all the dataset users.
+             - node_to_id: A numpy array that maps from node anonymized ids, to twitter user ids.
+             - id_to_name: A compact mapping from Twitter user ids to screen names.
+             - id_to_username: A compact mapping from Twitter user ids to user names.
+             - id_to_listedcount: A compact mapping from Twitter user ids to listed counts.
+    """
+    builder = TweetGraphBuilder(spill_folder=spill_folder, extract_lemmas=False)
+    mention_graph, retweet_graph, user_lemma_matrix = builder.update(tweet_generator)
 
-            # Update the mention graph one-by-one.
-            for mentioned_user_id in mentioned_user_id_set:
-                # Map users to distinct integer numbers.
-                graph_size = len(id_to_node)
-                mention_target_node = id_to_node.setdefault(mentioned_user_id, graph_size)
+    ####################################################################################################################
+    # Final steps of preprocessing tweets.
+    ####################################################################################################################
+    mention_graph = spsp.coo_matrix(mention_graph)
+    retweet_graph = spsp.coo_matrix(retweet_graph)
 
-                append_user_id(mentioned_user_id)
+    # All the users have been mapped to nodes.
+    tweet_id_set = builder.tweet_id_set.keys()
+    user_id_set = builder.id_to_node.keys()
+    node_to_id = builder.get_node_to_id()
 
-                # Add values to the sparse matrix arrays.
-                append_mention_graph_row(source_node)
-                append_mention_graph_col(mention_target_node)
+    return mention_graph, retweet_graph, tweet_id_set, user_id_set, node_to_id,\
+        builder.id_to_name, builder.id_to_username, builder.id_to_listedcount
 
-            # This is the first time we deal with this tweet.
-            if original_tweet_id not in tweet_id_set:
-                # Update sets, lists and dictionaries.
-                add_tweet_id(original_tweet_id)
-                id_to_name[original_tweet_user_id] = original_tweet_user_screen_name
-                id_to_username[original_tweet_user_id] = original_tweet_user_name
-                append_user_id(original_tweet_user_id)
 
-                ########################################################################################################
-                # Update mention matrix.
-                ########################################################################################################
-                # Update the mention graph one-by-one.
-                for mentioned_user_id in retweet_mentioned_user_id_set:
-                    # Map users to distinct integer numbers.
-                    graph_size = len(id_to_node)
-                    mention_target_node = id_to_node.setdefault(mentioned_user_id, graph_size)
+def get_tweet_timestamp(tweet):
+    """
+    Returns the creation time of a tweet in seconds since the epoch.
 
-                    append_user_id(mentioned_user_id)
+    Input:  - tweet: A tweet in python dictionary (json) format. The "created_at" field may be in the Twitter API format,
+                     e.g. "Wed Aug 27 13:08:45 +0000 2008", a python datetime as stored by MongoDB, or a number of seconds.
 
-                    # Add values to the sparse matrix arrays.
-                    append_mention_graph_row(original_tweet_node)
-                    append_mention_graph_col(mention_target_node)
-            else:
-                pass
+    Output: - timestamp: The creation time of the tweet in integer seconds.
+    """
+    created_at = tweet["created_at"]
+    if isinstance(created_at, datetime.datetime):
+        if created_at.tzinfo is None:
+            # MongoDB returns naive UTC datetimes.
+            return calendar.timegm(created_at.timetuple())
+        return int(created_at.timestamp())
+    elif isinstance(created_at, (int, float)):
+        return int(created_at)
+    else:
+        return int(datetime.datetime.strptime(created_at, "%a %b %d %H:%M:%S %z %Y").timestamp())
 
-    ####################################################################################################################
-    # Final steps of preprocessing tweets.
-    ####################################################################################################################
-    # Discard any duplicates.
-    user_id_set = set(user_id_set)
-    number_of_users = len(user_id_set)
-    # min_number_of_users = max(user_id_set) + 1
 
-    # Form mention graph adjacency matrix.
-    mention_graph_row = np.array(mention_graph_row, dtype=np.int64)
-    mention_graph_col = np.array(mention_graph_col, dtype=np.int64)
-    mention_graph_data = np.ones_like(mention_graph_row, dtype=np.float64)
+class WindowedTweetGraph:
+    """
+    Maintains the mention and retweet graphs of the tweets of a sliding time window, e.g. of the last 7 days.
+
+    Every edge keeps the creation time of the tweet it came from. As new tweets arrive, the edges that are older than
+    the horizon with respect to the latest tweet expire. Only the counts of the arriving and expiring edges are updated,
+    so the graphs need not be rebuilt from the whole window at every refresh.
+
+    The graphs are the ones that extract_graphs_from_tweets would extract from the tweets of the window. There, the
+    mentions of an original tweet are added once, whether the tweet itself or only its retweets are within the window;
+    here they are kept for as long as the tweet or any of its retweets is. Nodes are never renumbered, so a user whose
+    edges have all expired keeps their node as an isolated one.
+    """
+    def __init__(self, horizon=7*24*60*60):
+        """
+        Input:  - horizon: The length of the time window in seconds. Default: 7 days.
+        """
+        self.horizon = horizon
+        self.latest_time = None
+
+        self.id_to_node = IdInterner()
+
+        # Maps the original tweets within the window to the time they were last seen, themselves or retweeted, and to
+        # the mention edges of their authors; ordered by that time.
+        self.tweet_id_to_mentions = collections.OrderedDict()
+
+        self.mention_counts = TimedCountMatrix()
+        self.retweet_counts = TimedCountMatrix()
+
+    def update(self, tweet_generator):
+        """
+        Adds new tweets to the window and expires the edges that fall out of it.
 
-    mention_graph = spsp.coo_matrix((mention_graph_data, (mention_graph_row, mention_graph_col)),
-                                    shape=(number_of_users, number_of_users))
-    mention_graph = spsp.coo_matrix(spsp.csr_matrix(mention_graph))
+        We assume that the tweets are given in increasing timestamp, also with respect to previous updates.
 
-    # Form retweet graph adjacency matrix.
-    retweet_graph_row = np.array(retweet_graph_row, dtype=np.int64)
-    retweet_graph_col = np.array(retweet_graph_col, dtype=np.int64)
-    retweet_graph_data = np.ones_like(retweet_graph_row, dtype=np.float64)
+        Input:  - tweet_generator: A python generator of tweets in python dictionary (json) format.
 
-    retweet_graph = spsp.coo_matrix((retweet_graph_data, (retweet_graph_row, retweet_graph_col)),
-                                    shape=(number_of_users, number_of_users))
-    retweet_graph = spsp.coo_matrix(spsp.csr_matrix(retweet_graph))
+        Outputs: - number_of_new_edges: The number of mention and retweet edges that were added.
+                 - number_of_expired_edges: The number of mention and retweet edges that expired.
+        """
+        id_to_node = self.id_to_node
+        tweet_id_to_mentions = self.tweet_id_to_mentions
 
-    node_to_id = dict(zip(id_to_node.values(), id_to_node.keys()))
+        # The mentions of retweets expire with the retweets.
+        mention_graph_time = Int64Buffer()
+        mention_graph_row = Int64Buffer()
+        mention_graph_col = Int64Buffer()
 
-    return mention_graph, retweet_graph, tweet_id_set, user_id_set, node_to_id, id_to_name, id_to_username, id_to_listedcount
+        retweet_graph_time = Int64Buffer()
+        retweet_graph_row = Int64Buffer()
+        retweet_graph_col = Int64Buffer()
+
+        # The mentions of original tweets expire when the tweets are last seen.
+        original_mention_graph_row = Int64Buffer()
+        original_mention_graph_col = Int64Buffer()
+
+        def see_original_tweet(original_tweet_id, original_tweet_node, mention_target_node_list, tweet_time):
+            try:
+                tweet_id_to_mentions[original_tweet_id][0] = tweet_time
+                tweet_id_to_mentions.move_to_end(original_tweet_id)
+            except KeyError:
+                tweet_id_to_mentions[original_tweet_id] = [tweet_time,
+                                                           original_tweet_node,
+                                                           np.array(mention_target_node_list, dtype=np.int64)]
+                original_mention_graph_row.extend_repeat(original_tweet_node, len(mention_target_node_list))
+                original_mention_graph_col.extend(mention_target_node_list)
+
+        for tweet in tweet_generator:
+            tweet_fields = get_tweet_graph_fields(tweet)
+            if tweet_fields is None:
+                continue
+            try:
+                tweet_time = get_tweet_timestamp(tweet)
+            except (KeyError, ValueError):
+                continue
+
+            source_node, original_tweet_node, mention_target_node_list = get_tweet_graph_nodes(tweet_fields, id_to_node)
+
+            original_tweet_fields = tweet_fields[6]
+            if original_tweet_fields is None:
+                see_original_tweet(tweet_fields[0], source_node, mention_target_node_list, tweet_time)
+            else:
+                retweet_graph_time.append(tweet_time)
+                retweet_graph_row.append(source_node)
+                retweet_graph_col.append(original_tweet_node)
+
+                for mention_target_node in mention_target_node_list:
+                    mention_graph_time.append(tweet_time)
+                    mention_graph_row.append(source_node)
+                    mention_graph_col.append(mention_target_node)
+
+                see_original_tweet(original_tweet_fields[0], original_tweet_node, mention_target_node_list, tweet_time)
+
+            if self.latest_time is None or tweet_time > self.latest_time:
+                self.latest_time = tweet_time
+
+        number_of_new_edges = len(mention_graph_time) + len(retweet_graph_time) + len(original_mention_graph_row)
+
+        self.mention_counts.add_events(mention_graph_time.to_array(),
+                                       mention_graph_row.to_array(),
+                                       mention_graph_col.to_array())
+        self.mention_counts.add_counts(original_mention_graph_row.to_array(),
+                                       original_mention_graph_col.to_array(),
+                                       1.0)
+        self.retweet_counts.add_events(retweet_graph_time.to_array(),
+                                       retweet_graph_row.to_array(),
+                                       retweet_graph_col.to_array())
+        for buffer in (mention_graph_time, mention_graph_row, mention_graph_col,
+                       retweet_graph_time, retweet_graph_row, retweet_graph_col,
+                       original_mention_graph_row, original_mention_graph_col):
+            buffer.close()
+
+        number_of_expired_edges = 0
+        if self.latest_time is not None:
+            number_of_expired_edges = self.expire(self.latest_time - self.horizon)
+
+        return number_of_new_edges, number_of_expired_edges
+
+    def expire(self, cutoff_time):
+        """
+        Expires the edges of the tweets that were created before a cutoff time, e.g. when no tweets arrive for a while.
+
+        Input:  - cutoff_time: A time in seconds since the epoch.
+
+        Output: - number_of_expired_edges: The number of mention and retweet edges that expired.
+        """
+        tweet_id_to_mentions = self.tweet_id_to_mentions
+
+        expired_row_list = list()
+        expired_col_list = list()
+        while len(tweet_id_to_mentions) > 0:
+            tweet_time, original_tweet_node, mention_target_nodes = next(iter(tweet_id_to_mentions.values()))
+            if tweet_time >= cutoff_time:
+                break
+            tweet_id_to_mentions.popitem(last=False)
+            expired_row_list.append(np.repeat(np.int64(original_tweet_node), mention_target_nodes.size))
+            expired_col_list.append(mention_target_nodes)
+
+        number_of_expired_edges = 0
+        if len(expired_row_list) > 0:
+            expired_rows = np.concatenate(expired_row_list)
+            self.mention_counts.add_counts(expired_rows, np.concatenate(expired_col_list), -1.0)
+            number_of_expired_edges += expired_rows.size
+
+        number_of_expired_edges += self.mention_counts.expire(cutoff_time)
+        number_of_expired_edges += self.retweet_counts.expire(cutoff_time)
+        return number_of_expired_edges
+
+    def get_graphs(self):
+        """
+        Returns the graphs of the current window.
+
+        Outputs: - mention_graph: The mention graph as a SciPy sparse CSR matrix.
+                 - retweet_graph: The retweet graph as a SciPy sparse CSR matrix.
+        """
+        number_of_users = len(self.id_to_node)
+        mention_graph = self.mention_counts.get_matrix((number_of_users, number_of_users))
+        retweet_graph = self.retweet_counts.get_matrix((number_of_users, number_of_users))
+        return mention_graph, retweet_graph
+
+    def get_node_to_id(self):
+        """
+        Returns a numpy array that maps from node anonymized ids, to twitter user ids.
+        """
+        return self.id_to_node.get_node_to_id()
 
 
 def extract_connected_components(graph, connectivity_type, node_to_id):
@@ -771,38 +1140,41 @@ def extract_connected_components(graph, connectivity_type, node_to_id):
 
     Inputs:  - graph: An adjacency matrix in scipy sparse matrix format.
              - connectivity_type: A string that can be either: "strong" or "weak".
-             - node_to_id: A map from graph node id to Twitter id, in python dictionary format.
+             - node_to_id: A map from graph node id to Twitter id, in python dictionary or numpy array format.
 
     Outputs: - largest_connected_component: An adjacency matrix in scipy sparse matrix format.
              - new_node_to_id: A map from graph node id to Twitter id, in python dictionary format.
-             - old_node_list: List of nodes from the possibly disconnected original graph.
+             - old_node_list: Numpy array of the nodes (in increasing order) from the possibly disconnected original
+                              graph; new node i corresponds to old node old_node_list[i].
 
     Raises:  - RuntimeError: If there the input graph is empty.
     """
-    # Get a networkx graph.
-    nx_graph = nx.from_scipy_sparse_matrix(graph, create_using=nx.DiGraph())
-
-    # Calculate all connected components in graph.
-    if connectivity_type == "weak":
-        largest_connected_component_list = nxalgcom.weakly_connected_component_subgraphs(nx_graph)
-    elif connectivity_type == "strong":
-        largest_connected_component_list = nxalgcom.strongly_connected_component_subgraphs(nx_graph)
-    else:
+    if connectivity_type not in ("weak", "strong"):
         print("Invalid connectivity type input.")
         raise RuntimeError
 
     # Handle empty graph.
-    try:
-        largest_connected_component = max(largest_connected_component_list, key=len)
-    except ValueError:
+    graph = spsp.csr_matrix(graph)
+    if graph.shape[0] == 0:
         print("Error: Empty graph.")
         raise RuntimeError
 
-    old_node_list = largest_connected_component.nodes()
-    node_to_node = dict(zip(np.arange(len(old_node_list)), old_node_list))
-    largest_connected_component = nx.to_scipy_sparse_matrix(largest_connected_component, dtype=np.float64, format="csr")
+    # Calculate all connected components in graph.
+    number_of_components, component_labels = spspcsgraph.connected_components(graph,
+                                                                              directed=True,
+                                                                              connection=connectivity_type)
+
+    # Select the largest one.
+    largest_component_label = np.argmax(np.bincount(component_labels, minlength=number_of_components))
+    old_node_list = np.flatnonzero(component_labels == largest_component_label)
+
+    largest_connected_component = graph[old_node_list, :][:, old_node_list]
+    largest_connected_component = spsp.csr_matrix(largest_connected_component, dtype=np.float64)
 
     # Make node_to_id.
-    new_node_to_id = {k: node_to_id[v] for k, v in node_to_node.items()}
+    if isinstance(node_to_id, np.ndarray):
+        new_node_to_id = dict(enumerate(node_to_id[old_node_list].tolist()))
+    else:
+        new_node_to_id = {k: node_to_id[v] for k, v in enumerate(old_node_list.tolist())}
 
     return largest_connected_component, new_node_to_id, old_node_list
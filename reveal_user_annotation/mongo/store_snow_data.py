@@ -1,48 +1,460 @@
 __author__ = 'Georgios Rizos (georgerizos@iti.gr)'
 
 import pymongo
+from pymongo.errors import BulkWriteError
+import multiprocessing as mp
+import concurrent.futures
 import json
 import os
+import time
+import io
+import gzip
+import bz2
+import lzma
+import threading
+import queue
+import importlib
 
+from reveal_user_annotation.text.map_data import split_every
 
-def extract_snow_tweets_from_file_generator(json_file_path):
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The errors raised when a file is not actually compressed in the format its extension suggests.
+if zstandard is None:
+    DECOMPRESSION_ERRORS = (OSError, EOFError, ValueError)
+else:
+    DECOMPRESSION_ERRORS = (OSError, EOFError, ValueError, zstandard.ZstdError)
+
+COMPRESSED_FILE_EXTENSIONS = (".gz", ".bz2", ".xz", ".lzma", ".zst")
+
+
+########################################################################################################################
+# Tweet decoding.
+########################################################################################################################
+def get_json_decoder(decoder_name=None):
+    """
+    Returns a function that decodes a JSON document from a line of bytes.
+
+    Input:  - decoder_name: "orjson", "ujson" or "json". Default: None, i.e. the fastest one that is installed.
+
+    Output: - json_loads: A function that takes a bytes object and returns the decoded python object.
+    """
+    if decoder_name is None:
+        for decoder_name in ("orjson", "ujson", "json"):
+            try:
+                return get_json_decoder(decoder_name)
+            except ImportError:
+                continue
+
+    if decoder_name in ("orjson", "ujson"):
+        return importlib.import_module(decoder_name).loads
+    elif decoder_name == "json":
+        return lambda line: json.loads(line.decode("utf-8"))
+    else:
+        print("Invalid JSON decoder.")
+        raise RuntimeError
+
+
+SLIM_TWEET_USER_FIELDS = ("id", "screen_name", "name", "listed_count")
+SLIM_TWEET_USER_MENTION_FIELDS = ("id", "screen_name")
+
+
+def get_slim_tweet(tweet):
+    """
+    Keeps only the tweet fields that the graph and lemma extractors read, in the same nested layout.
+
+    The slim record holds the id, creation time, text, reply and user mention fields, the id, names and listed count of
+    the user, and the slim record of the retweeted tweet, if any. Fields that are missing in the tweet stay missing.
+
+    Input:  - tweet: A tweet in python dictionary (json) format.
+
+    Output: - slim_tweet: A slim tweet in python dictionary (json) format.
+    """
+    slim_tweet = dict()
+    for field in ("id", "created_at", "text", "in_reply_to_user_id", "in_reply_to_screen_name"):
+        if field in tweet:
+            slim_tweet[field] = tweet[field]
+
+    user = tweet.get("user")
+    if isinstance(user, dict):
+        slim_tweet["user"] = {field: user[field] for field in SLIM_TWEET_USER_FIELDS if field in user}
+
+    entities = tweet.get("entities")
+    if isinstance(entities, dict):
+        slim_tweet["entities"] = slim_entities = dict()
+        if "user_mentions" in entities:
+            slim_entities["user_mentions"] = [{field: user_mention[field]
+                                               for field in SLIM_TWEET_USER_MENTION_FIELDS if field in user_mention}
+                                              for user_mention in entities["user_mentions"]]
+
+    if "retweeted_status" in tweet:
+        slim_tweet["retweeted_status"] = get_slim_tweet(tweet["retweeted_status"])
+
+    return slim_tweet
+
+
+########################################################################################################################
+# Transparent decompression of tweet files.
+########################################################################################################################
+def open_binary_file(file_path):
+    """
+    Opens a file for reading, decompressing it on the fly according to its extension.
+
+    Input:  - file_path: The path of a plain, gzip (.gz), bzip2 (.bz2), xz (.xz, .lzma) or zstandard (.zst) file.
+
+    Output: - binary_file: A binary file object with the decompressed contents.
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == ".gz":
+        return gzip.open(file_path, "rb")
+    elif extension == ".bz2":
+        return bz2.open(file_path, "rb")
+    elif extension in (".xz", ".lzma"):
+        return lzma.open(file_path, "rb")
+    elif extension == ".zst":
+        if zstandard is None:
+            print("Reading .zst files requires the zstandard package.")
+            raise RuntimeError
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(file_path, "rb"), closefd=True))
+    else:
+        return open(file_path, "rb")
+
+
+class DecompressionThreadReader(io.RawIOBase):
+    """
+    Reads a decompressing file object in a background thread, so that decompression overlaps with parsing.
+
+    The gzip, bzip2, xz and zstandard decompressors release the GIL while they work, so the thread runs in parallel
+    with the JSON parsing of the previous blocks. A bounded queue of blocks keeps the memory use in check.
+    """
+    def __init__(self, binary_file, block_size=2**20, queue_size=8):
+        """
+        Inputs: - binary_file: A binary file object, e.g. as returned by open_binary_file.
+                - block_size: The number of decompressed bytes in each block.
+                - queue_size: The maximum number of blocks decompressed ahead of the reader.
+        """
+        super().__init__()
+        self.binary_file = binary_file
+        self.block_size = block_size
+
+        self.block_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.current_block = memoryview(b"")
+        self.is_exhausted = False
+
+        self.thread = threading.Thread(target=self.decompress_blocks)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def decompress_blocks(self):
+        try:
+            while not self.stop_event.is_set():
+                block = self.binary_file.read(self.block_size)
+                self.put_block(block)
+                if len(block) == 0:
+                    break
+        except Exception as e:
+            # The exception is raised again in the reading thread.
+            self.put_block(e)
+
+    def put_block(self, block):
+        while not self.stop_event.is_set():
+            try:
+                self.block_queue.put(block, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self.current_block) == 0:
+            if self.is_exhausted:
+                return 0
+            block = self.block_queue.get()
+            if isinstance(block, Exception):
+                self.is_exhausted = True
+                raise block
+            if len(block) == 0:
+                self.is_exhausted = True
+                return 0
+            self.current_block = memoryview(block)
+
+        number_of_bytes = min(len(buffer), len(self.current_block))
+        buffer[:number_of_bytes] = self.current_block[:number_of_bytes]
+        self.current_block = self.current_block[number_of_bytes:]
+        return number_of_bytes
+
+    def close(self):
+        if not self.closed:
+            self.stop_event.set()
+            self.thread.join()
+            self.binary_file.close()
+        super().close()
+
+
+def extract_snow_tweets_from_file_generator(json_file_path, threaded_decompression_size=2**24, json_decoder=None,
+                                            slim=False):
     """
     A generator that opens a file containing many json tweets and yields all the tweets contained inside.
 
-    Input:  - json_file_path: The path of a json file containing a tweet in each line.
+    Compressed files are decompressed on the fly; the large ones in a background thread.
+
+    Input:  - json_file_path: The path of a json file containing a tweet in each line, possibly compressed.
+            - threaded_decompression_size: Compressed files of at least that many bytes are decompressed in a
+                                           background thread.
+            - json_decoder: "orjson", "ujson" or "json". Default: None, i.e. the fastest one that is installed.
+            - slim: If True, slim tweet records are yielded instead; see get_slim_tweet.
 
     Yields: - tweet: A tweet in python dictionary (json) format.
     """
-    with open(json_file_path, "r", encoding="utf-8") as fp:
+    json_loads = get_json_decoder(json_decoder)
+
+    binary_file = open_binary_file(json_file_path)
+    if json_file_path.lower().endswith(COMPRESSED_FILE_EXTENSIONS) and\
+            os.path.getsize(json_file_path) >= threaded_decompression_size:
+        binary_file = io.BufferedReader(DecompressionThreadReader(binary_file))
+
+    with binary_file as fp:
         for file_line in fp:
-            tweet = json.loads(file_line)
+            if file_line.isspace():
+                continue
+            tweet = json_loads(file_line)
+            if slim:
+                tweet = get_slim_tweet(tweet)
             yield tweet
 
 
-def extract_all_snow_tweets_from_disk_generator(json_folder_path):
+def is_snow_tweet_file(file_path):
+    """
+    Checks whether a file holds tweets, i.e. it is a regular, non-hidden file whose contents begin with a JSON object.
+
+    Input:  - file_path: The path of a plain or compressed file.
+
+    Output: - True if the file is a tweet file, False otherwise, e.g. for a README or a checksum file.
+    """
+    if os.path.basename(file_path).startswith(".") or not os.path.isfile(file_path):
+        return False
+
+    try:
+        with open_binary_file(file_path) as binary_file:
+            head = binary_file.read(4096)
+    except RuntimeError:
+        # A .zst file, while the zstandard package is not installed.
+        return False
+    except DECOMPRESSION_ERRORS:
+        return False
+    return head.lstrip(b"\xef\xbb\xbf \t\r\n").startswith(b"{")
+
+
+def get_snow_tweet_file_paths(json_folder_path):
+    """
+    Returns the paths of the tweet files in a SNOW tweet folder, in sorted order; other files are skipped.
+
+    Input:  - json_folder_path: The path of the folder containing the raw data.
+
+    Output: - json_file_path_list: A python list of file paths.
+    """
+    json_file_path_list = list()
+    for name in sorted(os.listdir(json_folder_path)):
+        json_file_path = os.path.join(json_folder_path, name)
+        if is_snow_tweet_file(json_file_path):
+            json_file_path_list.append(json_file_path)
+        else:
+            print("Skipping non-data file:", json_file_path)
+    return json_file_path_list
+
+
+def extract_all_snow_tweets_from_disk_generator(json_folder_path, json_decoder=None, slim=False):
     """
     A generator that returns all SNOW tweets stored in disk.
 
     Input:  - json_file_path: The path of the folder containing the raw data.
+            - json_decoder: "orjson", "ujson" or "json". Default: None, i.e. the fastest one that is installed.
+            - slim: If True, slim tweet records are yielded instead; see get_slim_tweet.
 
     Yields: - tweet: A tweet in python dictionary (json) format.
     """
-    # Get a generator with all file paths in the folder
-    json_file_path_generator = (json_folder_path + "/" + name for name in os.listdir(json_folder_path))
-
-    for path in json_file_path_generator:
-        for tweet in extract_snow_tweets_from_file_generator(path):
+    for path in get_snow_tweet_file_paths(json_folder_path):
+        for tweet in extract_snow_tweets_from_file_generator(path, json_decoder=json_decoder, slim=slim):
             yield tweet
 
 
-def store_snow_tweets_from_disk_to_mongodb(snow_tweets_folder):
+########################################################################################################################
+# Parallel ingestion; reader processes parse files into tweet batches and the parent process writes them to MongoDB.
+########################################################################################################################
+tweet_batch_queue = None
+tweet_batch_size = None
+tweet_reader_options = None
+tweet_reader_stop_event = None
+
+
+def initialize_snow_tweet_reader(batch_queue, batch_size, json_decoder=None, slim=False, stop_event=None):
+    global tweet_batch_queue
+    global tweet_batch_size
+    global tweet_reader_options
+    global tweet_reader_stop_event
+
+    tweet_batch_queue = batch_queue
+    tweet_batch_size = batch_size
+    tweet_reader_options = dict(json_decoder=json_decoder, slim=slim)
+    tweet_reader_stop_event = stop_event
+
+
+def put_tweet_batch(tweet_batch):
+    """
+    Puts a tweet batch in the batch queue, unless the parent process has stopped the ingestion in the meantime.
+
+    Output: - True if the batch was put in the queue, False if the ingestion was stopped.
+    """
+    while True:
+        try:
+            tweet_batch_queue.put(tweet_batch, timeout=0.1)
+            return True
+        except queue.Full:
+            if (tweet_reader_stop_event is not None) and tweet_reader_stop_event.is_set():
+                return False
+
+
+def read_snow_tweet_file(json_file_path):
+    """
+    Parses a SNOW tweet file in a reader process and puts its tweets in the batch queue, followed by None.
+
+    Input:  - json_file_path: The path of a json file containing a tweet in each line.
+
+    Output: - number_of_tweets: The number of tweets read from the file.
+    """
+    number_of_tweets = 0
+    try:
+        for tweet_batch in split_every(extract_snow_tweets_from_file_generator(json_file_path, **tweet_reader_options),
+                                   tweet_batch_size):
+            if not put_tweet_batch(tweet_batch):
+                break
+            number_of_tweets += len(tweet_batch)
+    finally:
+        # The parent counts the finished files, whether they were read successfully or not.
+        put_tweet_batch(None)
+    return number_of_tweets
+
+
+def insert_tweet_batch(collection, tweet_batch):
+    """
+    Inserts a batch of tweets in an unordered bulk write; tweets whose id is already stored are skipped.
+
+    Inputs:  - collection: A pymongo collection with a unique index on the tweet "id" field.
+             - tweet_batch: A python list of tweets in python dictionary (json) format.
+
+    Outputs: - number_of_inserted: The number of tweets that were inserted.
+             - number_of_duplicates: The number of tweets that were already stored.
+    """
+    try:
+        result = collection.insert_many(tweet_batch, ordered=False)
+    except BulkWriteError as e:
+        write_error_list = e.details["writeErrors"]
+        for write_error in write_error_list:
+            if write_error["code"] != 11000:
+                raise
+        return e.details["nInserted"], len(write_error_list)
+    return len(result.inserted_ids), 0
+
+
+def store_snow_tweets_from_disk_to_mongodb(snow_tweets_folder, mongo_uri="mongodb://localhost:27017",
+                                           database_name="snow_tweet_storage", collection_name="tweets",
+                                           number_of_workers=1, batch_size=1000, queue_size=None, report_interval=10.0,
+                                           json_decoder=None, slim=False, poll_timeout=5.0):
     """
     Store all SNOW tweets in a mongodb collection.
+
+    The files are parsed in a pool of reader processes. Their tweets are passed in batches through a bounded queue to
+    this process, which inserts them in unordered bulk writes. A unique index on the tweet id makes the ingestion
+    idempotent, so an interrupted ingestion can simply be run again.
+
+    Inputs:  - snow_tweets_folder: The path of the folder containing the raw data.
+             - mongo_uri: A MongoDB URI.
+             - database_name: The name of the target Mongo database as a string.
+             - collection_name: The name of the target tweet collection as a string.
+             - number_of_workers: The number of reader processes.
+             - batch_size: The number of tweets in each bulk write.
+             - queue_size: The maximum number of parsed batches waiting to be written. Default: Two per reader.
+             - report_interval: The ingestion rate is printed every that many seconds. Use 0 to disable.
+             - json_decoder: "orjson", "ujson" or "json". Default: None, i.e. the fastest one that is installed.
+             - slim: If True, only slim tweet records are stored; see get_slim_tweet.
+             - poll_timeout: The reader processes are checked for failures after that many seconds without a batch.
+
+    Outputs: - number_of_inserted: The number of tweets that were inserted.
+             - number_of_duplicates: The number of tweets that were already stored.
     """
-    client = pymongo.MongoClient("localhost", 27017)
+    client = pymongo.MongoClient(mongo_uri)
+
+    db = client[database_name]
+    collection = db[collection_name]
+    collection.create_index("id", unique=True)
+
+    json_file_path_list = get_snow_tweet_file_paths(snow_tweets_folder)
+    number_of_files = len(json_file_path_list)
+
+    if queue_size is None:
+        queue_size = 2*number_of_workers
+    batch_queue = mp.Queue(maxsize=queue_size)
+
+    number_of_inserted = 0
+    number_of_duplicates = 0
+
+    start_time = time.perf_counter()
+    last_report_time = start_time
+
+    # The readers stop putting batches in the queue once this is set, so that they can be shut down on a failure.
+    stop_event = mp.Event()
+
+    executor = concurrent.futures.ProcessPoolExecutor(number_of_workers,
+                                                      initializer=initialize_snow_tweet_reader,
+                                                      initargs=(batch_queue, batch_size, json_decoder, slim, stop_event))
+    future_list = list()
+    try:
+        future_list = [executor.submit(read_snow_tweet_file, json_file_path) for json_file_path in json_file_path_list]
+
+        files_done = 0
+        while files_done < number_of_files:
+            try:
+                tweet_batch = batch_queue.get(timeout=poll_timeout)
+            except queue.Empty:
+                # A reader that dies without running its finally clause never sends its None; the executor then fails
+                # the pending files with a BrokenProcessPool, which is raised here instead of blocking forever.
+                for future in future_list:
+                    if future.done():
+                        future.result()
+                continue
+            if tweet_batch is None:
+                files_done += 1
+                continue
+
+            batch_inserted, batch_duplicates = insert_tweet_batch(collection, tweet_batch)
+            number_of_inserted += batch_inserted
+            number_of_duplicates += batch_duplicates
+
+            current_time = time.perf_counter()
+            if report_interval > 0 and current_time - last_report_time >= report_interval:
+                last_report_time = current_time
+                print("Stored:", number_of_inserted, "tweets,", number_of_duplicates, "duplicates,",
+                      files_done, "/", number_of_files, "files (",
+                      "%.0f" % ((number_of_inserted + number_of_duplicates)/(current_time - start_time)),
+                      "tweets/s).")
+
+        # Raises any exception of the reader processes.
+        number_of_tweets = sum(future.result() for future in future_list)
+    finally:
+        stop_event.set()
+        for future in future_list:
+            future.cancel()
+        executor.shutdown(wait=True)
 
-    db = client["snow_tweet_storage"]
-    collection = db["tweets"]
+    elapsed = time.perf_counter() - start_time
+    if report_interval > 0:
+        print("Total:", number_of_tweets, "tweets read,", number_of_inserted, "inserted,", number_of_duplicates,
+              "duplicates in", "%.1f" % elapsed, "s (", "%.0f" % (number_of_tweets/max(elapsed, 1e-9)), "tweets/s).")
 
-    for tweet in extract_all_snow_tweets_from_disk_generator(snow_tweets_folder):
-        collection.insert(tweet)
+    return number_of_inserted, number_of_duplicates
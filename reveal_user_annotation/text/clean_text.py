@@ -3,6 +3,9 @@ __author__ = 'Georgios Rizos (georgerizos@iti.gr)'
 import os
 import re
 import string
+import hashlib
+import pickle
+import tempfile
 
 from nltk.corpus import stopwords
 from nltk.stem.porter import PorterStemmer
@@ -13,10 +16,10 @@ from nltk.tag.brill_trainer import BrillTaggerTrainer
 import nltk
 from multiprocessing import Pool
 from functools import partial
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
-from reveal_user_annotation.common.config_package import get_package_path, get_threads_number
-from reveal_user_annotation.common.datarw import get_file_row_generator
+from reveal_user_annotation.common.config_package import get_package_path, get_threads_number, get_cache_path
+from reveal_user_annotation.common.datarw import get_file_row_generator, load_pickle, store_pickle_atomically
 from reveal_user_annotation.text.map_data import chunks
 from reveal_user_annotation.text.text_util import reduce_list_of_bags_of_words, combine_word_list
 
@@ -53,22 +56,127 @@ def get_word_patterns():
     return word_patterns
 
 
-def get_braupt_tagger():
+# Increment this whenever the training procedure changes in a way that is not captured by the cache key.
+BRAUPT_TAGGER_CACHE_VERSION = 1
+
+
+def get_braupt_tagger(max_rules=100, min_score=3, use_cache=True, cache_folder=None):
+    """
+    Returns a Brill tagger trained on conll2000 on top of a Regexp/Affix/Unigram/Bigram/Trigram backoff chain.
+
+    Training takes from tens of seconds to minutes, so the trained tagger is pickled in a cache folder and loaded from
+    there in later calls. The tagger is retrained only if the cache key (template set, word patterns, training
+    parameters, corpus and NLTK version) has changed.
+
+    Inputs: - max_rules: The maximum number of Brill transformation rules to learn.
+            - min_score: The minimum score a Brill rule must have in order to be learnt.
+            - use_cache: If False, the tagger is always trained from scratch and the cache is not touched.
+            - cache_folder: The folder where trained taggers are cached. Default: get_cache_path()
+
+    Output: - braubt_tagger: A trained nltk BrillTagger.
+    """
+    word_patterns = get_word_patterns()
+    templates = brill.brill24()
+
+    if use_cache:
+        cache_file_path = get_braupt_tagger_cache_file_path(templates, word_patterns, max_rules, min_score,
+                                                            cache_folder)
+        try:
+            braubt_tagger = load_pickle(cache_file_path)
+            return braubt_tagger
+        except FileNotFoundError:
+            pass
+        except (OSError, EOFError, AttributeError, ImportError, pickle.UnpicklingError):
+            print("Warning: Could not load cached tagger from " + cache_file_path + ". Retraining.")
+
     conll_sents = nltk.corpus.conll2000.tagged_sents()
     # conll_sents = nltk.corpus.conll2002.tagged_sents()
 
-    word_patterns = get_word_patterns()
     raubt_tagger = backoff_tagger(conll_sents, [nltk.tag.AffixTagger,
     nltk.tag.UnigramTagger, nltk.tag.BigramTagger, nltk.tag.TrigramTagger],
     backoff=nltk.tag.RegexpTagger(word_patterns))
 
-    templates = brill.brill24()
-
     trainer = BrillTaggerTrainer(raubt_tagger, templates)
-    braubt_tagger = trainer.train(conll_sents, max_rules=100, min_score=3)
+    braubt_tagger = trainer.train(conll_sents, max_rules=max_rules, min_score=min_score)
+
+    if use_cache:
+        try:
+            store_pickle_atomically(cache_file_path, braubt_tagger)
+        except OSError:
+            print("Warning: Could not store trained tagger in " + cache_file_path + ".")
+
     return braubt_tagger
 
 
+def get_braupt_tagger_cache_file_path(templates, word_patterns, max_rules, min_score, cache_folder=None):
+    """
+    Forms the versioned path of the cached Brill tagger that corresponds to a specific training configuration.
+
+    Inputs: - templates: The python list of Brill templates used in training.
+            - word_patterns: The python list of (regex, tag) pairs used by the RegexpTagger backoff.
+            - max_rules: The maximum number of Brill transformation rules to learn.
+            - min_score: The minimum score a Brill rule must have in order to be learnt.
+            - cache_folder: The folder where trained taggers are cached. Default: get_cache_path()
+
+    Output: - cache_file_path: The path of the cached tagger pickle.
+    """
+    if cache_folder is None:
+        cache_folder = get_cache_path()
+
+    # The corpus is identified by its file names and sizes; modification times change whenever nltk_data is copied.
+    corpus_signature = list()
+    try:
+        conll2000 = nltk.corpus.conll2000
+        for file_id in conll2000.fileids():
+            corpus_signature.append((file_id, os.path.getsize(conll2000.abspath(file_id))))
+    except (LookupError, OSError):
+        pass
+
+    cache_key = repr((BRAUPT_TAGGER_CACHE_VERSION,
+                      nltk.__version__,
+                      [repr(template) for template in templates],
+                      word_patterns,
+                      max_rules,
+                      min_score,
+                      corpus_signature))
+    cache_key = hashlib.sha1(cache_key.encode("utf-8")).hexdigest()
+
+    cache_file_path = os.path.join(cache_folder,
+                                   "braupt_tagger_v" + str(BRAUPT_TAGGER_CACHE_VERSION) + "_" + cache_key + ".pkl")
+    return cache_file_path
+
+
+def get_clean_document_namespace(lemmatizing="wordnet", stopset=None, pos_set=None, max_rules=100, min_score=3):
+    """
+    Forms a namespace that identifies a text cleaning configuration, e.g. for a CleanDocumentCache.
+
+    Inputs: - lemmatizing: A string containing one of the following: "porter", "snowball" or "wordnet".
+            - stopset: The python set of stopwords. Default: get_stopset()
+            - pos_set: The python set of part-of-speech tags that are kept. Default: get_pos_set()
+            - max_rules: The maximum number of Brill transformation rules of the tagger.
+            - min_score: The minimum score of a Brill rule of the tagger.
+
+    Output: - namespace: A string that changes along with the tagger cache key, the stopwords, the kept POS tags, the
+                         lemmatizer and the NLTK version.
+    """
+    if stopset is None:
+        stopset = get_stopset()
+    if pos_set is None:
+        pos_set = get_pos_set()
+
+    tagger_file_path = get_braupt_tagger_cache_file_path(brill.brill24(), get_word_patterns(), max_rules, min_score)
+    tagger_key = os.path.splitext(os.path.basename(tagger_file_path))[0]
+
+    stopset_key = hashlib.sha1("\n".join(sorted(stopset)).encode("utf-8")).hexdigest()
+
+    namespace = "-".join([tagger_key,
+                          lemmatizing,
+                          "stopset_" + stopset_key,
+                          "pos_" + "_".join(sorted(pos_set)),
+                          "nltk_" + nltk.__version__])
+    return namespace
+
+
 def clean_single_word(word, lemmatizing="wordnet"):
     """
     Performs stemming or lemmatizing on a single word.
@@ -199,6 +307,81 @@ def clean_document(document,
     return lemma_list, lemma_to_keywordbag
 
 
+def clean_documents(documents,
+                    sent_tokenize, _treebank_word_tokenize,
+                    tagger,
+                    lemmatizer,
+                    lemmatize,
+                    stopset,
+                    first_cap_re, all_cap_re,
+                    digits_punctuation_whitespace_re,
+                    pos_set):
+    """
+    Extracts a clean bag-of-words from each document in a batch.
+
+    The results are identical to calling clean_document on each document separately. However, the part-of-speech
+    tagger is called once for the whole batch and the rest of the stages operate on the flattened tokens of all the
+    documents, which amortizes the per-call overhead for short documents (e.g. Twitter list names).
+
+    Inputs: - documents: A python iterable of strings.
+
+    Output: - list_of_lemma_lists: A python list that contains a list of lemmas or stems per document.
+            - list_of_lemma_to_keywordbags: A python list that contains a dictionary per document, mapping stems/lemmas
+                                            to original topic keywords.
+    """
+    ####################################################################################################################
+    # Tokenizing text, separating camelCase and making every letter lower case
+    ####################################################################################################################
+    tokenized_documents = list()
+    append_tokenized_document = tokenized_documents.append
+    for document in documents:
+        try:
+            tokenized_document = fast_word_tokenize(document, sent_tokenize, _treebank_word_tokenize)
+        except LookupError:
+            print("Warning: Could not tokenize document. If these warnings are commonplace, there is a problem with the nltk resources.")
+            tokenized_document = list()
+        append_tokenized_document([separate_camel_case(token, first_cap_re, all_cap_re).lower() for token in tokenized_document])
+
+    number_of_documents = len(tokenized_documents)
+
+    ####################################################################################################################
+    # Parts of speech tagger; a single call for the whole batch
+    ####################################################################################################################
+    tagged_documents = tagger.tag_sents(tokenized_documents)
+
+    # Flatten the tokens of all documents, keeping track of the document each token belongs to.
+    document_index_list = list()
+    token_list = list()
+    append_document_index = document_index_list.append
+    append_token = token_list.append
+    for document_index, tagged_document in enumerate(tagged_documents):
+        for token, tag in tagged_document:
+            if tag in pos_set:
+                append_document_index(document_index)
+                append_token(token)
+
+    ####################################################################################################################
+    # Removing digits, punctuation, whitespace and stopwords, lemmatizing and removing stopwords once more
+    ####################################################################################################################
+    list_of_lemma_lists = [list() for document_index in range(number_of_documents)]
+    list_of_lemma_to_keywordbags = [defaultdict(lambda: defaultdict(int)) for document_index in range(number_of_documents)]
+
+    remove_digits_punctuation_whitespace_sub = digits_punctuation_whitespace_re.sub
+    for document_index, token in zip(document_index_list, token_list):
+        word = remove_digits_punctuation_whitespace_sub(u'', token)
+        if word == u'':
+            continue
+        if word in stopset:
+            continue
+
+        lemma = lemmatize(word)
+        list_of_lemma_to_keywordbags[document_index][lemma][word] += 1
+        if lemma not in stopset:
+            list_of_lemma_lists[document_index].append(lemma)
+
+    return list_of_lemma_lists, list_of_lemma_to_keywordbags
+
+
 def get_tokenizer():
     sent_tokenize = nltk.tokenize.sent_tokenize
     _treebank_word_tokenize = nltk.tokenize._treebank_word_tokenize
@@ -228,7 +411,19 @@ def get_stopset():
     return stopset
 
 
-def get_lemmatizer(lemmatizing="wordnet"):
+def get_lemmatizer(lemmatizing="wordnet", cache_size=None, vocabulary_file_path=None):
+    """
+    Returns a stemmer/lemmatizer object along with the function that is to be called on each word.
+
+    Inputs: - lemmatizing: A string containing one of the following: "porter", "snowball" or "wordnet".
+            - cache_size: If not None, the lemmatize function is wrapped in a MemoizedLemmatizer that holds at most
+                          this many words. Default: None, i.e. no memoization.
+            - vocabulary_file_path: A vocabulary file stored by MemoizedLemmatizer.store_vocabulary, with which the
+                                    memoized lemmatizer is pre-warmed. Ignored if cache_size is None.
+
+    Outputs: - lemmatizer: The nltk stemmer/lemmatizer object.
+             - lemmatize: A function that maps a word to its stem/lemma.
+    """
     if lemmatizing == "porter":
         lemmatizer = PorterStemmer()
         lemmatize = lemmatizer.stem
@@ -241,9 +436,106 @@ def get_lemmatizer(lemmatizing="wordnet"):
     else:
         print("Invalid lemmatizer argument.")
         raise RuntimeError
+
+    if cache_size is not None:
+        lemmatize = MemoizedLemmatizer(lemmatize, cache_size)
+        if vocabulary_file_path is not None:
+            lemmatize.load_vocabulary(vocabulary_file_path)
+
     return lemmatizer, lemmatize
 
 
+class MemoizedLemmatizer:
+    """
+    Wraps a stemming/lemmatizing function with a bounded least-recently-used cache.
+
+    Tweet and Twitter list vocabularies are Zipfian, so a cache of a few tens of thousands of words serves the vast
+    majority of the calls. Instances are callable exactly like the wrapped function.
+    """
+    def __init__(self, lemmatize, cache_size):
+        """
+        Inputs: - lemmatize: The function that maps a word to its stem/lemma (e.g. WordNetLemmatizer().lemmatize).
+                - cache_size: The maximum number of words held in the cache.
+        """
+        if cache_size < 1:
+            print("Invalid cache size argument.")
+            raise RuntimeError
+
+        self.lemmatize = lemmatize
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, word):
+        try:
+            lemma = self.cache[word]
+        except KeyError:
+            self.misses += 1
+            lemma = self.lemmatize(word)
+            self.cache[word] = lemma
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return lemma
+
+        self.hits += 1
+        self.cache.move_to_end(word)
+        return lemma
+
+    def cache_info(self):
+        """
+        Returns a python dictionary with the hits, misses, current size and maximum size of the cache.
+        """
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.cache),
+                "cache_size": self.cache_size}
+
+    def warm_up(self, word_iterable):
+        """
+        Fills the cache with the lemmas of some words, without affecting the hit/miss counters.
+
+        Input:  - word_iterable: A python iterable of words, in increasing order of importance.
+        """
+        cache = self.cache
+        lemmatize = self.lemmatize
+        for word in word_iterable:
+            if word in cache:
+                cache.move_to_end(word)
+            else:
+                cache[word] = lemmatize(word)
+                if len(cache) > self.cache_size:
+                    cache.popitem(last=False)
+
+    def store_vocabulary(self, file_path):
+        """
+        Stores the cached words in a file, one word per line, from the least to the most recently used.
+
+        The file is replaced atomically, so that several processes may store their vocabularies in the same file.
+
+        Input:  - file_path: Target file path.
+        """
+        file_descriptor, temporary_file_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)),
+                                                                suffix=".tmp")
+        try:
+            with os.fdopen(file_descriptor, "w", encoding="utf-8") as fp:
+                for word in self.cache.keys():
+                    fp.write(word + "\n")
+            os.replace(temporary_file_path, file_path)
+        except BaseException:
+            os.remove(temporary_file_path)
+            raise
+
+    def load_vocabulary(self, file_path):
+        """
+        Pre-warms the cache with a vocabulary file stored by store_vocabulary.
+
+        Input:  - file_path: The path of the vocabulary file.
+        """
+        file_row_gen = get_file_row_generator(file_path, "\t", encoding="utf-8")
+        self.warm_up(row[0] for row in file_row_gen if row[0] != "")
+
+
 def get_pos_set():
     pos_set = set(["JJ", "NN", "NNS", "NNP"])
     return pos_set
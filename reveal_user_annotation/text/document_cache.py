@@ -0,0 +1,197 @@
+__author__ = 'Georgios Rizos (georgerizos@iti.gr)'
+
+import hashlib
+import json
+import sqlite3
+from collections import defaultdict, OrderedDict
+
+from reveal_user_annotation.text.clean_text import clean_documents
+
+
+class CleanDocumentCache:
+    """
+    A content-addressed cache of clean_document results, i.e. (lemma_list, lemma_to_keywordbag) pairs.
+
+    Short texts such as Twitter list names ("news", "journalists", "tech") repeat across huge numbers of users. The
+    cache has an in-process least-recently-used tier and an optional on-disk SQLite tier that survives across runs.
+
+    The results depend on the text cleaning configuration (tagger, lemmatizer, stopwords), so a different namespace
+    should be used for every configuration that shares the same on-disk file.
+    """
+    def __init__(self, cache_size=2**16, file_path=None, namespace="", commit_every=1000):
+        """
+        Inputs: - cache_size: The maximum number of documents held in memory.
+                - file_path: The path of the SQLite file of the on-disk tier. Default: None, i.e. in-memory tier only.
+                - namespace: A string that is hashed along with each document to form the on-disk key.
+                - commit_every: The number of new results that are buffered before being written to disk in one transaction.
+        """
+        self.cache_size = cache_size
+        self.file_path = file_path
+        self.namespace = namespace
+        self.commit_every = commit_every
+
+        self.cache = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.connection = None
+        self.pending_rows = list()
+        if file_path is not None:
+            self.connection = sqlite3.connect(file_path, timeout=60.0)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS clean_document "
+                                    "(document_key BLOB PRIMARY KEY, result TEXT NOT NULL)")
+            self.connection.commit()
+
+    def get_document_key(self, document):
+        return hashlib.sha1((self.namespace + "\0" + document).encode("utf-8")).digest()
+
+    def get(self, document):
+        """
+        Looks a document up in the memory and disk tiers.
+
+        Input:  - document: A string containing some text.
+
+        Output: - result: A (lemma_list, lemma_to_keywordbag) tuple as returned by clean_document, or None on a miss.
+        """
+        try:
+            lemma_tuple, lemma_to_keywordbag = self.cache[document]
+            self.cache.move_to_end(document)
+            self.memory_hits += 1
+            return unfreeze_clean_document_result(lemma_tuple, lemma_to_keywordbag)
+        except KeyError:
+            pass
+
+        if self.connection is not None:
+            row = self.connection.execute("SELECT result FROM clean_document WHERE document_key = ?",
+                                          (self.get_document_key(document),)).fetchone()
+            if row is not None:
+                self.disk_hits += 1
+                lemma_list, lemma_to_keywordbag = json.loads(row[0])
+                self.put_in_memory(document, tuple(lemma_list), lemma_to_keywordbag)
+                return unfreeze_clean_document_result(lemma_list, lemma_to_keywordbag)
+
+        self.misses += 1
+        return None
+
+    def put(self, document, lemma_list, lemma_to_keywordbag):
+        """
+        Stores the cleaning result of a document in the memory and disk tiers.
+
+        Inputs: - document: A string containing some text.
+                - lemma_list: A python list of lemmas or stems.
+                - lemma_to_keywordbag: A python dictionary that maps stems/lemmas to original topic keywords.
+        """
+        lemma_to_keywordbag = {lemma: dict(keywordbag) for lemma, keywordbag in lemma_to_keywordbag.items()}
+        self.put_in_memory(document, tuple(lemma_list), lemma_to_keywordbag)
+
+        if self.connection is not None:
+            self.pending_rows.append((self.get_document_key(document),
+                                      json.dumps([lemma_list, lemma_to_keywordbag])))
+            if len(self.pending_rows) >= self.commit_every:
+                self.commit()
+
+    def put_in_memory(self, document, lemma_tuple, lemma_to_keywordbag):
+        self.cache[document] = (lemma_tuple, lemma_to_keywordbag)
+        self.cache.move_to_end(document)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def clean_documents(self, documents,
+                        sent_tokenize, _treebank_word_tokenize,
+                        tagger, lemmatizer, lemmatize, stopset,
+                        first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
+                        pos_set):
+        """
+        Cached version of clean_text.clean_documents; only the documents that miss the cache are actually cleaned.
+
+        Inputs: - documents: A python iterable of strings.
+
+        Output: - list_of_lemma_lists: A python list that contains a list of lemmas or stems per document.
+                - list_of_lemma_to_keywordbags: A python list that contains a lemma-to-keywordbag dictionary per document.
+        """
+        documents = list(documents)
+        list_of_lemma_lists = list()
+        list_of_lemma_to_keywordbags = list()
+
+        # Documents that miss the cache are cleaned once, even if they appear several times in the batch.
+        missed_document_to_indices = OrderedDict()
+        for document_index, document in enumerate(documents):
+            if document in missed_document_to_indices:
+                missed_document_to_indices[document].append(document_index)
+                result = (None, None)
+            else:
+                result = self.get(document)
+                if result is None:
+                    missed_document_to_indices[document] = [document_index]
+                    result = (None, None)
+            list_of_lemma_lists.append(result[0])
+            list_of_lemma_to_keywordbags.append(result[1])
+
+        if len(missed_document_to_indices) > 0:
+            missed_documents = list(missed_document_to_indices.keys())
+            missed_lemma_lists, missed_lemma_to_keywordbags = clean_documents(missed_documents,
+                                                                              sent_tokenize, _treebank_word_tokenize,
+                                                                              tagger, lemmatizer, lemmatize, stopset,
+                                                                              first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
+                                                                              pos_set)
+            for document, lemma_list, lemma_to_keywordbag in zip(missed_documents,
+                                                                 missed_lemma_lists,
+                                                                 missed_lemma_to_keywordbags):
+                self.put(document, lemma_list, lemma_to_keywordbag)
+
+                document_indices = missed_document_to_indices[document]
+                list_of_lemma_lists[document_indices[0]] = lemma_list
+                list_of_lemma_to_keywordbags[document_indices[0]] = lemma_to_keywordbag
+                for document_index in document_indices[1:]:
+                    list_of_lemma_lists[document_index], list_of_lemma_to_keywordbags[document_index]\
+                        = unfreeze_clean_document_result(lemma_list, lemma_to_keywordbag)
+
+        return list_of_lemma_lists, list_of_lemma_to_keywordbags
+
+    def cache_info(self):
+        """
+        Returns a python dictionary with the hit/miss statistics and the hit rate of the cache.
+        """
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        if lookups > 0:
+            hit_rate = (self.memory_hits + self.disk_hits)/lookups
+        else:
+            hit_rate = 0.0
+        return {"memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hit_rate,
+                "size": len(self.cache),
+                "cache_size": self.cache_size}
+
+    def commit(self):
+        """
+        Writes the buffered results to the on-disk tier in a single short transaction.
+        """
+        if (self.connection is not None) and (len(self.pending_rows) > 0):
+            try:
+                with self.connection:
+                    self.connection.executemany("INSERT OR IGNORE INTO clean_document (document_key, result) "
+                                                "VALUES (?, ?)", self.pending_rows)
+            except sqlite3.OperationalError:
+                # Another process held the lock for too long; these results are simply not persisted.
+                print("Warning: Could not write to the document cache file " + self.file_path + ".")
+            self.pending_rows = list()
+
+    def close(self):
+        if self.connection is not None:
+            self.commit()
+            self.connection.close()
+            self.connection = None
+
+
+def unfreeze_clean_document_result(lemma_list, lemma_to_keywordbag):
+    """
+    Forms fresh copies of a cached result, of the same types as returned by clean_document.
+    """
+    lemma_list = list(lemma_list)
+    unfrozen_lemma_to_keywordbag = defaultdict(lambda: defaultdict(int))
+    for lemma, keywordbag in lemma_to_keywordbag.items():
+        unfrozen_lemma_to_keywordbag[lemma].update(keywordbag)
+    return lemma_list, unfrozen_lemma_to_keywordbag
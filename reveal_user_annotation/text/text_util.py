@@ -50,35 +50,63 @@ def augmented_tf_idf(attribute_matrix):
                                     Introduction to information retrieval (Vol. 1, p. 6).
                                     Cambridge: Cambridge university press.
 
+    Document frequencies and per-document maximum term frequencies are computed directly on the compressed arrays of
+    a CSR or CSC matrix; any other format is converted to CSR once.
+
     Input:  - attribute_matrix: A bag-of-words vector representation in SciPy sparse matrix format.
 
-    Output: - attribute_matrix: The same matrix after augmented tf-idf normalization.
+    Output: - attribute_matrix: The same matrix after augmented tf-idf normalization, in CSR format.
     """
+    if attribute_matrix.format not in ("csr", "csc"):
+        attribute_matrix = attribute_matrix.tocsr()
+
     number_of_documents = attribute_matrix.shape[0]
+    number_of_terms = attribute_matrix.shape[1]
 
     max_term_frequencies = np.ones(number_of_documents, dtype=np.float64)
-    idf_array = np.ones(attribute_matrix.shape[1], dtype=np.float64)
+    idf_array = np.ones(number_of_terms, dtype=np.float64)
+
+    if attribute_matrix.format == "csr":
+        row = np.repeat(np.arange(number_of_documents), np.diff(attribute_matrix.indptr))
+        col = attribute_matrix.indices
+
+        document_frequencies = np.bincount(col, minlength=number_of_terms)
+
+        # Segmented maximum over the nonempty rows; empty rows own no data, so the segments are contiguous.
+        row_nnz = np.diff(attribute_matrix.indptr)
+        nonempty_rows = np.flatnonzero(row_nnz)
+        row_maxima = np.empty(number_of_documents, dtype=np.float64)
+        row_maxima.fill(-np.inf)
+        if nonempty_rows.size > 0:
+            row_maxima[nonempty_rows] = np.maximum.reduceat(attribute_matrix.data,
+                                                            attribute_matrix.indptr[nonempty_rows])
+    else:
+        row = attribute_matrix.indices
+        col = np.repeat(np.arange(number_of_terms), np.diff(attribute_matrix.indptr))
+
+        document_frequencies = np.diff(attribute_matrix.indptr)
+
+        row_maxima = np.empty(number_of_documents, dtype=np.float64)
+        row_maxima.fill(-np.inf)
+        np.maximum.at(row_maxima, row, attribute_matrix.data)
 
     # Calculate inverse document frequency
-    attribute_matrix = attribute_matrix.tocsc()
-    for j in range(attribute_matrix.shape[1]):
-        document_frequency = attribute_matrix.getcol(j).data.size
-        if document_frequency > 1:
-            idf_array[j] = np.log(number_of_documents/document_frequency)
+    frequent_terms = document_frequencies > 1
+    idf_array[frequent_terms] = np.log(number_of_documents/document_frequencies[frequent_terms])
 
     # Calculate maximum term frequencies for a user
-    attribute_matrix = attribute_matrix.tocsr()
-    for i in range(attribute_matrix.shape[0]):
-        max_term_frequency = attribute_matrix.getrow(i).data
-        if max_term_frequency.size > 0:
-            max_term_frequency = max_term_frequency.max()
-            if max_term_frequency > 0.0:
-                max_term_frequencies[i] = max_term_frequency
+    positive_maxima = row_maxima > 0.0
+    max_term_frequencies[positive_maxima] = row_maxima[positive_maxima]
 
     # Do augmented tf-idf normalization
-    attribute_matrix = attribute_matrix.tocoo()
-    attribute_matrix.data = 0.5 + np.divide(0.5*attribute_matrix.data, np.multiply((max_term_frequencies[attribute_matrix.row]), (idf_array[attribute_matrix.col])))
+    data = 0.5 + np.divide(0.5*attribute_matrix.data, np.multiply((max_term_frequencies[row]), (idf_array[col])))
+
+    attribute_matrix = attribute_matrix.__class__((data,
+                                                   attribute_matrix.indices.copy(),
+                                                   attribute_matrix.indptr.copy()),
+                                                  shape=attribute_matrix.shape)
     attribute_matrix = attribute_matrix.tocsr()
+    attribute_matrix.sum_duplicates()
 
     return attribute_matrix
 
@@ -136,3 +164,88 @@ def simple_word_query(target_word, list_of_words, edit_distance=1):
             pass
 
     return found_list_of_words
+
+
+class KeywordIndex:
+    """
+    A deletion-neighbourhood (SymSpell-style) index over a list of keywords, for fast fuzzy keyword queries.
+
+    Queries return exactly the same results as simple_word_query: words longer than 6 characters match a target within
+    the given edit distance, whereas shorter words match only exactly. Every keyword is indexed under all the strings
+    that are reachable from it by at most edit_distance character deletions. Two words within that edit distance
+    always share such a string, so only the few keywords that share one with the target need an edit distance check.
+    The results of the most recent queries are kept in a bounded least-recently-used cache.
+    """
+    def __init__(self, list_of_words, edit_distance=1, cache_size=2**16):
+        """
+        Inputs: - list_of_words: A python list of keywords.
+                - edit_distance: For larger words, we also check for similar words based on edit_distance.
+                - cache_size: The maximum number of target words whose results are cached. Use 0 to disable.
+        """
+        self.list_of_words = list(list_of_words)
+        self.edit_distance = edit_distance
+
+        self.exact_word_to_positions = dict()
+        self.deletion_to_positions = dict()
+        self.cache_size = cache_size
+        self.query_cache = collections.OrderedDict()
+
+        for position, word in enumerate(self.list_of_words):
+            if len(word) > 6:
+                for deletion in get_deletion_neighbourhood(word, edit_distance):
+                    self.deletion_to_positions.setdefault(deletion, list()).append(position)
+            else:
+                self.exact_word_to_positions.setdefault(word, list()).append(position)
+
+    def query(self, target_word):
+        """
+        Returns the keywords that are within editing distance of a target word, in the order of the keyword list.
+
+        Input:  - target_word: A string containing the word we want to search in the keyword list.
+
+        Output: - found_list_of_words: This is the list of words that are within edit distance of the target word.
+        """
+        try:
+            found_list_of_words = self.query_cache[target_word]
+        except KeyError:
+            pass
+        else:
+            self.query_cache.move_to_end(target_word)
+            return list(found_list_of_words)
+
+        found_positions = set(self.exact_word_to_positions.get(target_word, list()))
+
+        candidate_positions = set()
+        for deletion in get_deletion_neighbourhood(target_word, self.edit_distance):
+            candidate_positions.update(self.deletion_to_positions.get(deletion, list()))
+
+        for position in candidate_positions:
+            word = self.list_of_words[position]
+            if abs(len(word)-len(target_word)) <= self.edit_distance:
+                if nltk.edit_distance(word, target_word) <= self.edit_distance:
+                    found_positions.add(position)
+
+        found_list_of_words = [self.list_of_words[position] for position in sorted(found_positions)]
+
+        if self.cache_size > 0:
+            self.query_cache[target_word] = tuple(found_list_of_words)
+            if len(self.query_cache) > self.cache_size:
+                self.query_cache.popitem(last=False)
+        return found_list_of_words
+
+
+def get_deletion_neighbourhood(word, edit_distance):
+    """
+    Returns the set of all strings that are reachable from a word by at most edit_distance character deletions.
+    """
+    deletion_neighbourhood = {word}
+    frontier = {word}
+    for distance in range(edit_distance):
+        new_frontier = set()
+        for frontier_word in frontier:
+            for i in range(len(frontier_word)):
+                new_frontier.add(frontier_word[:i] + frontier_word[i+1:])
+        new_frontier.difference_update(deletion_neighbourhood)
+        deletion_neighbourhood.update(new_frontier)
+        frontier = new_frontier
+    return deletion_neighbourhood
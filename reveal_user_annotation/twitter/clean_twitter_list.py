@@ -2,35 +2,41 @@ __author__ = 'Georgios Rizos (georgerizos@iti.gr)'
 
 from collections import defaultdict
 
-from reveal_user_annotation.text.clean_text import clean_document
+from reveal_user_annotation.text.clean_text import clean_documents
 from reveal_user_annotation.text.text_util import reduce_list_of_bags_of_words
 
+# Past this many entries a Twitter list index is dropped and rebuilt, so that its memory stays bounded.
+MAX_TWITTER_LIST_INDEX_SIZE = 2**18
 
-def clean_twitter_list(twitter_list,
-                       sent_tokenize, _treebank_word_tokenize,
-                       tagger, lemmatizer, lemmatize, stopset,
-                       first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
-                       pos_set):
+
+def get_twitter_list_documents(twitter_list):
     """
-    Extracts the *set* of keywords found in a Twitter list (name + description).
+    Returns the normalized name and description texts of a Twitter list, which are cleaned as separate documents.
 
-    Inputs: - twitter_list: A Twitter list in json format.
-            - lemmatizing: A string containing one of the following: "porter", "snowball" or "wordnet".
+    Input:  - twitter_list: A Twitter list in json format.
+
+    Outputs: - name_document: The list name as a string.
+             - description_document: The list description as a string.
+    """
+    name_document = twitter_list["name"].replace("_", " ").replace("-", " ")
+    description_document = twitter_list["description"].replace("_", " ").replace("-", " ")
+
+    return name_document, description_document
+
+
+def combine_twitter_list_documents(name_lemmas, name_lemma_to_keywordbag,
+                                   description_lemmas, description_lemma_to_keywordbag):
+    """
+    Combines the cleaned name and description of a Twitter list into the keywords of the list.
+
+    Inputs: - name_lemmas: A python list of lemmas extracted from the list name.
+            - name_lemma_to_keywordbag: A python dictionary that maps the name stems/lemmas to original keywords.
+            - description_lemmas: A python list of lemmas extracted from the list description.
+            - description_lemma_to_keywordbag: A python dictionary that maps the description stems/lemmas to keywords.
 
     Output: - keyword_set: A set of keywords (i.e. not a bag-of-words) in python set format.
             - lemma_to_keywordbag: A python dictionary that maps stems/lemmas to original topic keywords.
     """
-    name_lemmas, name_lemma_to_keywordbag = clean_document(twitter_list["name"].replace("_", " ").replace("-", " "),
-                                                           sent_tokenize, _treebank_word_tokenize,
-                                                           tagger, lemmatizer, lemmatize, stopset,
-                                                           first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
-                                                           pos_set)
-    description_lemmas, description_lemma_to_keywordbag = clean_document(twitter_list["description"].replace("_", " ").replace("-", " "),
-                                                           sent_tokenize, _treebank_word_tokenize,
-                                                           tagger, lemmatizer, lemmatize, stopset,
-                                                           first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
-                                                           pos_set)
-
     keyword_set = set(name_lemmas + description_lemmas)
 
     lemma_to_keywordbag = defaultdict(lambda: defaultdict(int))
@@ -45,16 +51,55 @@ def clean_twitter_list(twitter_list,
     return keyword_set, lemma_to_keywordbag
 
 
+def clean_twitter_list(twitter_list,
+                       sent_tokenize, _treebank_word_tokenize,
+                       tagger, lemmatizer, lemmatize, stopset,
+                       first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
+                       pos_set, document_cache=None):
+    """
+    Extracts the *set* of keywords found in a Twitter list (name + description).
+
+    Inputs: - twitter_list: A Twitter list in json format.
+            - lemmatizing: A string containing one of the following: "porter", "snowball" or "wordnet".
+            - document_cache: An optional CleanDocumentCache through which names and descriptions are cleaned.
+
+    Output: - keyword_set: A set of keywords (i.e. not a bag-of-words) in python set format.
+            - lemma_to_keywordbag: A python dictionary that maps stems/lemmas to original topic keywords.
+    """
+    name_document, description_document = get_twitter_list_documents(twitter_list)
+
+    if document_cache is not None:
+        clean_documents_function = document_cache.clean_documents
+    else:
+        clean_documents_function = clean_documents
+
+    list_of_lemma_lists, list_of_lemma_to_keywordbags = clean_documents_function([name_document, description_document],
+                                                                        sent_tokenize, _treebank_word_tokenize,
+                                                                        tagger, lemmatizer, lemmatize, stopset,
+                                                                        first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
+                                                                        pos_set)
+
+    keyword_set, lemma_to_keywordbag = combine_twitter_list_documents(list_of_lemma_lists[0],
+                                                                      list_of_lemma_to_keywordbags[0],
+                                                                      list_of_lemma_lists[1],
+                                                                      list_of_lemma_to_keywordbags[1])
+
+    return keyword_set, lemma_to_keywordbag
+
+
 def clean_list_of_twitter_list(list_of_twitter_lists,
                                sent_tokenize, _treebank_word_tokenize,
                                tagger, lemmatizer, lemmatize, stopset,
                                first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
-                               pos_set):
+                               pos_set, document_cache=None):
     """
     Extracts the sets of keywords for each Twitter list.
 
+    The names and descriptions of all the Twitter lists are cleaned in a single batch.
+
     Inputs: - list_of_twitter_lists: A python list of Twitter lists in json format.
             - lemmatizing: A string containing one of the following: "porter", "snowball" or "wordnet".
+            - document_cache: An optional CleanDocumentCache through which names and descriptions are cleaned.
 
     Output: - list_of_keyword_sets: A list of sets of keywords (i.e. not a bag-of-words) in python set format.
             - list_of_lemma_to_keywordbags: List of python dicts that map stems/lemmas to original topic keywords.
@@ -65,41 +110,165 @@ def clean_list_of_twitter_list(list_of_twitter_lists,
     list_of_lemma_to_keywordbags = list()
     append_lemma_to_keywordbag = list_of_lemma_to_keywordbags.append
 
+    if list_of_twitter_lists is None:
+        return list_of_keyword_sets, list_of_lemma_to_keywordbags
+
+    # Each Twitter list contributes two consecutive documents: its name and its description.
+    documents = list()
+    extend_documents = documents.extend
+    for twitter_list in list_of_twitter_lists:
+        if twitter_list is not None:
+            extend_documents(get_twitter_list_documents(twitter_list))
+
+    if document_cache is not None:
+        clean_documents_function = document_cache.clean_documents
+    else:
+        clean_documents_function = clean_documents
+
+    list_of_lemma_lists, list_of_document_lemma_to_keywordbags = clean_documents_function(documents,
+                                                                                 sent_tokenize, _treebank_word_tokenize,
+                                                                                 tagger, lemmatizer, lemmatize, stopset,
+                                                                                 first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
+                                                                                 pos_set)
+
+    for i in range(0, len(documents), 2):
+        keyword_set, lemma_to_keywordbag = combine_twitter_list_documents(list_of_lemma_lists[i],
+                                                                          list_of_document_lemma_to_keywordbags[i],
+                                                                          list_of_lemma_lists[i + 1],
+                                                                          list_of_document_lemma_to_keywordbags[i + 1])
+        append_keyword_set(keyword_set)
+        append_lemma_to_keywordbag(lemma_to_keywordbag)
+
+    return list_of_keyword_sets, list_of_lemma_to_keywordbags
+
+
+def get_twitter_list_id(twitter_list):
+    """
+    Returns the Twitter id of a Twitter list, or None if the list object does not carry one.
+    """
+    try:
+        return twitter_list["id"]
+    except KeyError:
+        return None
+
+
+def update_twitter_list_keyword_index(twitter_list_index, list_of_twitter_lists,
+                                      sent_tokenize, _treebank_word_tokenize,
+                                      tagger, lemmatizer, lemmatize, stopset,
+                                      first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
+                                      pos_set, document_cache=None):
+    """
+    Cleans the Twitter lists that are not yet in a list-id-to-keywords index and adds them to it.
+
+    A popular Twitter list appears in the corpora of all of its members, but is cleaned only once.
+
+    Inputs: - twitter_list_index: A python dictionary that maps Twitter list ids to (keyword_set, lemma_to_keywordbag).
+            - list_of_twitter_lists: A python list of Twitter lists in json format.
+            - document_cache: An optional CleanDocumentCache through which names and descriptions are cleaned.
+
+    Output: - twitter_list_index: The same, updated python dictionary.
+    """
+    new_twitter_lists = dict()
     if list_of_twitter_lists is not None:
         for twitter_list in list_of_twitter_lists:
             if twitter_list is not None:
-                keyword_set, lemma_to_keywordbag = clean_twitter_list(twitter_list,
-                                                                      sent_tokenize, _treebank_word_tokenize,
-                                                                      tagger, lemmatizer, lemmatize, stopset,
-                                                                      first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
-                                                                      pos_set)
-                append_keyword_set(keyword_set)
-                append_lemma_to_keywordbag(lemma_to_keywordbag)
+                twitter_list_id = get_twitter_list_id(twitter_list)
+                if (twitter_list_id is not None) and (twitter_list_id not in twitter_list_index):
+                    new_twitter_lists[twitter_list_id] = twitter_list
+
+    if len(new_twitter_lists) > 0:
+        list_of_keyword_sets, list_of_lemma_to_keywordbags = clean_list_of_twitter_list(list(new_twitter_lists.values()),
+                                                                                        sent_tokenize, _treebank_word_tokenize,
+                                                                                        tagger, lemmatizer, lemmatize, stopset,
+                                                                                        first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
+                                                                                        pos_set, document_cache)
+        for twitter_list_id, keyword_set, lemma_to_keywordbag in zip(new_twitter_lists.keys(),
+                                                                     list_of_keyword_sets,
+                                                                     list_of_lemma_to_keywordbags):
+            twitter_list_index[twitter_list_id] = (keyword_set, lemma_to_keywordbag)
+
+    return twitter_list_index
 
-    return list_of_keyword_sets, list_of_lemma_to_keywordbags
+
+def form_twitter_list_keyword_index(twitter_list_corpora,
+                                    sent_tokenize, _treebank_word_tokenize,
+                                    tagger, lemmatizer, lemmatize, stopset,
+                                    first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
+                                    pos_set, document_cache=None):
+    """
+    Forms the index of the keywords of all distinct Twitter lists found in the corpora of many users.
+
+    Inputs: - twitter_list_corpora: A python iterable of python lists of Twitter lists in json format.
+            - document_cache: An optional CleanDocumentCache through which names and descriptions are cleaned.
+
+    Output: - twitter_list_index: A python dictionary that maps Twitter list ids to (keyword_set, lemma_to_keywordbag).
+    """
+    twitter_list_index = dict()
+    for twitter_list_corpus in twitter_list_corpora:
+        update_twitter_list_keyword_index(twitter_list_index, twitter_list_corpus,
+                                          sent_tokenize, _treebank_word_tokenize,
+                                          tagger, lemmatizer, lemmatize, stopset,
+                                          first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
+                                          pos_set, document_cache)
+
+    return twitter_list_index
 
 
 def user_twitter_list_bag_of_words(twitter_list_corpus,
                                    sent_tokenize, _treebank_word_tokenize,
                                    tagger, lemmatizer, lemmatize, stopset,
                                    first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
-                                   pos_set):
+                                   pos_set, document_cache=None, twitter_list_index=None):
     """
     Extract a bag-of-words for a corpus of Twitter lists pertaining to a Twitter user.
 
     Inputs: - twitter_list_corpus: A python list of Twitter lists in json format.
             - lemmatizing: A string containing one of the following: "porter", "snowball" or "wordnet".
+            - document_cache: An optional CleanDocumentCache through which names and descriptions are cleaned.
+            - twitter_list_index: An optional python dictionary that maps Twitter list ids to their keywords, as formed
+                                  by form_twitter_list_keyword_index. Lists missing from the index are added to it.
 
     Output: - bag_of_words: A bag-of-words in python dictionary format.
             - lemma_to_keywordbag_total: Aggregated python dictionary that maps stems/lemmas to original topic keywords.
     """
     # Extract a bag-of-words from a list of Twitter lists.
     # May result in empty sets
-    list_of_keyword_sets, list_of_lemma_to_keywordbags = clean_list_of_twitter_list(twitter_list_corpus,
-                                                                                    sent_tokenize, _treebank_word_tokenize,
-                                                                                    tagger, lemmatizer, lemmatize, stopset,
-                                                                                    first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
-                                                                                    pos_set)
+    if twitter_list_index is None:
+        list_of_keyword_sets, list_of_lemma_to_keywordbags = clean_list_of_twitter_list(twitter_list_corpus,
+                                                                                        sent_tokenize, _treebank_word_tokenize,
+                                                                                        tagger, lemmatizer, lemmatize, stopset,
+                                                                                        first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
+                                                                                        pos_set, document_cache)
+    else:
+        update_twitter_list_keyword_index(twitter_list_index, twitter_list_corpus,
+                                          sent_tokenize, _treebank_word_tokenize,
+                                          tagger, lemmatizer, lemmatize, stopset,
+                                          first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
+                                          pos_set, document_cache)
+
+        # Twitter lists without an id cannot be indexed; these are cleaned directly.
+        if twitter_list_corpus is None:
+            twitter_list_corpus = list()
+        twitter_list_corpus = [twitter_list for twitter_list in twitter_list_corpus if twitter_list is not None]
+        unindexed_twitter_lists = [twitter_list for twitter_list in twitter_list_corpus
+                                   if get_twitter_list_id(twitter_list) is None]
+        unindexed_keyword_sets, unindexed_lemma_to_keywordbags = clean_list_of_twitter_list(unindexed_twitter_lists,
+                                                                                            sent_tokenize, _treebank_word_tokenize,
+                                                                                            tagger, lemmatizer, lemmatize, stopset,
+                                                                                            first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
+                                                                                            pos_set, document_cache)
+        unindexed_results = zip(unindexed_keyword_sets, unindexed_lemma_to_keywordbags)
+
+        list_of_keyword_sets = list()
+        list_of_lemma_to_keywordbags = list()
+        for twitter_list in twitter_list_corpus:
+            twitter_list_id = get_twitter_list_id(twitter_list)
+            if twitter_list_id is None:
+                keyword_set, lemma_to_keywordbag = next(unindexed_results)
+            else:
+                keyword_set, lemma_to_keywordbag = twitter_list_index[twitter_list_id]
+            list_of_keyword_sets.append(keyword_set)
+            list_of_lemma_to_keywordbags.append(lemma_to_keywordbag)
 
     # Reduce keyword sets.
     bag_of_words = reduce_list_of_bags_of_words(list_of_keyword_sets)
@@ -11,10 +11,12 @@ from operator import itemgetter
 from urllib.error import URLError
 from http.client import BadStatusLine
 
-from reveal_user_annotation.text.text_util import augmented_tf_idf, simple_word_query
-from reveal_user_annotation.text.clean_text import clean_single_word
+from reveal_user_annotation.text.text_util import augmented_tf_idf, KeywordIndex
+from reveal_user_annotation.text.clean_text import clean_single_word, get_tokenizer, get_braupt_tagger, get_lemmatizer,\
+    get_stopset, get_camel_case_regexes, get_digits_punctuation_whitespace_regex, get_pos_set
 from reveal_user_annotation.twitter.twitter_util import login, safe_twitter_request_handler
-from reveal_user_annotation.twitter.clean_twitter_list import user_twitter_list_bag_of_words
+from reveal_user_annotation.twitter.clean_twitter_list import user_twitter_list_bag_of_words,\
+    update_twitter_list_keyword_index, MAX_TWITTER_LIST_INDEX_SIZE
 from reveal_user_annotation.twitter.manage_resources import get_reveal_set, get_topic_keyword_dictionary
 
 
@@ -22,6 +24,9 @@ def extract_user_keywords_generator(twitter_lists_gen, lemmatizing="wordnet"):
     """
     Based on the user-related lists I have downloaded, annotate the users.
 
+    A popular Twitter list is found in the corpora of many users. The distinct Twitter lists are therefore cleaned
+    once, through an index that is kept across users and dropped whenever it exceeds MAX_TWITTER_LIST_INDEX_SIZE.
+
     Inputs: - twitter_lists_gen: A python generator that yields a user Twitter id and a generator of Twitter lists.
             - lemmatizing: A string containing one of the following: "porter", "snowball" or "wordnet".
 
@@ -31,14 +36,37 @@ def extract_user_keywords_generator(twitter_lists_gen, lemmatizing="wordnet"):
                 * lemma_to_keywordbag: A python dictionary that maps stems/lemmas to original topic keywords.
     """
     ####################################################################################################################
-    # Extract keywords serially.
+    # Prepare the text cleaning resources.
+    ####################################################################################################################
+    sent_tokenize, _treebank_word_tokenize = get_tokenizer()
+    tagger = get_braupt_tagger()
+    lemmatizer, lemmatize = get_lemmatizer(lemmatizing, cache_size=2**16)
+    stopset = get_stopset()
+    first_cap_re, all_cap_re = get_camel_case_regexes()
+    digits_punctuation_whitespace_re = get_digits_punctuation_whitespace_regex()
+    pos_set = get_pos_set()
+
+    nlp_resources = (sent_tokenize, _treebank_word_tokenize,
+                     tagger, lemmatizer, lemmatize, stopset,
+                     first_cap_re, all_cap_re, digits_punctuation_whitespace_re,
+                     pos_set)
+
+    ####################################################################################################################
+    # Extract keywords serially; each distinct Twitter list is cleaned once.
     ####################################################################################################################
+    twitter_list_index = dict()
     for user_twitter_id, twitter_lists_list in twitter_lists_gen:
         if twitter_lists_list is not None:
             if "lists" in twitter_lists_list.keys():
                 twitter_lists_list = twitter_lists_list["lists"]
 
-            bag_of_lemmas, lemma_to_keywordbag = user_twitter_list_bag_of_words(twitter_lists_list, lemmatizing)
+            if len(twitter_list_index) > MAX_TWITTER_LIST_INDEX_SIZE:
+                twitter_list_index = dict()
+            update_twitter_list_keyword_index(twitter_list_index, twitter_lists_list, *nlp_resources)
+
+            bag_of_lemmas, lemma_to_keywordbag = user_twitter_list_bag_of_words(twitter_lists_list,
+                                                                                *nlp_resources,
+                                                                                twitter_list_index=twitter_list_index)
 
             for lemma, keywordbag in lemma_to_keywordbag.items():
                 lemma_to_keywordbag[lemma] = dict(keywordbag)
@@ -104,13 +132,17 @@ def write_terms_and_frequencies(path, user_term_matrix, label_to_lemma):
             fp.write(row)
 
 
-def form_user_term_matrix(user_twitter_list_keywords_gen, id_to_node, lemma_set=None, keyword_to_topic_manual=None):
+def form_user_term_matrix(user_twitter_list_keywords_gen, id_to_node, lemma_set=None, keyword_to_topic_manual=None,
+                          keyword_index=None):
     """
     Forms a user-term matrix.
 
     Input:   - user_twitter_list_keywords_gen: A python generator that yields a user Twitter id and a bag-of-words.
              - id_to_node:  A Twitter id to node map as a python dictionary.
              - lemma_set: For the labelling, we use only lemmas in this set. Default: None
+             - keyword_to_topic_manual: A python dictionary that maps keywords to topics. Default: None
+             - keyword_index: A prebuilt KeywordIndex over the keys of keyword_to_topic_manual. Default: None, in which
+                              case it is built here.
 
     Outputs: - user_term_matrix: A user-to-term matrix in scipy sparse matrix format.
              - annotated_nodes: A numpy array containing graph nodes.
@@ -136,8 +168,8 @@ def form_user_term_matrix(user_twitter_list_keywords_gen, id_to_node, lemma_set=
     invalid_terms = list()
     counter = 0
 
-    if keyword_to_topic_manual is not None:
-        manual_keyword_list = list(keyword_to_topic_manual.keys())
+    if (keyword_to_topic_manual is not None) and (keyword_index is None):
+        keyword_index = KeywordIndex(list(keyword_to_topic_manual.keys()), edit_distance=1)
 
     for user_twitter_id, user_annotation in user_twitter_list_keywords_gen:
         counter += 1
@@ -160,7 +192,7 @@ def form_user_term_matrix(user_twitter_list_keywords_gen, id_to_node, lemma_set=
                 keyword_bag = lemma_to_keywordbag[term]
                 term = max(keyword_bag.keys(), key=(lambda key: keyword_bag[key]))
 
-                found_list_of_words = simple_word_query(term, manual_keyword_list, edit_distance=1)
+                found_list_of_words = keyword_index.query(term)
 
                 if len(found_list_of_words) > 0:
                     term = found_list_of_words[0]
@@ -261,32 +293,26 @@ def filter_user_term_matrix(user_term_matrix, annotated_nodes, label_to_topic, m
     # percentile = 80
     percentile = 50
 
+    # Sort the scores within each topic column once; all candidate percentiles are evaluated on these segments.
+    sorted_data, sorted_row, sorted_col, column_indptr = get_sorted_column_segments(user_term_matrix)
+
     while True:
-        matrix_row = list()
-        matrix_col = list()
-        extend_matrix_row = matrix_row.extend
-        extend_matrix_col = matrix_col.extend
-
-        user_term_matrix = sparse.csc_matrix(user_term_matrix)
-        for topic in range(user_term_matrix.shape[1]):
-            col = user_term_matrix.getcol(topic)
-            p = np.percentile(col.data, percentile)
-            index = col.indices[col.data >= p]
-            extend_matrix_row(index)
-            extend_matrix_col(topic*np.ones_like(index))
-        matrix_row = np.array(matrix_row, dtype=np.int64)
-        matrix_col = np.array(matrix_col, dtype=np.int64)
-        matrix_data = np.ones_like(matrix_row, dtype=np.int8)
-        user_term_matrix = sparse.coo_matrix((matrix_data, (matrix_row, matrix_col)), shape=user_term_matrix.shape)
-        user_term_matrix = sparse.csr_matrix(user_term_matrix)
-
-        if (user_term_matrix.getnnz() > user_term_nnz/10) and (user_term_matrix.shape[1] > 1):
+        thresholds = get_column_percentiles(sorted_data, column_indptr, percentile)
+        is_annotated = sorted_data >= thresholds[sorted_col]
+
+        if (np.count_nonzero(is_annotated) > user_term_nnz/10) and (user_term_matrix.shape[1] > 1):
             break
         else:
             percentile -= 10
             if percentile <= 10:
                 break
 
+    matrix_row = sorted_row[is_annotated]
+    matrix_col = sorted_col[is_annotated]
+    matrix_data = np.ones_like(matrix_row, dtype=np.int8)
+    user_term_matrix = sparse.coo_matrix((matrix_data, (matrix_row, matrix_col)), shape=user_term_matrix.shape)
+    user_term_matrix = sparse.csr_matrix(user_term_matrix)
+
     # print(user_term_matrix.getnnz())
     # print(user_term_matrix.shape)
 
@@ -333,6 +359,77 @@ def filter_user_term_matrix(user_term_matrix, annotated_nodes, label_to_topic, m
     return user_term_matrix, annotated_nodes, label_to_topic
 
 
+def get_sorted_column_segments(matrix):
+    """
+    Sorts the nonzero values of a sparse matrix within each column.
+
+    Input:  - matrix: A matrix in scipy sparse matrix format.
+
+    Outputs: - sorted_data: The nonzero values, grouped by column and in increasing order within each column.
+             - sorted_row: The row index of each of the sorted values.
+             - sorted_col: The column index of each of the sorted values.
+             - column_indptr: The CSC index pointer; the values of column j are in sorted_data[indptr[j]:indptr[j+1]].
+    """
+    matrix = sparse.csc_matrix(matrix)
+    column_indptr = matrix.indptr
+
+    col = np.repeat(np.arange(matrix.shape[1], dtype=np.int64), np.diff(column_indptr))
+    order = np.lexsort((matrix.data, col))
+
+    sorted_data = matrix.data[order]
+    sorted_row = matrix.indices[order].astype(np.int64)
+    sorted_col = col[order]
+
+    return sorted_data, sorted_row, sorted_col, column_indptr
+
+
+def get_column_percentiles(sorted_data, column_indptr, percentile):
+    """
+    Calculates a percentile of the nonzero values of each column, from the output of get_sorted_column_segments.
+
+    The linear interpolation of numpy.percentile is replicated exactly, so that the thresholds are identical to calling
+    numpy.percentile on each column separately.
+
+    Inputs: - sorted_data: The nonzero values, grouped by column and in increasing order within each column.
+            - column_indptr: The CSC index pointer of the columns.
+            - percentile: The percentile in [0, 100].
+
+    Output: - column_percentiles: A numpy array with the percentile of each column; NaN for empty columns.
+    """
+    column_counts = np.diff(column_indptr)
+    column_percentiles = np.empty(column_counts.size, dtype=np.float64)
+    column_percentiles.fill(np.nan)
+
+    nonempty_columns = np.flatnonzero(column_counts)
+    if nonempty_columns.size == 0:
+        return column_percentiles
+    counts = column_counts[nonempty_columns]
+    offsets = column_indptr[nonempty_columns]
+
+    virtual_indices = (counts - 1)*(percentile/100)
+    previous_indices = np.floor(virtual_indices)
+    gamma = virtual_indices - previous_indices
+    previous_indices = previous_indices.astype(np.int64)
+    next_indices = previous_indices + 1
+
+    # At the upper bound, numpy takes the maximum value.
+    above_bounds = virtual_indices >= counts - 1
+    previous_indices[above_bounds] = counts[above_bounds] - 1
+    next_indices[above_bounds] = counts[above_bounds] - 1
+    gamma[above_bounds] = virtual_indices[above_bounds] + 1
+
+    previous_values = sorted_data[offsets + previous_indices]
+    next_values = sorted_data[offsets + next_indices]
+
+    difference = next_values - previous_values
+    interpolation = previous_values + difference*gamma
+    upper_half = gamma >= 0.5
+    interpolation[upper_half] = next_values[upper_half] - difference[upper_half]*(1 - gamma[upper_half])
+
+    column_percentiles[nonempty_columns] = interpolation
+    return column_percentiles
+
+
 # def filter_user_term_matrix(user_term_matrix, annotated_nodes, label_to_topic, max_number_of_labels=None):
 #     """
 #     Filters out labels that are either too rare, or have very few representatives.
@@ -550,7 +647,7 @@ def decide_which_users_to_annotate(centrality_vector,
     Inputs: - centrality_vector: A numpy array vector, that contains the centrality values for all users.
             - number_to_annotate: The number of users to annotate.
             - already_annotated: A python set of user twitter ids that have already been annotated.
-            - node_to_id: A python dictionary that maps graph nodes to user twitter ids.
+            - node_to_id: A numpy array that maps graph nodes to user twitter ids.
 
     Output: - user_id_list: A python list of Twitter user ids.
     """
@@ -569,7 +666,7 @@ def decide_which_users_to_annotate(centrality_vector,
 
     counter = 0
     for node in reversed_ind:
-        user_twitter_id = node_to_id[node]
+        user_twitter_id = int(node_to_id[node])
         if user_twitter_id not in already_annotated:
             append_user_id(user_twitter_id)
             counter += 1
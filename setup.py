@@ -41,7 +41,8 @@ setup(
     keywords="online-social-network user-annotation twitter-list-crowdsourcing Reveal-FP7",
     entry_points={
         'console_scripts': ['store_snow_tweets_in_mongo=reveal_user_annotation.entry_points.store_snow_tweets_in_mongo:main',
-                            'extract_twitter_list_keywords=reveal_user_annotation.entry_points.extract_twitter_list_keywords:main'],
+                            'extract_twitter_list_keywords=reveal_user_annotation.entry_points.extract_twitter_list_keywords:main',
+                            'pack_twitter_list_corpora=reveal_user_annotation.entry_points.pack_twitter_list_corpora:main'],
     },
     package_data={'reveal_user_annotation.text': ['res/stopwords/*.txt'],
                   'reveal_user_annotation.twitter': ['res/topics/*.txt']},